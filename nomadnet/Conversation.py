@@ -16,27 +16,9 @@ class Conversation:
         app = nomadnet.NomadNetworkApp.get_shared_instance()
 
         if not destination_hash in app.ignored_list:
-            destination_hash_text = RNS.hexrep(destination_hash, delimit=False)
-            # Check if the announced destination is in
-            # our list of conversations
-            if destination_hash_text in [e[0] for e in Conversation.conversation_list(app)]:
-                if app.directory.find(destination_hash):
-                    if Conversation.created_callback != None:
-                        Conversation.created_callback()
-                else:
-                    if Conversation.created_callback != None:
-                        Conversation.created_callback()
-
-            # This reformats the new v0.5.0 announce data back to the expected format
-            # for nomadnets storage and other handling functions.
-            dn = LXMF.display_name_from_app_data(app_data)
-            app_data = b""
-            if dn != None:
-                app_data = dn.encode("utf-8")
-            
             # Add the announce to the directory announce
             # stream logger
-            app.directory.lxmf_announce_received(destination_hash, app_data)
+            app.directory.queue_announce("peer", destination_hash, announced_identity, app_data)
             
         else:
             RNS.log("Ignored announce from "+RNS.prettyhexrep(destination_hash), RNS.LOG_DEBUG)
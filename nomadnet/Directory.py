@@ -1,11 +1,18 @@
 import os
 import RNS
 import LXMF
+import mmap
 import time
+import queue
+import struct
 import nomadnet
+import unicodedata
+import bisect
 import threading
 import RNS.vendor.umsgpack as msgpack
 
+from collections import OrderedDict
+
 from LXMF import pn_announce_data_is_valid
 
 class PNAnnounceHandler:
@@ -14,76 +21,213 @@ class PNAnnounceHandler:
         self.owner = owner
 
     def received_announce(self, destination_hash, announced_identity, app_data):
-        try:
-            if pn_announce_data_is_valid(app_data):
-                data = msgpack.unpackb(app_data)
-
-                if data[2] == True:
-                    RNS.log("Received active propagation node announce from "+RNS.prettyhexrep(destination_hash))
-
-                    associated_peer = RNS.Destination.hash_from_name_and_identity("lxmf.delivery", announced_identity)
-                    associated_node = RNS.Destination.hash_from_name_and_identity("nomadnetwork.node", announced_identity)
-
-                    self.owner.app.directory.pn_announce_received(destination_hash, app_data, associated_peer, associated_node)
-                    self.owner.app.autoselect_propagation_node()
-
-        except Exception as e:
-            RNS.log("Error while evaluating propagation node announce, ignoring announce.", RNS.LOG_DEBUG)
-            RNS.log("The contained exception was: "+str(e), RNS.LOG_DEBUG)
+        if not destination_hash in self.owner.app.ignored_list:
+            self.owner.queue_announce("pn", destination_hash, announced_identity, app_data)
 
 class Directory:
     ANNOUNCE_STREAM_MAXLENGTH = 256
+    ANNOUNCE_QUEUE_SIZE       = 2048
+    ANNOUNCE_BATCH_SIZE       = 128
+
+    CHANGED_NODES             = 0x01
+    CHANGED_PEERS             = 0x02
+    CHANGED_PNS               = 0x04
+    CHANGED_ENTRIES           = 0x08
+    CHANGED_TYPES             = {"node": CHANGED_NODES, "peer": CHANGED_PEERS, "pn": CHANGED_PNS}
+    PEER_COUNT_WINDOWS        = [5*60, 30*60, 24*60*60]
+
+    JOURNAL_REMEMBER          = 0x01
+    JOURNAL_FORGET            = 0x02
+    JOURNAL_COMPACT_RECORDS   = 256
+    JOURNAL_COMPACT_INTERVAL  = 10*60
+
+    # Characters commonly substituted for one another
+    # in look-alike display names, including Cyrillic
+    # letters rendered identically to Latin ones.
+    LOOKALIKES = str.maketrans({
+        "0": "o", "1": "l", "i": "l", "|": "l", "!": "l",
+        "3": "e", "5": "s", "$": "s", "@": "a", "7": "t",
+        "\u0430": "a", "\u0435": "e", "\u043e": "o", "\u0440": "p",
+        "\u0441": "c", "\u0445": "x", "\u0443": "y", "\u0456": "l",
+        "\u0458": "j", "\u0455": "s", "\u04cf": "l",
+    })
 
     aspect_filter = "nomadnetwork.node"
     @staticmethod
     def received_announce(destination_hash, announced_identity, app_data):
-        try:
-            app = nomadnet.NomadNetworkApp.get_shared_instance()
+        app = nomadnet.NomadNetworkApp.get_shared_instance()
 
-            if not destination_hash in app.ignored_list:
-                associated_peer = RNS.Destination.hash_from_name_and_identity("lxmf.delivery", announced_identity)
-
-                app.directory.node_announce_received(destination_hash, app_data, associated_peer)
-                app.autoselect_propagation_node()
-                
-            else:
-                RNS.log("Ignored announce from "+RNS.prettyhexrep(destination_hash), RNS.LOG_DEBUG)
-
-        except Exception as e:
-            RNS.log("Error while evaluating LXMF destination announce, ignoring announce.", RNS.LOG_DEBUG)
-            RNS.log("The contained exception was: "+str(e), RNS.LOG_DEBUG)
+        if not destination_hash in app.ignored_list:
+            app.directory.queue_announce("node", destination_hash, announced_identity, app_data)
+        else:
+            RNS.log("Ignored announce from "+RNS.prettyhexrep(destination_hash), RNS.LOG_DEBUG)
 
 
     def __init__(self, app):
         self.directory_entries = {}
-        self.announce_stream = []
+        self.announce_stream = AnnounceStream(Directory.ANNOUNCE_STREAM_MAXLENGTH)
+        self.announce_history = None
         self.app = app
         self.announce_lock = threading.Lock()
+        self.journal_lock = threading.Lock()
+        self.journalpath = self.app.directorypath+".journal"
+        self.journal_records = 0
+        self.last_compaction = time.time()
+        self.display_names = {}
+        self.normalised_names = {}
+        self.indexed_names = {}
+        self.peer_counter = PeerCounter(Directory.PEER_COUNT_WINDOWS)
+        self.pn_candidates = set()
+        self.sorted_nodes = []
+        self.node_keys = {}
+        self.announce_queue = queue.Queue(maxsize=Directory.ANNOUNCE_QUEUE_SIZE)
+        self.dropped_announces = 0
+        self.change_lock = threading.Lock()
+        self.change_listeners = []
+        self.pending_changes = 0
+
+        if self.app.announce_history > 0:
+            try:
+                self.announce_history = AnnounceHistory(self.app.announcespath, self.app.announce_history)
+            except Exception as e:
+                RNS.log("Could not open announce history, only recent announces will be kept. The contained exception was: "+str(e), RNS.LOG_ERROR)
+                self.announce_history = None
+
         self.load_from_disk()
 
+        ingest_thread = threading.Thread(target=self.__ingest_announces)
+        ingest_thread.daemon = True
+        ingest_thread.start()
+
         self.pn_announce_handler = PNAnnounceHandler(self)
         RNS.Transport.register_announce_handler(self.pn_announce_handler)
 
 
+    # Directory changes are appended to a journal as they happen,
+    # and periodically folded into the directory file, which is
+    # always replaced atomically.
     def save_to_disk(self):
         try:
-            packed_list = []
-            for source_hash in self.directory_entries:
-                e = self.directory_entries[source_hash]
-                packed_list.append((e.source_hash, e.display_name, e.trust_level, e.hosts_node, e.preferred_delivery, e.identify, e.sort_rank))
-
-            directory = {
-                "entry_list": packed_list,
-                "announce_stream": self.announce_stream
-            }
-
-            file = open(self.app.directorypath, "wb")
-            file.write(msgpack.packb(directory))
-            file.close()
+            with self.journal_lock:
+                packed_list = []
+                for source_hash in self.directory_entries:
+                    packed_list.append(self.pack_entry(self.directory_entries[source_hash]))
+
+                # With the announce history enabled, the stream lives
+                # in the ring file and is not duplicated here.
+                if self.announce_history != None:
+                    stream_list = []
+                    self.announce_history.flush()
+                else:
+                    stream_list = self.announce_stream.entries_list()
+
+                directory = {
+                    "entry_list": packed_list,
+                    "announce_stream": stream_list
+                }
+
+                tmp_path = self.app.directorypath+".tmp"
+                file = open(tmp_path, "wb")
+                file.write(msgpack.packb(directory))
+                file.flush()
+                os.fsync(file.fileno())
+                file.close()
+                os.replace(tmp_path, self.app.directorypath)
+
+                if os.path.isfile(self.journalpath):
+                    os.unlink(self.journalpath)
+
+                self.journal_records = 0
+                self.last_compaction = time.time()
 
         except Exception as e:
             RNS.log("Could not write directory to disk. Then contained exception was: "+str(e), RNS.LOG_ERROR)
 
+    # Without the announce history, the announce stream is only
+    # persisted in the directory file, so it is also written out
+    # periodically when no journal records are pending.
+    def compact_journal(self):
+        if self.journal_records > 0 or self.announce_history == None:
+            if self.journal_records >= Directory.JOURNAL_COMPACT_RECORDS or time.time() > self.last_compaction+Directory.JOURNAL_COMPACT_INTERVAL:
+                RNS.log("Compacting "+str(self.journal_records)+" directory journal records", RNS.LOG_DEBUG)
+                self.save_to_disk()
+
+    def journal(self, record):
+        try:
+            packed = msgpack.packb(record)
+            file = open(self.journalpath, "ab")
+            file.write(struct.pack(">I", len(packed))+packed)
+            file.close()
+            self.journal_records += 1
+
+        except Exception as e:
+            RNS.log("Could not write directory journal to disk. The contained exception was: "+str(e), RNS.LOG_ERROR)
+
+    def replay_journal(self):
+        if os.path.isfile(self.journalpath):
+            try:
+                file = open(self.journalpath, "rb")
+                journal = file.read()
+                file.close()
+
+                offset = 0
+                records = 0
+                while offset+4 <= len(journal):
+                    length = struct.unpack_from(">I", journal, offset)[0]
+                    if offset+4+length > len(journal):
+                        # Cut off a record torn by a crash, so new
+                        # records are not appended behind it
+                        RNS.log("Ignoring incomplete record at end of directory journal", RNS.LOG_WARNING)
+                        os.truncate(self.journalpath, offset)
+                        break
+
+                    record = msgpack.unpackb(journal[offset+4:offset+4+length])
+                    offset += 4+length
+                    records += 1
+
+                    if record[0] == Directory.JOURNAL_REMEMBER:
+                        entry = self.unpack_entry(record[1])
+                        self.directory_entries[entry.source_hash] = entry
+                        self.index_entry(entry)
+                    elif record[0] == Directory.JOURNAL_FORGET:
+                        self.directory_entries.pop(record[1], None)
+                        self.unindex_entry(record[1])
+
+                self.journal_records = records
+                RNS.log("Replayed "+str(records)+" directory journal records", RNS.LOG_DEBUG)
+
+            except Exception as e:
+                RNS.log("Could not replay directory journal. The contained exception was: "+str(e), RNS.LOG_ERROR)
+
+    def pack_entry(self, e):
+        return (e.source_hash, e.display_name, e.trust_level, e.hosts_node, e.preferred_delivery, e.identify, e.sort_rank)
+
+    def unpack_entry(self, e):
+        if e[1] == None:
+            e[1] = "Undefined"
+
+        if len(e) > 3:
+            hosts_node = e[3]
+        else:
+            hosts_node = False
+
+        if len(e) > 4:
+            preferred_delivery = e[4]
+        else:
+            preferred_delivery = None
+
+        if len(e) > 5:
+            identify = e[5]
+        else:
+            identify = False
+
+        if len(e) > 6:
+            sort_rank = e[6]
+        else:
+            sort_rank = None
+
+        return DirectoryEntry(e[0], e[1], e[2], hosts_node, preferred_delivery=preferred_delivery, identify_on_connect=identify, sort_rank=sort_rank)
+
     def load_from_disk(self):
         if os.path.isfile(self.app.directorypath):
             try:
@@ -94,138 +238,189 @@ class Directory:
 
                 entries = {}
                 for e in unpacked_list:
+                    entries[e[0]] = self.unpack_entry(e)
 
-                    if e[1] == None:
-                        e[1] = "Undefined"
+                self.directory_entries = entries
+                for source_hash in entries:
+                    self.index_entry(entries[source_hash])
 
-                    if len(e) > 3:
-                        hosts_node = e[3]
-                    else:
-                        hosts_node = False
+                self.announce_stream = AnnounceStream(Directory.ANNOUNCE_STREAM_MAXLENGTH, unpacked_directory["announce_stream"])
 
-                    if len(e) > 4:
-                        preferred_delivery = e[4]
-                    else:
-                        preferred_delivery = None
+                # Carry an existing stream over into a new history
+                if self.announce_history != None and len(self.announce_history) == 0:
+                    for entry in reversed(unpacked_directory["announce_stream"]):
+                        self.announce_history.append(entry)
 
-                    if len(e) > 5:
-                        identify = e[5]
-                    else:
-                        identify = False
+            except Exception as e:
+                RNS.log("Could not load directory from disk. The contained exception was: "+str(e), RNS.LOG_ERROR)
 
-                    if len(e) > 6:
-                        sort_rank = e[6]
-                    else:
-                        sort_rank = None
+        self.replay_journal()
 
-                    entries[e[0]] = DirectoryEntry(e[0], e[1], e[2], hosts_node, preferred_delivery=preferred_delivery, identify_on_connect=identify, sort_rank=sort_rank)
+        if self.announce_history != None:
+            recent = self.announce_history.latest(Directory.ANNOUNCE_STREAM_MAXLENGTH, compact=self.app.compact_stream)
+            self.announce_stream = AnnounceStream(Directory.ANNOUNCE_STREAM_MAXLENGTH, recent)
+            heard = self.announce_history.since(time.time()-self.peer_counter.longest)
+        else:
+            heard = reversed(self.announce_stream.entries_list())
 
-                self.directory_entries = entries
+        for entry in heard:
+            self.peer_counter.add(entry[1], entry[0])
 
-                self.announce_stream = unpacked_directory["announce_stream"]
+    def add_announce(self, entry):
+        self.announce_stream.add(entry)
+        self.peer_counter.add(entry[1], entry[0])
+        if self.announce_history != None:
+            self.announce_history.append(entry)
 
-            except Exception as e:
-                RNS.log("Could not load directory from disk. The contained exception was: "+str(e), RNS.LOG_ERROR)
+    def older_announces(self, before_timestamp, count, announce_types=None, exclude_sources=None):
+        if self.announce_history == None:
+            return []
+        else:
+            return self.announce_history.before(before_timestamp, count, announce_types, exclude_sources)
 
-    def lxmf_announce_received(self, source_hash, app_data):
-        with self.announce_lock:
-            if app_data != None:
-                if self.app.compact_stream:
-                    try:
-                        remove_announces = []
-                        for announce in self.announce_stream:
-                            if announce[1] == source_hash:
-                                remove_announces.append(announce)
-
-                        for a in remove_announces:
-                            self.announce_stream.remove(a)
-                    
-                    except Exception as e:
-                        RNS.log("An error occurred while compacting the announce stream. The contained exception was:"+str(e), RNS.LOG_ERROR)
-
-                timestamp = time.time()
-                self.announce_stream.insert(0, (timestamp, source_hash, app_data, "peer"))
-                while len(self.announce_stream) > Directory.ANNOUNCE_STREAM_MAXLENGTH:
-                    self.announce_stream.pop()
-
-                if hasattr(self.app, "ui") and self.app.ui != None:
-                    if hasattr(self.app.ui, "main_display"):
-                        self.app.ui.main_display.sub_displays.network_display.directory_change_callback()
-
-    def node_announce_received(self, source_hash, app_data, associated_peer):
-        with self.announce_lock:
-            if app_data != None:
-                if self.app.compact_stream:
-                    try:
-                        remove_announces = []
-                        for announce in self.announce_stream:
-                            if announce[1] == source_hash:
-                                remove_announces.append(announce)
-
-                        for a in remove_announces:
-                            self.announce_stream.remove(a)
-                    
-                    except Exception as e:
-                        RNS.log("An error occurred while compacting the announce stream. The contained exception was:"+str(e), RNS.LOG_ERROR)
-
-                timestamp = time.time()
-                self.announce_stream.insert(0, (timestamp, source_hash, app_data, "node"))
-                while len(self.announce_stream) > Directory.ANNOUNCE_STREAM_MAXLENGTH:
-                    self.announce_stream.pop()
-
-                if self.trust_level(associated_peer) == DirectoryEntry.TRUSTED:
-                    existing_entry = self.find(source_hash)
-                    if not existing_entry:
-                        node_entry = DirectoryEntry(source_hash, display_name=app_data.decode("utf-8"), trust_level=DirectoryEntry.TRUSTED, hosts_node=True)
-                        self.remember(node_entry)
-                
-                if hasattr(self.app.ui, "main_display"):
-                    self.app.ui.main_display.sub_displays.network_display.directory_change_callback()
-
-    def pn_announce_received(self, source_hash, app_data, associated_peer, associated_node):
-        with self.announce_lock:
-            found_node = None
-            for sh in self.directory_entries:
-                if sh == associated_node:
-                    found_node = True
+    # Announce handlers only queue raw announces, so no work is
+    # done on the transport thread. When announces arrive faster
+    # than they can be processed, new ones are dropped.
+    def queue_announce(self, announce_type, destination_hash, announced_identity, app_data):
+        try:
+            self.announce_queue.put_nowait((announce_type, time.time(), destination_hash, announced_identity, app_data))
+        except queue.Full:
+            if self.dropped_announces == 0:
+                RNS.log("Announce queue is full, dropping incoming announces", RNS.LOG_WARNING)
+            self.dropped_announces += 1
+
+    def __ingest_announces(self):
+        while True:
+            batch = [self.announce_queue.get()]
+            while len(batch) < Directory.ANNOUNCE_BATCH_SIZE:
+                try:
+                    batch.append(self.announce_queue.get_nowait())
+                except queue.Empty:
                     break
 
-            for e in self.announce_stream:
-                if e[1] == associated_node:
-                    found_node = True
-                    break
+            try:
+                self.process_announces(batch)
+            except Exception as e:
+                RNS.log("Error while processing announces. The contained exception was: "+str(e), RNS.LOG_ERROR)
+
+            if self.dropped_announces > 0 and self.announce_queue.empty():
+                RNS.log("Announce queue drained, "+str(self.dropped_announces)+" announces were dropped", RNS.LOG_WARNING)
+                self.dropped_announces = 0
 
-            # TODO: Remove debug and rethink this (needs way to set PN when node is saved)
-            if True or not found_node:
+    def process_announces(self, batch):
+        entries = []
+        trusted_nodes = []
+        changed_candidates = set()
+        conversations_changed = False
+
+        for announce_type, timestamp, destination_hash, announced_identity, app_data in batch:
+            try:
+                if announce_type == "peer":
+                    # This reformats the new v0.5.0 announce data back to the expected format
+                    # for nomadnets storage and other handling functions.
+                    dn = LXMF.display_name_from_app_data(app_data)
+                    app_data = b""
+                    if dn != None:
+                        app_data = dn.encode("utf-8")
+
+                    # Check if the announced destination is in
+                    # our list of conversations
+                    if os.path.isdir(self.app.conversationpath+"/"+RNS.hexrep(destination_hash, delimit=False)):
+                        conversations_changed = True
+
+                    entries.append((timestamp, destination_hash, app_data, "peer"))
+
+                elif announce_type == "node":
+                    if app_data != None:
+                        associated_peer = RNS.Destination.hash_from_name_and_identity("lxmf.delivery", announced_identity)
+                        entries.append((timestamp, destination_hash, app_data, "node"))
+                        trusted_nodes.append((destination_hash, app_data, associated_peer))
+
+                        if self.is_pn_candidate(destination_hash):
+                            changed_candidates.add(destination_hash)
+
+                elif announce_type == "pn":
+                    if pn_announce_data_is_valid(app_data):
+                        data = msgpack.unpackb(app_data)
+
+                        if data[2] == True:
+                            RNS.log("Received active propagation node announce from "+RNS.prettyhexrep(destination_hash))
+                            associated_node = RNS.Destination.hash_from_name_and_identity("nomadnetwork.node", announced_identity)
+                            entries.append((timestamp, destination_hash, app_data, "pn"))
+
+                            if self.is_pn_candidate(associated_node):
+                                changed_candidates.add(associated_node)
+
+            except Exception as e:
+                RNS.log("Error while evaluating announce from "+RNS.prettyhexrep(destination_hash)+", ignoring announce.", RNS.LOG_DEBUG)
+                RNS.log("The contained exception was: "+str(e), RNS.LOG_DEBUG)
+
+        # With a compacted stream, only the latest announce
+        # from each source in the batch is kept
+        if self.app.compact_stream:
+            latest = {}
+            for entry in entries:
+                latest[entry[1]] = entry
+            entries = [e for e in entries if latest[e[1]] is e]
+
+        with self.announce_lock:
+            for entry in entries:
                 if self.app.compact_stream:
-                    try:
-                        remove_announces = []
-                        for announce in self.announce_stream:
-                            if announce[1] == source_hash:
-                                remove_announces.append(announce)
-
-                        for a in remove_announces:
-                            self.announce_stream.remove(a)
-                    
-                    except Exception as e:
-                        RNS.log("An error occurred while compacting the announce stream. The contained exception was:"+str(e), RNS.LOG_ERROR)
-
-                timestamp = time.time()
-                self.announce_stream.insert(0, (timestamp, source_hash, app_data, "pn"))
-                while len(self.announce_stream) > Directory.ANNOUNCE_STREAM_MAXLENGTH:
-                    self.announce_stream.pop()
-                
-                if hasattr(self.app, "ui") and hasattr(self.app.ui, "main_display"):
-                    self.app.ui.main_display.sub_displays.network_display.directory_change_callback()
+                    self.announce_stream.remove_source(entry[1])
+                self.add_announce(entry)
+
+        for source_hash, app_data, associated_peer in trusted_nodes:
+            if self.trust_level(associated_peer) == DirectoryEntry.TRUSTED:
+                existing_entry = self.find(source_hash)
+                if not existing_entry:
+                    node_entry = DirectoryEntry(source_hash, display_name=app_data.decode("utf-8"), trust_level=DirectoryEntry.TRUSTED, hosts_node=True)
+                    self.remember(node_entry)
+
+        for node_hash in changed_candidates:
+            self.app.autoselect_propagation_node(node_hash)
+
+        if conversations_changed and nomadnet.Conversation.created_callback != None:
+            nomadnet.Conversation.created_callback()
+
+        changes = 0
+        for entry in entries:
+            changes |= Directory.CHANGED_TYPES[entry[3]]
+        self.notify_change(changes)
+
+    # Changes are accumulated as flags until a listener takes
+    # them, and listeners are only called when the first change
+    # after a take arrives, so bursts of changes coalesce into
+    # a single notification.
+    def add_change_listener(self, callback):
+        with self.change_lock:
+            self.change_listeners.append(callback)
+            pending = self.pending_changes
+
+        if pending != 0:
+            callback()
+
+    def notify_change(self, changes):
+        if changes != 0:
+            with self.change_lock:
+                should_notify = self.pending_changes == 0
+                self.pending_changes |= changes
+                listeners = list(self.change_listeners)
+
+            if should_notify:
+                for callback in listeners:
+                    callback()
+
+    def take_changes(self):
+        with self.change_lock:
+            changes = self.pending_changes
+            self.pending_changes = 0
+            return changes
 
     def remove_announce_with_timestamp(self, timestamp):
-        selected_announce = None
-        for announce in self.announce_stream:
-            if announce[0] == timestamp:
-                selected_announce = announce
-
-        if selected_announce != None:
-            self.announce_stream.remove(selected_announce)
+        with self.announce_lock:
+            self.announce_stream.remove_timestamp(timestamp)
+            if self.announce_history != None:
+                self.announce_history.remove(timestamp)
 
     def display_name(self, source_hash):
         if source_hash in self.directory_entries:
@@ -261,17 +456,80 @@ class Directory:
             return None
 
 
+    def index_entry(self, entry):
+        self.index_name(entry)
+        if entry.hosts_node and entry.trust_level == DirectoryEntry.TRUSTED:
+            self.pn_candidates.add(entry.source_hash)
+        else:
+            self.pn_candidates.discard(entry.source_hash)
+
+        self.unindex_node(entry.source_hash)
+        if entry.hosts_node:
+            key = (Directory.entry_sort_key(entry), entry.source_hash)
+            self.node_keys[entry.source_hash] = key
+            bisect.insort(self.sorted_nodes, key)
+
+    def unindex_entry(self, source_hash):
+        self.unindex_name(source_hash)
+        self.pn_candidates.discard(source_hash)
+        self.unindex_node(source_hash)
+
+    # Known nodes are kept sorted by their sort keys, so
+    # listing them never requires sorting the directory
+    def unindex_node(self, source_hash):
+        if source_hash in self.node_keys:
+            key = self.node_keys.pop(source_hash)
+            position = bisect.bisect_left(self.sorted_nodes, key)
+            del self.sorted_nodes[position]
+
+    # Trusted nodes are the candidates for automatic
+    # propagation node selection
+    def is_pn_candidate(self, source_hash):
+        return source_hash in self.pn_candidates
+
+    def propagation_node_candidates(self):
+        return list(self.pn_candidates)
+
+    @staticmethod
+    def normalise_name(display_name):
+        name = unicodedata.normalize("NFKC", display_name).casefold()
+        name = "".join(c for c in name if not unicodedata.category(c) in ["Cf", "Mn", "Zs", "Cc"])
+        return name.translate(Directory.LOOKALIKES)
+
+    # Display names are indexed both as-is and normalised, so
+    # impersonation checks do not need to scan the directory
+    def index_name(self, entry):
+        self.unindex_name(entry.source_hash)
+        if entry.display_name != None:
+            self.indexed_names[entry.source_hash] = entry.display_name
+            self.display_names.setdefault(entry.display_name, set()).add(entry.source_hash)
+            self.normalised_names.setdefault(Directory.normalise_name(entry.display_name), set()).add(entry.source_hash)
+
+    def unindex_name(self, source_hash):
+        if source_hash in self.indexed_names:
+            display_name = self.indexed_names.pop(source_hash)
+            for index, key in [(self.display_names, display_name), (self.normalised_names, Directory.normalise_name(display_name))]:
+                hashes = index[key]
+                hashes.discard(source_hash)
+                if len(hashes) == 0:
+                    index.pop(key)
+
+    def name_used_by_other(self, display_name, source_hash):
+        for index, key in [(self.display_names, display_name), (self.normalised_names, Directory.normalise_name(display_name))]:
+            hashes = index.get(key)
+            if hashes != None and (len(hashes) > 1 or not source_hash in hashes):
+                return True
+
+        return False
+
     def trust_level(self, source_hash, announced_display_name=None):
         if source_hash in self.directory_entries:
             if announced_display_name == None:
                 return self.directory_entries[source_hash].trust_level
             else:
                 if not self.directory_entries[source_hash].trust_level == DirectoryEntry.TRUSTED:
-                    for entry in self.directory_entries:
-                        e = self.directory_entries[entry]
-                        if e.display_name == announced_display_name:
-                            if e.source_hash != source_hash:
-                                return DirectoryEntry.WARNING
+                    if self.name_used_by_other(announced_display_name, source_hash):
+                        return DirectoryEntry.WARNING
 
                 return self.directory_entries[source_hash].trust_level
         else:
@@ -296,20 +554,41 @@ class Directory:
             return DirectoryEntry.DIRECT
 
     def remember(self, entry):
-        self.directory_entries[entry.source_hash] = entry
-
         identity = RNS.Identity.recall(entry.source_hash)
-        if identity != None:
-            associated_node = RNS.Destination.hash_from_name_and_identity("nomadnetwork.node", identity)
-            if associated_node in self.directory_entries:
-                node_entry = self.directory_entries[associated_node]
-                node_entry.trust_level = entry.trust_level
+        with self.journal_lock:
+            candidates = set(self.pn_candidates)
+            self.directory_entries[entry.source_hash] = entry
+            self.index_entry(entry)
+            self.journal((Directory.JOURNAL_REMEMBER, self.pack_entry(entry)))
 
-        self.save_to_disk()
+            if identity != None:
+                associated_node = RNS.Destination.hash_from_name_and_identity("nomadnetwork.node", identity)
+                if associated_node in self.directory_entries:
+                    node_entry = self.directory_entries[associated_node]
+                    node_entry.trust_level = entry.trust_level
+                    self.index_entry(node_entry)
+                    self.journal((Directory.JOURNAL_REMEMBER, self.pack_entry(node_entry)))
+
+            candidates_changed = candidates != self.pn_candidates
+
+        if candidates_changed:
+            self.app.autoselect_propagation_node()
+
+        self.notify_change(Directory.CHANGED_ENTRIES)
 
     def forget(self, source_hash):
-        if source_hash in self.directory_entries:
-            self.directory_entries.pop(source_hash)
+        candidates_changed = False
+        with self.journal_lock:
+            if source_hash in self.directory_entries:
+                candidates_changed = self.is_pn_candidate(source_hash)
+                self.directory_entries.pop(source_hash)
+                self.unindex_entry(source_hash)
+                self.journal((Directory.JOURNAL_FORGET, source_hash))
+
+        if candidates_changed:
+            self.app.autoselect_propagation_node()
+
+        self.notify_change(Directory.CHANGED_ENTRIES)
 
     def find(self, source_hash):
         if source_hash in self.directory_entries:
@@ -337,33 +616,410 @@ class Directory:
             return False
 
     def set_identify_on_connect(self, source_hash, state):
-        if source_hash in self.directory_entries:
-            entry = self.directory_entries[source_hash]
-            entry.identify = state
+        with self.journal_lock:
+            if source_hash in self.directory_entries:
+                entry = self.directory_entries[source_hash]
+                entry.identify = state
+                self.journal((Directory.JOURNAL_REMEMBER, self.pack_entry(entry)))
     
     def known_nodes(self):
-        node_list = []
-        for eh in self.directory_entries:
-            e = self.directory_entries[eh]
-            if e.hosts_node:
-                node_list.append(e)
+        with self.journal_lock:
+            return [self.directory_entries[key[1]] for key in self.sorted_nodes]
+
+    @staticmethod
+    def entry_sort_key(e):
+        return (e.sort_rank if e.sort_rank != None else 2**32, DirectoryEntry.TRUSTED-e.trust_level, e.display_name if e.display_name != None else "_")
 
-        node_list.sort(key = lambda e: (e.sort_rank if e.sort_rank != None else 2^32, DirectoryEntry.TRUSTED-e.trust_level, e.display_name if e.display_name != None else "_"))
-        return node_list
+    def sort_key(self, source_hash):
+        e = self.directory_entries.get(source_hash)
+        if e == None:
+            return (2**32, DirectoryEntry.TRUSTED, "_")
+        else:
+            return Directory.entry_sort_key(e)
 
     def number_of_known_nodes(self):
-        return len(self.known_nodes())
+        return len(self.node_keys)
 
     def number_of_known_peers(self, lookback_seconds=None):
-        unique_hashes = []
-        cutoff_time = time.time()-lookback_seconds
+        if lookback_seconds in self.peer_counter.windows:
+            return self.peer_counter.count(lookback_seconds)
+
+        unique_hashes = set()
         for entry in self.announce_stream:
-            if not entry[1] in unique_hashes:
-                if lookback_seconds == None or entry[0] > cutoff_time:
-                    unique_hashes.append(entry[1])
+            if lookback_seconds == None or entry[0] > time.time()-lookback_seconds:
+                unique_hashes.add(entry[1])
 
         return len(unique_hashes)
 
+    def heard_peers(self):
+        return self.peer_counter.counts()
+
+class IgnoreList:
+    # Holds the destinations listed in the ignore file, one hash
+    # per line. A line can also hold a hash prefix followed by
+    # "*", which ignores every destination starting with it, and
+    # anything after a "#" is a comment. Exact hashes are kept in
+    # a set, and prefixes in sets per prefix length, so checking
+    # a destination does not depend on the size of the list.
+    RELOAD_INTERVAL = 5
+
+    def __init__(self, path):
+        self.path = path
+        self.hashes = set()
+        self.prefixes = {}
+        self.mtime = None
+        self.last_check = time.time()
+        self.load()
+
+    def file_mtime(self):
+        try:
+            return os.path.getmtime(self.path)
+        except OSError:
+            return None
+
+    def load(self):
+        hashes = set()
+        prefixes = {}
+        self.mtime = self.file_mtime()
+
+        if self.mtime != None:
+            try:
+                fh = open(self.path, "rb")
+                ignored_input = fh.read()
+                fh.close()
+
+                for line in ignored_input.splitlines():
+                    hash_str = line.split(b"#")[0].strip()
+                    if len(hash_str) > 0:
+                        try:
+                            hash_str = hash_str.decode("utf-8").lower()
+                            if hash_str.endswith("*") and len(hash_str) > 1 and len(hash_str) <= RNS.Identity.TRUNCATED_HASHLENGTH//8*2+1:
+                                prefix = hash_str[:-1]
+                                int(prefix, 16)
+                                prefixes.setdefault(len(prefix), set()).add(prefix)
+                            elif len(hash_str) == RNS.Identity.TRUNCATED_HASHLENGTH//8*2:
+                                hashes.add(bytes.fromhex(hash_str))
+                            else:
+                                raise ValueError("Invalid hash length")
+
+                        except Exception as e:
+                            RNS.log("Could not decode RNS Identity hash from: "+str(line), RNS.LOG_DEBUG)
+                            RNS.log("The contained exception was: "+str(e), RNS.LOG_DEBUG)
+
+            except Exception as e:
+                RNS.log("Error while loading list of ignored destinations: "+str(e), RNS.LOG_ERROR)
+
+        self.hashes = hashes
+        self.prefixes = prefixes
+
+    # Reloads the list if the file changed, and returns the
+    # exact hashes that were added and removed, or None if
+    # the file was unchanged.
+    def reload_if_changed(self):
+        self.last_check = time.time()
+        if self.file_mtime() == self.mtime:
+            return None
+        else:
+            previous = self.hashes
+            self.load()
+            RNS.log("Reloaded list of ignored destinations, "+str(len(self.hashes))+" destinations and "+str(sum(len(p) for p in self.prefixes.values()))+" prefixes are ignored", RNS.LOG_VERBOSE)
+            return (self.hashes-previous, previous-self.hashes)
+
+    def __contains__(self, destination_hash):
+        if destination_hash in self.hashes:
+            return True
+
+        if len(self.prefixes) > 0:
+            hash_str = destination_hash.hex()
+            for length in self.prefixes:
+                if hash_str[:length] in self.prefixes[length]:
+                    return True
+
+        return False
+
+    def __iter__(self):
+        return iter(list(self.hashes))
+
+    def __len__(self):
+        return len(self.hashes)
+
+class PeerCounter:
+    # Counts unique announcing sources within several sliding
+    # windows at once. Each window maps sources to the time they
+    # were last heard, ordered from least to most recently heard,
+    # so memory grows with the number of unique sources instead of
+    # the number of announces, and expired sources are popped from
+    # the front.
+    def __init__(self, windows):
+        self.windows = sorted(windows)
+        self.longest = self.windows[-1]
+        self.sources = {}
+        self.lock = threading.Lock()
+        for window in self.windows:
+            self.sources[window] = OrderedDict()
+
+    def expire(self, now):
+        for window in self.windows:
+            sources = self.sources[window]
+            cutoff = now-window
+            while len(sources) > 0:
+                source_hash = next(iter(sources))
+                if sources[source_hash] > cutoff:
+                    break
+                sources.popitem(last=False)
+
+    def add(self, source_hash, heard_at):
+        with self.lock:
+            now = time.time()
+            self.expire(now)
+            for window in self.windows:
+                if heard_at > now-window:
+                    sources = self.sources[window]
+                    previous = sources.get(source_hash)
+                    if previous == None or previous < heard_at:
+                        sources[source_hash] = heard_at
+                        sources.move_to_end(source_hash)
+
+    def count(self, window):
+        with self.lock:
+            self.expire(time.time())
+            return len(self.sources[window])
+
+    def counts(self):
+        with self.lock:
+            self.expire(time.time())
+            counts = {}
+            for window in self.windows:
+                counts[window] = len(self.sources[window])
+            return counts
+
+class AnnounceStream:
+    # Announces are kept in insertion order, with indexes from
+    # source hash and timestamp to entry IDs, so adding, compacting
+    # and removing announces does not require scanning the stream.
+    # Entries keep the (timestamp, source_hash, app_data, type)
+    # shape, and iterating yields them newest first.
+    def __init__(self, maxlength, entries=None):
+        self.maxlength = maxlength
+        self.entries = OrderedDict()
+        self.sources = {}
+        self.timestamps = {}
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+        if entries != None:
+            for entry in reversed(entries):
+                self.add(entry)
+
+    def add(self, entry):
+        with self.lock:
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = entry
+            self.sources.setdefault(entry[1], set()).add(entry_id)
+            self.timestamps.setdefault(entry[0], set()).add(entry_id)
+
+            while len(self.entries) > self.maxlength:
+                self.__remove(next(iter(self.entries)))
+
+    def remove_source(self, source_hash):
+        with self.lock:
+            for entry_id in list(self.sources.get(source_hash, [])):
+                self.__remove(entry_id)
+
+    def remove_timestamp(self, timestamp):
+        with self.lock:
+            for entry_id in list(self.timestamps.get(timestamp, [])):
+                self.__remove(entry_id)
+
+    def entries_list(self):
+        with self.lock:
+            return list(reversed(self.entries.values()))
+
+    def __iter__(self):
+        return iter(self.entries_list())
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __remove(self, entry_id):
+        entry = self.entries.pop(entry_id)
+        for index, key in [(self.sources, entry[1]), (self.timestamps, entry[0])]:
+            ids = index[key]
+            ids.discard(entry_id)
+            if len(ids) == 0:
+                index.pop(key)
+
+class AnnounceHistory:
+    # A fixed-size ring of announces in a memory-mapped file. Every
+    # record has the same width, so a record is found by its sequence
+    # number alone, and since announces are appended in time order,
+    # timestamps can be binary searched for paging and deletion.
+    MAGIC          = b"NNAH"
+    VERSION        = 0x01
+    HEADER_FORMAT  = ">4sBIIQ"
+    HEADER_SIZE    = 64
+    RECORD_FORMAT  = ">dB16sH"
+    RECORD_SIZE    = 512
+    MAX_APP_DATA   = RECORD_SIZE-struct.calcsize(RECORD_FORMAT)
+
+    DELETED = 0x00
+    TYPES   = {"peer": 0x01, "node": 0x02, "pn": 0x03}
+    NAMES   = {0x01: "peer", 0x02: "node", 0x03: "pn"}
+
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        self.written = 0
+        self.lock = threading.Lock()
+        self.prefix_size = struct.calcsize(AnnounceHistory.RECORD_FORMAT)
+        size = AnnounceHistory.HEADER_SIZE+capacity*AnnounceHistory.RECORD_SIZE
+
+        self.file = None
+        if os.path.isfile(path) and os.path.getsize(path) == size:
+            self.file = open(path, "r+b")
+            header = self.file.read(struct.calcsize(AnnounceHistory.HEADER_FORMAT))
+            magic, version, record_size, file_capacity, written = struct.unpack(AnnounceHistory.HEADER_FORMAT, header)
+            if magic == AnnounceHistory.MAGIC and version == AnnounceHistory.VERSION and record_size == AnnounceHistory.RECORD_SIZE and file_capacity == capacity:
+                self.written = written
+            else:
+                self.file.close()
+                self.file = None
+
+        if self.file == None:
+            if os.path.isfile(path):
+                RNS.log("Announce history capacity or format changed, starting a new history", RNS.LOG_NOTICE)
+
+            self.file = open(path, "w+b")
+            self.file.truncate(size)
+
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.write_header()
+
+    def write_header(self):
+        struct.pack_into(AnnounceHistory.HEADER_FORMAT, self.map, 0, AnnounceHistory.MAGIC, AnnounceHistory.VERSION, AnnounceHistory.RECORD_SIZE, self.capacity, self.written)
+
+    def oldest(self):
+        return max(0, self.written-self.capacity)
+
+    def offset(self, seq):
+        return AnnounceHistory.HEADER_SIZE+(seq%self.capacity)*AnnounceHistory.RECORD_SIZE
+
+    def timestamp(self, seq):
+        return struct.unpack_from(">d", self.map, self.offset(seq))[0]
+
+    def read(self, seq):
+        offset = self.offset(seq)
+        timestamp, announce_type, source_hash, length = struct.unpack_from(AnnounceHistory.RECORD_FORMAT, self.map, offset)
+        if announce_type == AnnounceHistory.DELETED:
+            return None
+        else:
+            app_data = self.map[offset+self.prefix_size:offset+self.prefix_size+length]
+            return (timestamp, source_hash, app_data, AnnounceHistory.NAMES[announce_type])
+
+    # Returns the first sequence number with a
+    # timestamp equal to or later than the given
+    def search(self, timestamp):
+        low = self.oldest()
+        high = self.written
+        while low < high:
+            mid = (low+high)//2
+            if self.timestamp(mid) < timestamp:
+                low = mid+1
+            else:
+                high = mid
+
+        return low
+
+    def append(self, entry):
+        timestamp, source_hash, app_data, announce_type = entry
+        if announce_type == True:
+            announce_type = "node"
+        elif announce_type == False:
+            announce_type = "peer"
+
+        if app_data == None:
+            app_data = b""
+
+        if not announce_type in AnnounceHistory.TYPES or len(source_hash) != RNS.Identity.TRUNCATED_HASHLENGTH//8 or len(app_data) > AnnounceHistory.MAX_APP_DATA:
+            RNS.log("Announce from "+RNS.prettyhexrep(source_hash)+" does not fit in announce history, keeping it in memory only", RNS.LOG_DEBUG)
+            return False
+
+        with self.lock:
+            offset = self.offset(self.written)
+            struct.pack_into(AnnounceHistory.RECORD_FORMAT, self.map, offset, timestamp, AnnounceHistory.TYPES[announce_type], source_hash, len(app_data))
+            self.map[offset+self.prefix_size:offset+self.prefix_size+len(app_data)] = app_data
+            self.written += 1
+            self.write_header()
+
+        return True
+
+    def remove(self, timestamp):
+        with self.lock:
+            seq = self.search(timestamp)
+            while seq < self.written and self.timestamp(seq) == timestamp:
+                self.map[self.offset(seq)+8] = AnnounceHistory.DELETED
+                seq += 1
+
+    def latest(self, count, compact=False):
+        if compact:
+            return self.before(None, count, exclude_sources=set())
+        else:
+            return self.before(None, count)
+
+    # Pages announces older than before_timestamp, newest first.
+    # If a set of excluded sources is passed, it is extended with
+    # every returned source, so successive pages stay compacted.
+    def before(self, before_timestamp, count, announce_types=None, exclude_sources=None):
+        entries = []
+        with self.lock:
+            if before_timestamp == None:
+                seq = self.written-1
+            else:
+                seq = self.search(before_timestamp)-1
+
+            oldest = self.oldest()
+            while seq >= oldest and len(entries) < count:
+                entry = self.read(seq)
+                seq -= 1
+                if entry != None:
+                    if announce_types != None and not entry[3] in announce_types:
+                        continue
+                    if exclude_sources != None:
+                        if entry[1] in exclude_sources:
+                            continue
+                        exclude_sources.add(entry[1])
+
+                    entries.append(entry)
+
+        return entries
+
+    # Returns announces heard since the given time, oldest first
+    def since(self, timestamp):
+        entries = []
+        with self.lock:
+            seq = self.search(timestamp)
+            while seq < self.written:
+                entry = self.read(seq)
+                seq += 1
+                if entry != None:
+                    entries.append(entry)
+
+        return entries
+
+    def flush(self):
+        with self.lock:
+            self.map.flush()
+
+    def close(self):
+        with self.lock:
+            self.map.flush()
+            self.map.close()
+            self.file.close()
+
+    def __len__(self):
+        return self.written-self.oldest()
+
 class DirectoryEntry:
     WARNING   = 0x00
     UNTRUSTED = 0x01
@@ -1,16 +1,46 @@
 import os
+import bz2
 import sys
+import stat
+import queue
+import hashlib
+import importlib.util
+import multiprocessing
+import concurrent.futures
 
 import RNS
+import json
 import time
+import bisect
 import threading
 import subprocess
 import RNS.vendor.umsgpack as msgpack
 
+from collections import OrderedDict
+
 class Node:
     JOB_INTERVAL = 5
     START_ANNOUNCE_DELAY = 6
 
+    FILE_COMPRESSION_LIMIT = 32_000_000
+    COMPRESSION_SAMPLE_SIZE = 64*1024
+    COMPRESSION_MIN_RATIO = 0.9
+    MAX_RANGE_LENGTH = 4*1000*1000
+    MAX_TRACKED_RANGES = 1024
+    VARIANT_PATH_PREFIX = "/bz2"
+    VARIANT_COMPRESSION = "bz2"
+    LISTING_PATH_PREFIX = "/list"
+    NOT_MODIFIED = "not_modified"
+    PLAIN_PATH = "plain_path"
+    RATE_LIMITED = "rate_limited"
+    STATS_LOG_INTERVAL = 15*60
+    INCOMPRESSIBLE_EXTENSIONS = [
+        ".7z", ".apk", ".avif", ".br", ".bz2", ".deb", ".docx", ".epub", ".flac", ".gif", ".gz",
+        ".heic", ".jar", ".jpeg", ".jpg", ".lz", ".lzma", ".m4a", ".mkv", ".mov", ".mp3", ".mp4",
+        ".odt", ".ogg", ".opus", ".png", ".rar", ".rpm", ".tgz", ".webm", ".webp", ".whl", ".xlsx",
+        ".xz", ".zip", ".zst",
+    ]
+
     def __init__(self, app):
         RNS.log("Nomad Network Node starting...", RNS.LOG_VERBOSE)
         self.app = app
@@ -26,10 +56,40 @@ class Node:
         self.should_run_jobs = True
         self.app_data = None
         self.name = self.app.node_name
+        self.servedpages = set()
+        self.servedfiles = set()
+        self.servedlistings = set()
+        self.compressible_files = {}
+        self.range_offsets = OrderedDict()
+        self.range_lock = threading.Lock()
+        self.serving_default_index = False
+        self.metrics = NodeMetrics()
+        self.page_cache = PageCache(self.app.page_cache_size)
+        self.response_cache = ResponseCache(self.app.page_output_cache_size)
+        self.request_coalescer = RequestCoalescer()
+        self.acl_registry = ACLRegistry(self.app.allowed_script_ttl)
+        self.content_index = ContentIndex(self.app.contentindexpath)
+        self.variant_store = VariantStore(self.app.variantspath, self.app.variant_store_size, self.app.variant_max_file_size, Node.COMPRESSION_MIN_RATIO, self.content_index)
+        self.handler_pools = {}
+        self.python_handlers = PythonPageHandlers(self.app.python_handler_pool, self.app.python_handler_workers)
+        self.file_listings = FileListings(self.app.filespath, self.app.file_listing_page_size)
+        self.page_rate_limiter = RateLimiter(self.app.page_rate_limit, self.app.page_rate_burst, self.app.page_rate_limit_total)
+        self.file_rate_limiter = RateLimiter(self.app.file_rate_limit, self.app.file_rate_burst, self.app.file_rate_limit_total)
+        self.last_stats_log = time.time()
+        self.last_metrics_snapshot = time.time()
+        self.page_scheduler = PageScheduler(self.app.max_page_executions, self.app.max_page_executions_per_page, self.app.max_queued_page_requests, self.app.page_execution_timeout)
+        self.handler_pools_lock = threading.Lock()
 
         self.register_pages()
         self.register_files()
 
+        # Clients can request the variant path prefix itself to
+        # find out whether this node serves compressed variants
+        self.destination.register_request_handler(
+            Node.VARIANT_PATH_PREFIX,
+            response_generator = self.serve_variant_support,
+            allow = RNS.Destination.ALLOW_ALL)
+
         self.destination.set_link_established_callback(self.peer_connected)
 
         if self.name == None:
@@ -52,114 +112,208 @@ class Node:
 
 
     def register_pages(self):
-        # TODO: Deregister previously registered pages
-        # that no longer exist.
-        self.servedpages = []
-        self.scan_pages(self.app.pagespath)
+        scanned_pages = self.scan_pages(self.app.pagespath)
+        added_pages = scanned_pages-self.servedpages
+        removed_pages = self.servedpages-scanned_pages
 
-        if not self.app.pagespath+"index.mu" in self.servedpages:
-            self.destination.register_request_handler(
-                "/page/index.mu",
-                response_generator = self.serve_default_index,
-                allow = RNS.Destination.ALLOW_ALL)
+        for page in removed_pages:
+            request_path = "/page"+page.replace(self.app.pagespath, "", 1)
+            self.destination.deregister_request_handler(request_path)
+            self.destination.deregister_request_handler(Node.VARIANT_PATH_PREFIX+request_path)
+            self.page_cache.invalidate(page)
+            self.content_index.forget(page)
+            self.python_handlers.forget(page)
+            self.acl_registry.forget(page+".allowed")
+            RNS.log("Deregistered removed page "+request_path, RNS.LOG_DEBUG)
 
-        for page in self.servedpages:
-            request_path = "/page"+page.replace(self.app.pagespath, "")
+        for page in added_pages:
+            request_path = "/page"+page.replace(self.app.pagespath, "", 1)
             self.destination.register_request_handler(
                 request_path,
                 response_generator = self.serve_page,
                 allow = RNS.Destination.ALLOW_ALL)
+            self.register_variant(request_path, self.serve_page_variant)
+
+        self.servedpages = scanned_pages
+
+        if not self.app.pagespath+"/index.mu" in self.servedpages:
+            if not self.serving_default_index:
+                self.destination.register_request_handler(
+                    "/page/index.mu",
+                    response_generator = self.serve_default_index,
+                    allow = RNS.Destination.ALLOW_ALL)
+                self.register_variant("/page/index.mu", self.serve_page_variant)
+                self.serving_default_index = True
+        else:
+            self.serving_default_index = False
+
+        if len(added_pages) > 0 or len(removed_pages) > 0:
+            RNS.log("Page registry updated, "+str(len(added_pages))+" added, "+str(len(removed_pages))+" removed", RNS.LOG_VERBOSE)
 
     def register_files(self):
-        # TODO: Deregister previously registered files
-        # that no longer exist.
-        self.servedfiles = []
-        self.scan_files(self.app.filespath)
+        scanned_files = self.scan_files(self.app.filespath)
+        added_files = scanned_files-self.servedfiles
+        removed_files = self.servedfiles-scanned_files
+
+        for file in removed_files:
+            request_path = "/file"+file.replace(self.app.filespath, "", 1)
+            self.destination.deregister_request_handler(request_path)
+            self.destination.deregister_request_handler(Node.VARIANT_PATH_PREFIX+request_path)
+            self.compressible_files.pop(file, None)
+            self.content_index.forget(file)
+            RNS.log("Deregistered removed file "+request_path, RNS.LOG_DEBUG)
+
+        for file in added_files:
+            request_path = "/file"+file.replace(self.app.filespath, "", 1)
+            if os.path.splitext(file)[1].lower() in Node.INCOMPRESSIBLE_EXTENSIONS:
+                self.compressible_files[file] = False
+
+            self.register_file(request_path, file)
+            self.register_variant(request_path, self.serve_file_variant)
+
+        self.servedfiles = scanned_files
+
+        if len(added_files) > 0 or len(removed_files) > 0:
+            RNS.log("File registry updated, "+str(len(added_files))+" added, "+str(len(removed_files))+" removed", RNS.LOG_VERBOSE)
+
+        if self.app.file_listings:
+            self.register_listings(added_files, removed_files)
+
+    def register_listings(self, added_files, removed_files):
+        # Listings are only updated for directories that contained
+        # added or removed files, so large file archives are not
+        # rescanned when they are browsed.
+        if len(self.servedlistings) > 0 and len(added_files) == 0 and len(removed_files) == 0:
+            return
 
-        for file in self.servedfiles:
-            request_path = "/file"+file.replace(self.app.filespath, "")
+        added_directories, removed_directories = self.file_listings.update(added_files, removed_files)
+        if len(self.servedlistings) == 0:
+            added_directories.add("")
+
+        for directory in removed_directories:
+            self.destination.deregister_request_handler(FileListings.request_path(directory))
+            self.servedlistings.discard(directory)
+
+        for directory in added_directories:
             self.destination.register_request_handler(
-                request_path,
-                response_generator = self.serve_file,
-                allow = RNS.Destination.ALLOW_ALL,
-                auto_compress = 32_000_000)
+                FileListings.request_path(directory),
+                response_generator = self.serve_file_listing,
+                allow = RNS.Destination.ALLOW_ALL)
+            self.servedlistings.add(directory)
 
-    def scan_pages(self, base_path):
-        files = [file for file in os.listdir(base_path) if os.path.isfile(os.path.join(base_path, file)) and file[:1] != "."]
-        directories = [file for file in os.listdir(base_path) if os.path.isdir(os.path.join(base_path, file)) and file[:1] != "."]
+    def serve_file_listing(self, path, data, request_id, link_id, remote_identity, requested_at):
+        if not self.page_rate_limiter.admit(link_id, remote_identity):
+            RNS.log("Listing request "+RNS.prettyhexrep(request_id)+" for "+str(path)+" was rate limited", RNS.LOG_DEBUG)
+            return DEFAULT_RATE_LIMITED.encode("utf-8")
 
-        for file in files:
-            if not file.endswith(".allowed"):
-                self.servedpages.append(base_path+"/"+file)
+        RNS.log("Listing request "+RNS.prettyhexrep(request_id)+" for: "+str(path), RNS.LOG_VERBOSE)
+        try:
+            page_number = 1
+            if isinstance(data, dict) and "var_page" in data:
+                page_number = int(data["var_page"])
 
-        for directory in directories:
-            self.scan_pages(base_path+"/"+directory)
+            directory = path.replace(Node.LISTING_PATH_PREFIX, "", 1).strip("/")
+            started = time.time()
+            listing, cache_hit = self.file_listings.render(directory, page_number)
+            self.metrics.record(path, response_bytes=len(listing), read_time=time.time()-started, cache_hit=cache_hit)
+            return listing
 
-    def scan_files(self, base_path):
-        files = [file for file in os.listdir(base_path) if os.path.isfile(os.path.join(base_path, file)) and file[:1] != "."]
-        directories = [file for file in os.listdir(base_path) if os.path.isdir(os.path.join(base_path, file)) and file[:1] != "."]
+        except Exception as e:
+            RNS.log("Error occurred while handling request "+RNS.prettyhexrep(request_id)+" for: "+str(path), RNS.LOG_ERROR)
+            RNS.log("The contained exception was: "+str(e), RNS.LOG_ERROR)
+            return None
 
-        for file in files:
-            self.servedfiles.append(base_path+"/"+file)
+    def register_file(self, request_path, file_path):
+        if self.compressible_files.get(file_path, None) == False:
+            auto_compress = False
+        else:
+            auto_compress = Node.FILE_COMPRESSION_LIMIT
 
-        for directory in directories:
-            self.scan_files(base_path+"/"+directory)
+        self.destination.register_request_handler(
+            request_path,
+            response_generator = self.serve_file,
+            allow = RNS.Destination.ALLOW_ALL,
+            auto_compress = auto_compress)
 
-    def serve_page(self, path, data, request_id, link_id, remote_identity, requested_at):
-        RNS.log("Page request "+RNS.prettyhexrep(request_id)+" for: "+str(path), RNS.LOG_VERBOSE)
+    def register_variant(self, request_path, response_generator):
+        # Variants are served on a separate path, since RNS decides
+        # on compression per request handler. Responses on variant
+        # paths are compressed by the node itself when worthwhile,
+        # and declare their compression to the client.
+        self.destination.register_request_handler(
+            Node.VARIANT_PATH_PREFIX+request_path,
+            response_generator = response_generator,
+            allow = RNS.Destination.ALLOW_ALL,
+            auto_compress = False)
+
+    def check_compressibility(self, request_path, file_path):
+        # Files of unknown type are sampled on their first request,
+        # and re-registered without compression if it would not
+        # reduce their size meaningfully.
         try:
-            self.app.peer_settings["served_page_requests"] += 1
-            self.app.save_peer_settings()
-            
+            fh = open(file_path, "rb")
+            sample = fh.read(Node.COMPRESSION_SAMPLE_SIZE)
+            fh.close()
+
+            compressible = len(sample) == 0 or len(bz2.compress(sample))/len(sample) < Node.COMPRESSION_MIN_RATIO
+            self.compressible_files[file_path] = compressible
+            if not compressible:
+                RNS.log("Disabling compression for incompressible file "+str(file_path), RNS.LOG_DEBUG)
+                self.register_file(request_path, file_path)
+
         except Exception as e:
-            RNS.log("Could not increase served page request count", RNS.LOG_ERROR)
+            RNS.log("Could not determine compressibility of "+str(file_path)+": "+str(e), RNS.LOG_DEBUG)
 
-        file_path = path.replace("/page", self.app.pagespath, 1)
+    def scan_pages(self, base_path):
+        pages = set()
+        with os.scandir(base_path) as entries:
+            for entry in entries:
+                if entry.name[:1] != ".":
+                    if entry.is_file():
+                        if not entry.name.endswith(".allowed"):
+                            pages.add(base_path+"/"+entry.name)
 
-        allowed_path = file_path+".allowed"
-        request_allowed = False
+                    elif entry.is_dir():
+                        pages |= self.scan_pages(base_path+"/"+entry.name)
 
-        if os.path.isfile(allowed_path):
-            allowed_list = []
+        return pages
 
-            try:
-                if os.access(allowed_path, os.X_OK):
-                    allowed_result = subprocess.run([allowed_path], stdout=subprocess.PIPE)
-                    allowed_input = allowed_result.stdout
+    def scan_files(self, base_path):
+        files = set()
+        with os.scandir(base_path) as entries:
+            for entry in entries:
+                if entry.name[:1] != ".":
+                    if entry.is_file():
+                        files.add(base_path+"/"+entry.name)
 
-                else:
-                    fh = open(allowed_path, "rb")
-                    allowed_input = fh.read()
-                    fh.close()
+                    elif entry.is_dir():
+                        files |= self.scan_files(base_path+"/"+entry.name)
 
-                allowed_hash_strs = allowed_input.splitlines()
+        return files
 
-                for hash_str in allowed_hash_strs:
-                    if len(hash_str) == RNS.Identity.TRUNCATED_HASHLENGTH//8*2:
-                        try:
-                            allowed_hash = bytes.fromhex(hash_str.decode("utf-8"))
-                            allowed_list.append(allowed_hash)
+    def serve_page(self, path, data, request_id, link_id, remote_identity, requested_at):
+        if not self.page_rate_limiter.admit(link_id, remote_identity):
+            RNS.log("Page request "+RNS.prettyhexrep(request_id)+" for "+str(path)+" was rate limited", RNS.LOG_DEBUG)
+            return DEFAULT_RATE_LIMITED.encode("utf-8")
 
-                        except Exception as e:
-                            RNS.log("Could not decode RNS Identity hash from: "+str(hash_str), RNS.LOG_DEBUG)
-                            RNS.log("The contained exception was: "+str(e), RNS.LOG_DEBUG)
+        return self.page_response(path, data, request_id, link_id, remote_identity, requested_at)
 
-            except Exception as e:
-                RNS.log("Error while fetching list of allowed identities for request: "+str(e), RNS.LOG_ERROR)
+    def page_response(self, path, data, request_id, link_id, remote_identity, requested_at):
+        RNS.log("Page request "+RNS.prettyhexrep(request_id)+" for: "+str(path), RNS.LOG_VERBOSE)
+        try:
+            self.app.increment_peer_counter("served_page_requests")
+            
+        except Exception as e:
+            RNS.log("Could not increase served page request count", RNS.LOG_ERROR)
 
-            if hasattr(remote_identity, "hash") and remote_identity.hash in allowed_list:
-                request_allowed = True
-            else:
-                request_allowed = False
-                RNS.log("Denying request, remote identity was not in list of allowed identities", RNS.LOG_VERBOSE)
+        file_path = path.replace("/page", self.app.pagespath, 1)
 
-        else:
-            request_allowed = True
+        request_allowed = self.page_allowed(file_path, remote_identity)
 
         try:
             if request_allowed:
                 RNS.log("Serving page: "+file_path, RNS.LOG_VERBOSE)
-                if not RNS.vendor.platformutils.is_windows() and os.access(file_path, os.X_OK):
+                if self.dynamic_page(path, file_path):
                     env_map = {}
                     if "PATH" in os.environ:
                         env_map["PATH"] = os.environ["PATH"]
@@ -173,15 +327,86 @@ class Node:
                             if isinstance(e, str) and (e.startswith("field_") or e.startswith("var_")):
                                 env_map[e] = data[e]
 
-                    generated = subprocess.run([file_path], stdout=subprocess.PIPE, env=env_map)
-                    return generated.stdout
+                    if self.app.page_output_cache_per_identity and remote_identity != None:
+                        cache_identity = remote_identity.hash
+                    else:
+                        cache_identity = None
+
+                    cache_key = ResponseCache.key(path, env_map, cache_identity)
+                    cached = self.response_cache.get(cache_key, file_path)
+                    if cached != None:
+                        RNS.log("Serving cached output of page: "+file_path, RNS.LOG_VERBOSE)
+                        self.metrics.record(path, response_bytes=len(cached), cache_hit=True)
+                        return cached
+
+                    # Concurrent requests with identical request data
+                    # share a single execution of the page. Output is
+                    # only shared between requestors for pages whose
+                    # last output opted into caching, and otherwise
+                    # only between requests on the same link from the
+                    # same identity. Pages that have not run yet, or
+                    # declared themselves private, are never shared.
+                    sharing = self.response_cache.sharing(path)
+                    if sharing == ResponseCache.SHARE_ALL:
+                        flight_key = cache_key
+                    elif sharing == ResponseCache.SHARE_REQUESTOR:
+                        flight_key = cache_key+(link_id, remote_identity.hash if remote_identity != None else None)
+                    else:
+                        flight_key = None
+
+                    if flight_key != None:
+                        flight, shared = self.request_coalescer.join(flight_key, self.app.page_execution_timeout)
+                    else:
+                        flight, shared = None, None
+
+                    if shared != None:
+                        RNS.log("Serving output of concurrent execution of page: "+file_path, RNS.LOG_VERBOSE)
+                        self.metrics.record(path, response_bytes=len(shared), coalesced=True)
+                        return shared
+
+                    response = None
+                    try:
+                        if not self.page_scheduler.acquire(path):
+                            RNS.log("Page execution queue is full, rejecting request for "+str(path), RNS.LOG_DEBUG)
+                            return DEFAULT_BUSY.encode("utf-8")
+
+                        try:
+                            started = time.time()
+                            response = self.execute_page(path, file_path, env_map, data, link_id, remote_identity)
+                            self.metrics.record(path, response_bytes=len(response), execution_time=time.time()-started)
+                            self.response_cache.learn(path, response)
+                            self.response_cache.put(cache_key, file_path, response)
+                            return response
+
+                        except PythonHandlerBusy as e:
+                            RNS.log("Rejecting request for "+str(path)+", "+str(e), RNS.LOG_WARNING)
+                            return DEFAULT_BUSY.encode("utf-8")
+
+                        except subprocess.TimeoutExpired:
+                            self.page_scheduler.timeouts += 1
+                            RNS.log("Execution of "+str(file_path)+" timed out, the page program was stopped", RNS.LOG_WARNING)
+                            return DEFAULT_TIMEOUT.encode("utf-8")
+
+                        finally:
+                            self.page_scheduler.release(path)
+
+                    finally:
+                        if flight != None:
+                            self.request_coalescer.complete(flight_key, flight, response)
                 else:
-                    fh = open(file_path, "rb")
-                    response_data = fh.read()
-                    fh.close()
-                    return response_data
+                    not_modified = self.conditional_response(file_path, data)
+                    if not_modified != None:
+                        RNS.log("Page "+file_path+" not modified since cached by requestor", RNS.LOG_VERBOSE)
+                        self.metrics.record(path, cache_hit=True)
+                        return not_modified
+
+                    started = time.time()
+                    page_data, cache_hit = self.page_cache.lookup(file_path)
+                    self.metrics.record(path, response_bytes=len(page_data), read_time=time.time()-started, cache_hit=cache_hit)
+                    return page_data
             else:
                 RNS.log("Request denied", RNS.LOG_VERBOSE)
+                self.metrics.record(path, denied=True)
                 return DEFAULT_NOTALLOWED.encode("utf-8")
 
         except Exception as e:
@@ -189,27 +414,294 @@ class Node:
             RNS.log("The contained exception was: "+str(e), RNS.LOG_ERROR)
             return None
 
-    # TODO: Improve file handling, this will be slow for large files
-    def serve_file(self, path, data, request_id, remote_identity, requested_at):
-        RNS.log("File request "+RNS.prettyhexrep(request_id)+" for: "+str(path), RNS.LOG_VERBOSE)
+    def conditional_response(self, file_path, data):
+        # Requestors holding an earlier copy of a static page or
+        # file can include its hash, and will receive only a short
+        # not modified response if the content is still the same.
+        if isinstance(data, dict) and data.get("cached_hash", None) != None:
+            content_hash = self.content_index.get(file_path)
+            if content_hash == data["cached_hash"]:
+                return [Node.NOT_MODIFIED, content_hash]
+
+        return None
+
+    def dynamic_page(self, path, file_path):
+        if path in self.app.python_handlers:
+            return True
+        else:
+            return not RNS.vendor.platformutils.is_windows() and os.access(file_path, os.X_OK)
+
+    def page_allowed(self, file_path, remote_identity):
+        # Access is denied if the access list can't be read, for
+        # example when the page was removed after it was scanned
         try:
-            self.app.peer_settings["served_file_requests"] += 1
-            self.app.save_peer_settings()
-            
+            allowed_list = self.acl_registry.get(file_path+".allowed")
+        except Exception as e:
+            RNS.log("Denying request, could not read access list for "+str(file_path)+". The contained exception was: "+str(e), RNS.LOG_ERROR)
+            return False
+
+        if allowed_list != None:
+            if hasattr(remote_identity, "hash") and remote_identity.hash in allowed_list:
+                return True
+            else:
+                RNS.log("Denying request, remote identity was not in list of allowed identities", RNS.LOG_VERBOSE)
+                return False
+
+        else:
+            return True
+
+    def serve_page_variant(self, path, data, request_id, link_id, remote_identity, requested_at):
+        page_path = path.replace(Node.VARIANT_PATH_PREFIX, "", 1)
+        if not self.page_rate_limiter.admit(link_id, remote_identity):
+            RNS.log("Page request "+RNS.prettyhexrep(request_id)+" for "+str(page_path)+" was rate limited", RNS.LOG_DEBUG)
+            return self.compress_response(DEFAULT_RATE_LIMITED.encode("utf-8"))
+
+        file_path = page_path.replace("/page", self.app.pagespath, 1)
+
+        if not os.path.isfile(file_path):
+            if page_path == "/page/index.mu":
+                return self.compress_response(self.serve_default_index(page_path, data, request_id, remote_identity, requested_at))
+            else:
+                return None
+
+        if not self.dynamic_page(page_path, file_path) and self.page_allowed(file_path, remote_identity):
+            try:
+                not_modified = self.conditional_response(file_path, data)
+                if not_modified != None:
+                    self.app.increment_peer_counter("served_page_requests")
+                    RNS.log("Page "+file_path+" not modified since cached by requestor", RNS.LOG_VERBOSE)
+                    self.metrics.record(page_path, cache_hit=True)
+                    return not_modified
+
+            except Exception as e:
+                RNS.log("Could not check modification state of "+str(file_path)+": "+str(e), RNS.LOG_DEBUG)
+
+            variant = self.variant_store.get(file_path)
+            if variant != None:
+                try:
+                    self.app.increment_peer_counter("served_page_requests")
+                    RNS.log("Serving compressed variant of page: "+file_path, RNS.LOG_VERBOSE)
+                    started = time.time()
+                    fh = open(variant, "rb")
+                    variant_data = fh.read()
+                    fh.close()
+                    self.metrics.record(page_path, response_bytes=len(variant_data), read_time=time.time()-started, cache_hit=True)
+                    return [Node.VARIANT_COMPRESSION, variant_data]
+
+                except Exception as e:
+                    RNS.log("Could not read compressed variant of "+str(file_path)+": "+str(e), RNS.LOG_DEBUG)
+
+        return self.compress_response(self.page_response(page_path, data, request_id, link_id, remote_identity, requested_at))
+
+    def compress_response(self, response):
+        if response == None:
+            return None
+
+        if isinstance(response, list):
+            return response
+
+        compressed = bz2.compress(response)
+        if len(compressed) < len(response):
+            return [Node.VARIANT_COMPRESSION, compressed]
+        else:
+            return [None, response]
+
+    def execute_page(self, path, file_path, env_map, data, link_id, remote_identity):
+        timeout = self.app.page_execution_timeout
+        if timeout == 0:
+            timeout = None
+
+        if path in self.app.python_handlers:
+            return self.python_handlers.handle(path, file_path, data, remote_identity, link_id, timeout)
+
+        if path in self.app.persistent_pages:
+            try:
+                return self.handler_pool(file_path).handle(env_map, timeout)
+
+            except subprocess.TimeoutExpired as e:
+                raise e
+
+            except Exception as e:
+                RNS.log("Persistent handler for "+str(path)+" failed, falling back to executing page directly", RNS.LOG_WARNING)
+                RNS.log("The contained exception was: "+str(e), RNS.LOG_WARNING)
+
+        generated = subprocess.run([file_path], stdout=subprocess.PIPE, env=env_map, timeout=timeout)
+        return generated.stdout
+
+    def handler_pool(self, file_path):
+        with self.handler_pools_lock:
+            if not file_path in self.handler_pools:
+                self.handler_pools[file_path] = HandlerPool(file_path, self.app.handler_pool_size)
+
+            return self.handler_pools[file_path]
+
+    def reap_handlers(self):
+        with self.handler_pools_lock:
+            for file_path in list(self.handler_pools.keys()):
+                pool = self.handler_pools[file_path]
+                pool.reap(self.app.handler_idle_timeout)
+                if not os.path.isfile(file_path):
+                    pool.shutdown()
+                    self.handler_pools.pop(file_path)
+
+    def serve_file(self, path, data, request_id, link_id, remote_identity, requested_at):
+        # Ranges continuing where the previous range of the same file
+        # on the same link ended belong to a download that was already
+        # admitted and counted when its first range was requested.
+        continuation = self.range_continuation(link_id, path, data)
+        if not continuation and not self.file_rate_limiter.admit(link_id, remote_identity):
+            RNS.log("File request "+RNS.prettyhexrep(request_id)+" for "+str(path)+" was rate limited", RNS.LOG_DEBUG)
+            return self.rate_limited_response()
+
+        response = self.file_response(path, data, request_id, remote_identity, requested_at, continuation)
+        self.track_range(link_id, path, response)
+        return response
+
+    def range_continuation(self, link_id, path, data):
+        if link_id == None or not isinstance(data, dict) or not "range" in data:
+            return False
+
+        try:
+            offset = int(data["range"][0])
         except Exception as e:
-            RNS.log("Could not increase served file request count", RNS.LOG_ERROR)
+            return False
+
+        with self.range_lock:
+            return offset > 0 and self.range_offsets.get((link_id, path), None) == offset
+
+    def track_range(self, link_id, path, response):
+        if link_id == None:
+            return
+
+        key = (link_id, path)
+        with self.range_lock:
+            self.range_offsets.pop(key, None)
+            if isinstance(response, list) and len(response) > 2 and isinstance(response[2], dict):
+                file_range = response[2]
+                range_end = file_range["offset"]+file_range["length"]
+                if file_range["length"] > 0 and range_end < file_range["size"]:
+                    self.range_offsets[key] = range_end
+                    while len(self.range_offsets) > Node.MAX_TRACKED_RANGES:
+                        self.range_offsets.popitem(last=False)
+
+    def rate_limited_response(self):
+        # Rate limited file requests are answered with a map instead
+        # of a list, so older clients reject the response instead of
+        # saving it as a file, while newer clients can read when to
+        # retry the request.
+        return {Node.RATE_LIMITED: self.file_rate_limiter.retry_after()}
+
+    def file_response(self, path, data, request_id, remote_identity, requested_at, continuation=False):
+        RNS.log("File request "+RNS.prettyhexrep(request_id)+" for: "+str(path), RNS.LOG_VERBOSE)
+        if not continuation:
+            try:
+                self.app.increment_peer_counter("served_file_requests")
+                
+            except Exception as e:
+                RNS.log("Could not increase served file request count", RNS.LOG_ERROR)
 
         file_path = path.replace("/file", self.app.filespath, 1)
         file_name = path.replace("/file/", "", 1)
         try:
             RNS.log("Serving file: "+file_path, RNS.LOG_VERBOSE)
-            return [open(file_path, "rb"), {"name": file_name.encode("utf-8")}]
+            if not file_path in self.compressible_files:
+                self.check_compressibility(path, file_path)
+
+            not_modified = self.conditional_response(file_path, data)
+            if not_modified != None:
+                RNS.log("File "+file_path+" not modified since cached by requestor", RNS.LOG_VERBOSE)
+                self.metrics.record(path, cache_hit=True)
+                return not_modified
+
+            elif isinstance(data, dict) and "range" in data:
+                started = time.time()
+                response = self.serve_file_range(file_path, file_name, data["range"])
+                self.metrics.record(path, response_bytes=len(response[1]), read_time=time.time()-started)
+                return response
+
+            else:
+                # The file is read by the resource as it is sent,
+                # so no read time is recorded for streamed files
+                fh = open(file_path, "rb")
+                self.metrics.record(path, response_bytes=os.fstat(fh.fileno()).st_size)
+                return [fh, {"name": file_name.encode("utf-8"), "variants": [Node.VARIANT_COMPRESSION]}]
 
         except Exception as e:
             RNS.log("Error occurred while handling request "+RNS.prettyhexrep(request_id)+" for: "+str(path), RNS.LOG_ERROR)
             RNS.log("The contained exception was: "+str(e), RNS.LOG_ERROR)
             return None
 
+    def serve_file_variant(self, path, data, request_id, link_id, remote_identity, requested_at):
+        # Variants are only sent when one has already been built, and
+        # the file is small enough to be sent in a single transfer no
+        # larger than a range. Otherwise the requestor is told to use
+        # the plain file path, where RNS compresses each range, since
+        # this path is registered without automatic compression.
+        file_request_path = path.replace(Node.VARIANT_PATH_PREFIX, "", 1)
+        file_path = file_request_path.replace("/file", self.app.filespath, 1)
+        file_name = file_request_path.replace("/file/", "", 1)
+
+        try:
+            if not (isinstance(data, dict) and "range" in data) and self.compressible_files.get(file_path, None) != False and os.path.getsize(file_path) <= Node.MAX_RANGE_LENGTH:
+                not_modified = self.conditional_response(file_path, data)
+                if not_modified != None:
+                    if not self.file_rate_limiter.admit(link_id, remote_identity):
+                        return self.rate_limited_response()
+                    return self.file_response(file_request_path, data, request_id, remote_identity, requested_at)
+
+                # If no variant is available yet, it is queued for
+                # building in the background
+                variant = self.variant_store.get(file_path)
+                if variant != None:
+                    if not self.file_rate_limiter.admit(link_id, remote_identity):
+                        RNS.log("File request "+RNS.prettyhexrep(request_id)+" for "+str(file_request_path)+" was rate limited", RNS.LOG_DEBUG)
+                        return self.rate_limited_response()
+
+                    self.app.increment_peer_counter("served_file_requests")
+                    RNS.log("Serving compressed variant of file: "+file_path, RNS.LOG_VERBOSE)
+                    fh = open(variant, "rb")
+                    self.metrics.record(file_request_path, response_bytes=os.fstat(fh.fileno()).st_size, cache_hit=True)
+                    return [fh, {"name": file_name.encode("utf-8"), "compression": Node.VARIANT_COMPRESSION}]
+
+        except Exception as e:
+            RNS.log("Could not serve compressed variant of "+str(file_path)+": "+str(e), RNS.LOG_DEBUG)
+
+        return [Node.PLAIN_PATH, file_request_path]
+
+    def serve_file_range(self, file_path, file_name, requested_range):
+        # Range requests carry an offset and an optional length, and
+        # are answered with at most MAX_RANGE_LENGTH bytes, which lets
+        # clients resume interrupted downloads in bounded chunks. The
+        # range reaching the end of the file includes its hash, so
+        # clients can verify the assembled download.
+        file_size = os.path.getsize(file_path)
+        offset = int(requested_range[0])
+        if len(requested_range) > 1 and requested_range[1] != None:
+            length = int(requested_range[1])
+        else:
+            length = file_size-offset
+
+        if offset < 0 or offset > file_size or length < 0:
+            raise ValueError("Invalid range "+str(requested_range)+" requested for file of size "+str(file_size))
+
+        length = min(length, file_size-offset, Node.MAX_RANGE_LENGTH)
+        fh = open(file_path, "rb")
+        fh.seek(offset)
+        range_data = fh.read(length)
+        fh.close()
+
+        file_range = {"offset": offset, "length": len(range_data), "size": file_size}
+        if offset+len(range_data) == file_size:
+            file_range["hash"] = self.content_index.get(file_path)
+
+        return [file_name, range_data, file_range]
+
+    def serve_variant_support(self, path, data, request_id, link_id, remote_identity, requested_at):
+        if self.variant_store.max_size > 0:
+            return [Node.VARIANT_COMPRESSION]
+        else:
+            return []
+
     def serve_default_index(self, path, data, request_id, remote_identity, requested_at):
         RNS.log("Serving default index for request "+RNS.prettyhexrep(request_id)+" for: "+str(path), RNS.LOG_VERBOSE)
         return DEFAULT_INDEX.encode("utf-8")
@@ -238,13 +730,54 @@ class Node:
                     self.register_files()
                     self.last_file_refresh = time.time()
 
+            if len(self.handler_pools) > 0:
+                self.reap_handlers()
+
+            if now > self.last_stats_log + Node.STATS_LOG_INTERVAL:
+                self.log_stats()
+                self.last_stats_log = time.time()
+
+            if self.app.metrics_snapshot_interval > 0:
+                if now > self.last_metrics_snapshot + self.app.metrics_snapshot_interval*60:
+                    self.write_metrics_snapshot()
+                    self.last_metrics_snapshot = time.time()
+
+            if self.content_index.dirty:
+                self.save_content_index()
+
             time.sleep(self.job_interval)
 
+    def save_content_index(self):
+        try:
+            self.content_index.save()
+
+        except Exception as e:
+            RNS.log("Could not save content index to "+str(self.app.contentindexpath)+": "+str(e), RNS.LOG_ERROR)
+
+    def write_metrics_snapshot(self):
+        try:
+            self.metrics.write_snapshot(self.app.metricspath)
+
+        except Exception as e:
+            RNS.log("Could not write node metrics snapshot to "+str(self.app.metricspath)+": "+str(e), RNS.LOG_ERROR)
+
+    def log_stats(self):
+        # Summaries are logged periodically, so operators of nodes
+        # running in daemon mode can see when clients are throttled
+        for limiter, kind in [(self.page_rate_limiter, "page"), (self.file_rate_limiter, "file")]:
+            limited = limiter.limited-limiter.logged_limited
+            if limited > 0:
+                limiter.logged_limited = limiter.limited
+                top_client = limiter.top_client()
+                top_str = ""
+                if top_client != None:
+                    top_str = ", most by "+RateLimiter.client_str(top_client[0])+" ("+str(top_client[2])+" of "+str(top_client[1])+" requests)"
+                RNS.log("Rate limited "+str(limited)+" "+kind+" requests in the last "+RNS.prettytime(Node.STATS_LOG_INTERVAL)+top_str, RNS.LOG_NOTICE)
+
     def peer_connected(self, link):
         RNS.log("Peer connected to "+str(self.destination), RNS.LOG_VERBOSE)
         try:
-            self.app.peer_settings["node_connects"] += 1
-            self.app.save_peer_settings()
+            self.app.increment_peer_counter("node_connects")
 
         except Exception as e:
             RNS.log("Could not increase node connection count", RNS.LOG_ERROR)
@@ -255,6 +788,1442 @@ class Node:
         RNS.log("Peer disconnected from "+str(self.destination), RNS.LOG_VERBOSE)
         pass
 
+class FileListings:
+    CACHE_TIME = 300
+
+    def __init__(self, files_path, page_size):
+        self.files_path = files_path
+        self.page_size = page_size
+        self.directories = {"": (set(), set())}
+        self.listings = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def request_path(directory):
+        if directory == "":
+            return Node.LISTING_PATH_PREFIX
+        else:
+            return Node.LISTING_PATH_PREFIX+"/"+directory
+
+    def update(self, added_files, removed_files):
+        # The directory tree is updated in place for added and
+        # removed files only. Cached listings are dropped for the
+        # directories that changed, and all directories above them.
+        # Returns the directories that appeared and disappeared.
+        added_directories = set()
+        removed_directories = set()
+
+        with self.lock:
+            for file in added_files:
+                parts = file[len(self.files_path)+1:].split("/")
+                for i in range(len(parts)-1):
+                    parent = "/".join(parts[:i])
+                    directory = "/".join(parts[:i+1])
+                    if not directory in self.directories:
+                        self.directories[directory] = (set(), set())
+                        added_directories.add(directory)
+                        removed_directories.discard(directory)
+                    self.directories[parent][0].add(parts[i])
+                self.directories["/".join(parts[:-1])][1].add(parts[-1])
+
+            for file in removed_files:
+                parts = file[len(self.files_path)+1:].split("/")
+                directory = "/".join(parts[:-1])
+                if directory in self.directories:
+                    self.directories[directory][1].discard(parts[-1])
+
+                # Prune directories left without any entries
+                while directory != "" and directory in self.directories:
+                    subdirectories, files = self.directories[directory]
+                    if len(subdirectories) > 0 or len(files) > 0:
+                        break
+                    self.directories.pop(directory)
+                    self.listings.pop(directory, None)
+                    removed_directories.add(directory)
+                    added_directories.discard(directory)
+                    parent, _, name = directory.rpartition("/")
+                    self.directories[parent][0].discard(name)
+                    directory = parent
+
+            for file in added_files | removed_files:
+                parts = file[len(self.files_path)+1:].split("/")
+                for i in range(len(parts)):
+                    self.listings.pop("/".join(parts[:i]), None)
+
+        return added_directories, removed_directories
+
+    def entries(self, directory):
+        # Returns sorted directory entries, with size and
+        # modification time of files, from cache if possible
+        with self.lock:
+            if directory in self.listings:
+                return self.listings[directory], True
+            elif not directory in self.directories:
+                return None, False
+            subdirectories, files = self.directories[directory]
+
+        entries = []
+        for name in sorted(subdirectories, key=str.lower):
+            entries.append((name, None, None))
+
+        for name in sorted(files, key=str.lower):
+            try:
+                file_stat = os.stat(self.files_path+"/"+directory+"/"+name if directory != "" else self.files_path+"/"+name)
+                entries.append((name, file_stat.st_size, file_stat.st_mtime))
+            except Exception as e:
+                RNS.log("Could not read file information for listing of "+str(name)+": "+str(e), RNS.LOG_DEBUG)
+
+        with self.lock:
+            self.listings[directory] = entries
+
+        return entries, False
+
+    def render(self, directory, page_number):
+        entries, cache_hit = self.entries(directory)
+        if entries == None:
+            raise ValueError("No listing exists for directory "+str(directory))
+
+        pages = max(1, (len(entries)+self.page_size-1)//self.page_size)
+        page_number = min(max(1, page_number), pages)
+        request_path = FileListings.request_path(directory)
+
+        markup = "#!c="+str(FileListings.CACHE_TIME)+"\n"
+        markup += ">Files in /"+FileListings.escape(directory)+"\n\n"
+        if directory != "":
+            parent = directory.rpartition("/")[0]
+            markup += "`[../`:"+FileListings.request_path(parent)+"]\n"
+
+        for name, size, mtime in entries[(page_number-1)*self.page_size:page_number*self.page_size]:
+            if size == None:
+                link_path = request_path+"/"+name
+                label = name+"/"
+                details = ""
+            else:
+                link_path = "/file/"+directory+"/"+name if directory != "" else "/file/"+name
+                label = name
+                details = "  "+RNS.prettysize(size)+"  "+time.strftime("%Y-%m-%d %H:%M", time.localtime(mtime))
+
+            if FileListings.linkable(name):
+                markup += "`_`["+FileListings.escape(label)+"`:"+link_path+"]`_"+details+"\n"
+            else:
+                markup += "\\"+FileListings.escape(label)+details+"\n"
+
+        if pages > 1:
+            markup += "\n-\nPage "+str(page_number)+" of "+str(pages)
+            if page_number > 1:
+                markup += "  `[Previous`:"+request_path+"`page="+str(page_number-1)+"]"
+            if page_number < pages:
+                markup += "  `[Next`:"+request_path+"`page="+str(page_number+1)+"]"
+            markup += "\n"
+
+        return markup.encode("utf-8"), cache_hit
+
+    @staticmethod
+    def escape(text):
+        return text.replace("\\", "\\\\").replace("`", "\\`")
+
+    @staticmethod
+    def linkable(name):
+        return not ("`" in name or "]" in name or "|" in name)
+
+class LatencyHistogram:
+    # Bucket upper bounds in seconds. Durations above the last
+    # bound are counted in an additional overflow bucket.
+    BOUNDS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30]
+
+    def __init__(self):
+        self.counts = [0]*(len(LatencyHistogram.BOUNDS)+1)
+        self.count = 0
+        self.total = 0
+
+    def add(self, duration):
+        self.counts[bisect.bisect_left(LatencyHistogram.BOUNDS, duration)] += 1
+        self.count += 1
+        self.total += duration
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        else:
+            return self.total/self.count
+
+    def percentile(self, fraction):
+        # Returns the upper bound of the bucket containing the
+        # requested percentile, or None if nothing was recorded
+        if self.count == 0:
+            return None
+
+        target = max(1, fraction*self.count)
+        cumulative = 0
+        for i in range(len(self.counts)):
+            cumulative += self.counts[i]
+            if cumulative >= target:
+                if i < len(LatencyHistogram.BOUNDS):
+                    return LatencyHistogram.BOUNDS[i]
+                else:
+                    return float("inf")
+
+    def as_dict(self):
+        return {"bounds": LatencyHistogram.BOUNDS, "counts": list(self.counts), "count": self.count, "total": self.total}
+
+class PathMetrics:
+    def __init__(self, requests=0):
+        self.requests = requests
+        self.response_bytes = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.denied = 0
+        self.execution = LatencyHistogram()
+        self.read = LatencyHistogram()
+
+    def add(self, response_bytes, execution_time, read_time, cache_hit, coalesced, denied):
+        self.requests += 1
+        self.response_bytes += response_bytes
+        if cache_hit:
+            self.cache_hits += 1
+        if coalesced:
+            self.coalesced += 1
+        if denied:
+            self.denied += 1
+        if execution_time != None:
+            self.execution.add(execution_time)
+        if read_time != None:
+            self.read.add(read_time)
+
+    def cache_hit_ratio(self):
+        if self.requests == 0:
+            return None
+        else:
+            return self.cache_hits/self.requests
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "response_bytes": self.response_bytes,
+            "cache_hits": self.cache_hits,
+            "coalesced": self.coalesced,
+            "denied": self.denied,
+            "execution_time": self.execution.as_dict(),
+            "read_time": self.read.as_dict(),
+        }
+
+class NodeMetrics:
+    MAX_PATHS = 64
+
+    def __init__(self):
+        # Per-path metrics are kept for at most MAX_PATHS paths. When
+        # a new path is seen and the table is full, the least
+        # requested path is replaced, and the new path inherits its
+        # request count. This keeps the most requested paths in the
+        # table, while memory use stays bounded.
+        self.totals = PathMetrics()
+        self.paths = {}
+        self.since = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, path, response_bytes=0, execution_time=None, read_time=None, cache_hit=False, coalesced=False, denied=False):
+        with self.lock:
+            if not path in self.paths:
+                if len(self.paths) >= NodeMetrics.MAX_PATHS:
+                    evicted = min(self.paths, key=lambda p: self.paths[p].requests)
+                    self.paths[path] = PathMetrics(self.paths.pop(evicted).requests)
+                else:
+                    self.paths[path] = PathMetrics()
+
+            for metrics in [self.paths[path], self.totals]:
+                metrics.add(response_bytes, execution_time, read_time, cache_hit, coalesced, denied)
+
+    def top_paths(self, count):
+        with self.lock:
+            top = sorted(self.paths, key=lambda p: self.paths[p].requests, reverse=True)[:count]
+            return [(path, self.paths[path]) for path in top]
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "since": self.since,
+                "time": time.time(),
+                "totals": self.totals.as_dict(),
+                "paths": {path: self.paths[path].as_dict() for path in self.paths},
+            }
+
+    def write_snapshot(self, snapshot_path):
+        tmp_path = snapshot_path+".tmp"
+        file = open(tmp_path, "w")
+        json.dump(self.snapshot(), file)
+        file.close()
+        os.replace(tmp_path, snapshot_path)
+
+    def reset_stats(self):
+        with self.lock:
+            self.totals = PathMetrics()
+            self.paths = {}
+            self.since = time.time()
+
+class PageCache:
+    def __init__(self, max_size):
+        # Maximum cache size is specified in megabytes
+        self.max_size = int(max_size*1000*1000)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, file_path):
+        # Returns the page data, and whether it was served from cache
+        stat = os.stat(file_path)
+        with self.lock:
+            if file_path in self.entries:
+                mtime, size, data = self.entries[file_path]
+                if mtime == stat.st_mtime_ns and size == stat.st_size:
+                    self.entries.move_to_end(file_path)
+                    self.hits += 1
+                    return data, True
+                else:
+                    self.__remove(file_path)
+
+            self.misses += 1
+
+        fh = open(file_path, "rb")
+        data = fh.read()
+        fh.close()
+
+        if len(data) == stat.st_size and len(data) <= self.max_size:
+            with self.lock:
+                if file_path in self.entries:
+                    self.__remove(file_path)
+
+                self.entries[file_path] = (stat.st_mtime_ns, stat.st_size, data)
+                self.size += len(data)
+                while self.size > self.max_size:
+                    self.__remove(next(iter(self.entries)))
+
+        return data, False
+
+    def invalidate(self, file_path):
+        with self.lock:
+            if file_path in self.entries:
+                self.__remove(file_path)
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def hit_ratio(self):
+        requests = self.hits+self.misses
+        if requests == 0:
+            return None
+        else:
+            return self.hits/requests
+
+    def __remove(self, file_path):
+        entry = self.entries.pop(file_path)
+        self.size -= len(entry[2])
+
+class RateLimiter:
+    MAX_CLIENTS = 4096
+
+    def __init__(self, client_rate, burst, total_rate):
+        # Rates are specified in requests per minute, and a rate
+        # of 0 disables the corresponding limit. Every client has
+        # a bucket per link, and identified clients additionally
+        # have one per identity, so a client can not escape the
+        # limit by opening more links.
+        self.client_rate = client_rate/60
+        self.total_rate = total_rate/60
+        self.burst = max(1, burst)
+        self.admitted = 0
+        self.limited = 0
+        self.logged_limited = 0
+        self.buckets = OrderedDict()
+        self.total_bucket = [self.burst, time.time()]
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def client_str(client_key):
+        kind, key_hash = client_key
+        return kind+" "+RNS.prettyhexrep(key_hash)
+
+    def enabled(self):
+        return self.client_rate > 0 or self.total_rate > 0
+
+    def admit(self, link_id, remote_identity):
+        if not self.enabled():
+            return True
+
+        now = time.time()
+        with self.lock:
+            buckets = []
+            if self.client_rate > 0:
+                if link_id != None:
+                    buckets.append(self.__client_bucket(("link", link_id), now))
+                if remote_identity != None:
+                    buckets.append(self.__client_bucket(("identity", remote_identity.hash), now))
+
+            admitted = True
+            for bucket in buckets:
+                bucket[2] += 1
+                if bucket[0] < 1:
+                    admitted = False
+
+            if admitted and self.total_rate > 0:
+                self.__refill(self.total_bucket, self.total_rate, now)
+                if self.total_bucket[0] < 1:
+                    admitted = False
+                else:
+                    self.total_bucket[0] -= 1
+
+            if admitted:
+                for bucket in buckets:
+                    bucket[0] -= 1
+                self.admitted += 1
+            else:
+                for bucket in buckets:
+                    bucket[3] += 1
+                self.limited += 1
+
+            return admitted
+
+    def retry_after(self):
+        # Seconds until a single token is available again
+        rates = [r for r in [self.client_rate, self.total_rate] if r > 0]
+        if len(rates) == 0:
+            return 0
+        else:
+            return round(1/min(rates), 1)
+
+    def limited_clients(self):
+        with self.lock:
+            return len([b for b in self.buckets.values() if b[3] > 0])
+
+    def top_client(self):
+        # Returns the client key and request count of the client
+        # that has been rate limited the most
+        with self.lock:
+            top = None
+            for client_key in self.buckets:
+                bucket = self.buckets[client_key]
+                if bucket[3] > 0 and (top == None or bucket[3] > self.buckets[top][3]):
+                    top = client_key
+
+            if top == None:
+                return None
+            else:
+                return (top, self.buckets[top][2], self.buckets[top][3])
+
+    def reset_stats(self):
+        with self.lock:
+            self.admitted = 0
+            self.limited = 0
+            self.logged_limited = 0
+            for bucket in self.buckets.values():
+                bucket[2] = 0
+                bucket[3] = 0
+
+    def __client_bucket(self, client_key, now):
+        # Buckets hold available tokens, the time of the last
+        # refill, and request and rate limited counters.
+        if client_key in self.buckets:
+            bucket = self.buckets[client_key]
+            self.buckets.move_to_end(client_key)
+            self.__refill(bucket, self.client_rate, now)
+        else:
+            bucket = [self.burst, now, 0, 0]
+            self.buckets[client_key] = bucket
+            while len(self.buckets) > RateLimiter.MAX_CLIENTS:
+                self.buckets.popitem(last=False)
+
+        return bucket
+
+    def __refill(self, bucket, rate, now):
+        bucket[0] = min(self.burst, bucket[0]+(now-bucket[1])*rate)
+        bucket[1] = now
+
+class RequestCoalescer:
+    def __init__(self):
+        self.saved = 0
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def join(self, key, timeout=None):
+        # If no request for the key is in flight, the caller becomes
+        # the leader, and must generate the response and hand it to
+        # complete(). Otherwise, the caller waits for the leader and
+        # shares its response. If the leader fails or the wait times
+        # out, None is returned and the caller generates it alone.
+        with self.lock:
+            if not key in self.flights:
+                flight = RequestFlight()
+                self.flights[key] = flight
+                return flight, None
+
+            flight = self.flights[key]
+
+        if timeout == 0:
+            timeout = None
+
+        if flight.event.wait(timeout) and flight.response != None:
+            with self.lock:
+                self.saved += 1
+            return None, flight.response
+        else:
+            return None, None
+
+    def complete(self, key, flight, response):
+        with self.lock:
+            if self.flights.get(key, None) == flight:
+                self.flights.pop(key)
+
+        flight.response = response
+        flight.event.set()
+
+    def reset_stats(self):
+        self.saved = 0
+
+class RequestFlight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+
+class ResponseCache:
+    CACHE_HEADER   = b"#!c="
+    PRIVATE_HEADER = b"#!private"
+
+    SHARE_NONE      = 0x00
+    SHARE_REQUESTOR = 0x01
+    SHARE_ALL       = 0x02
+
+    def __init__(self, max_size):
+        # Maximum cache size is specified in megabytes
+        self.max_size = int(max_size*1000*1000)
+        self.page_sharing = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(path, env_map, identity_hash=None):
+        # Only request variables and the optional identity are part
+        # of the key, since they are all a page program can vary its
+        # output on, apart from the link ID.
+        request_vars = []
+        for e in sorted(env_map):
+            if e.startswith("field_") or e.startswith("var_"):
+                request_vars.append((e, str(env_map[e])))
+
+        return (path, tuple(request_vars), identity_hash)
+
+    @staticmethod
+    def cache_time(response):
+        # Page output declares its cache lifetime in the same
+        # header that browsers use, for example "#!c=60"
+        if isinstance(response, bytes) and response.startswith(ResponseCache.CACHE_HEADER):
+            endpos = response.find(b"\n")
+            if endpos == -1:
+                endpos = len(response)
+            try:
+                return int(response[len(ResponseCache.CACHE_HEADER):endpos])
+            except ValueError:
+                return 0
+
+        return 0
+
+    @staticmethod
+    def is_private(response):
+        # Private output is marked by a "#!private" line among
+        # the header lines at the start of the output
+        if isinstance(response, bytes):
+            for line in response.split(b"\n", 8)[:8]:
+                if not line.startswith(b"#!"):
+                    break
+                if line.strip() == ResponseCache.PRIVATE_HEADER:
+                    return True
+
+        return False
+
+    def learn(self, path, response):
+        if ResponseCache.is_private(response):
+            self.page_sharing[path] = ResponseCache.SHARE_NONE
+        elif ResponseCache.cache_time(response) > 0:
+            self.page_sharing[path] = ResponseCache.SHARE_ALL
+        else:
+            self.page_sharing[path] = ResponseCache.SHARE_REQUESTOR
+
+    def sharing(self, path):
+        return self.page_sharing.get(path, ResponseCache.SHARE_NONE)
+
+    def get(self, key, file_path):
+        if self.max_size == 0:
+            return None
+
+        mtime = os.stat(file_path).st_mtime_ns
+        with self.lock:
+            cached = self.__get(key, mtime)
+            if cached != None:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+            return cached
+
+    def put(self, key, file_path, response):
+        if self.max_size == 0:
+            return
+
+        try:
+            cache_time = ResponseCache.cache_time(response)
+            if cache_time > 0 and len(response) <= self.max_size and not ResponseCache.is_private(response):
+                mtime = os.stat(file_path).st_mtime_ns
+                with self.lock:
+                    self.__remove(key)
+                    self.entries[key] = (time.time()+cache_time, mtime, response)
+                    self.size += len(response)
+                    while self.size > self.max_size:
+                        self.__remove(next(iter(self.entries)))
+
+        except Exception as e:
+            RNS.log("Could not cache output of "+str(file_path)+": "+str(e), RNS.LOG_DEBUG)
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def hit_ratio(self):
+        requests = self.hits+self.misses
+        if requests == 0:
+            return None
+        else:
+            return self.hits/requests
+
+    def __get(self, key, mtime):
+        if key in self.entries:
+            expires, entry_mtime, response = self.entries[key]
+            if expires > time.time() and entry_mtime == mtime:
+                self.entries.move_to_end(key)
+                return response
+            else:
+                self.__remove(key)
+
+        return None
+
+    def __remove(self, key):
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key)[2])
+
+class ContentIndex:
+    READ_CHUNK_SIZE = 1024*1024
+
+    # Content hashes are stored on disk along with the mtime and
+    # size of each file, so files that did not change while the
+    # node was stopped are not hashed again on startup.
+    def __init__(self, storage_path=None):
+        self.storage_path = storage_path
+        self.hashes = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+
+        if self.storage_path != None:
+            self.load()
+
+    def load(self):
+        try:
+            if os.path.isfile(self.storage_path):
+                fh = open(self.storage_path, "rb")
+                entries = msgpack.unpackb(fh.read())
+                fh.close()
+
+                for file_path in entries:
+                    mtime, size, content_hash = entries[file_path]
+                    try:
+                        file_stat = os.stat(file_path)
+                        if mtime == file_stat.st_mtime_ns and size == file_stat.st_size:
+                            self.hashes[file_path] = (mtime, size, content_hash)
+                        else:
+                            self.dirty = True
+
+                    except FileNotFoundError:
+                        self.dirty = True
+
+                RNS.log("Loaded "+str(len(self.hashes))+" content hashes from "+str(self.storage_path), RNS.LOG_DEBUG)
+
+        except Exception as e:
+            RNS.log("Could not load content index from "+str(self.storage_path)+": "+str(e), RNS.LOG_ERROR)
+            self.hashes = {}
+
+    def save(self):
+        if self.storage_path == None:
+            return
+
+        with self.lock:
+            entries = {}
+            for file_path in self.hashes:
+                entries[file_path] = list(self.hashes[file_path])
+            self.dirty = False
+
+        tmp_path = self.storage_path+".tmp"
+        try:
+            fh = open(tmp_path, "wb")
+            fh.write(msgpack.packb(entries))
+            fh.close()
+            os.replace(tmp_path, self.storage_path)
+
+        except Exception as e:
+            self.dirty = True
+            if os.path.isfile(tmp_path):
+                os.unlink(tmp_path)
+            raise e
+
+    def get(self, file_path, compute=True):
+        file_stat = os.stat(file_path)
+        with self.lock:
+            if file_path in self.hashes:
+                mtime, size, content_hash = self.hashes[file_path]
+                if mtime == file_stat.st_mtime_ns and size == file_stat.st_size:
+                    return content_hash
+
+        if not compute:
+            return None
+
+        hasher = hashlib.sha256()
+        fh = open(file_path, "rb")
+        while True:
+            chunk = fh.read(ContentIndex.READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+        fh.close()
+
+        content_hash = hasher.digest()
+        with self.lock:
+            self.hashes[file_path] = (file_stat.st_mtime_ns, file_stat.st_size, content_hash)
+            self.dirty = True
+
+        return content_hash
+
+    def forget(self, file_path):
+        with self.lock:
+            if self.hashes.pop(file_path, None) != None:
+                self.dirty = True
+
+class VariantStore:
+    READ_CHUNK_SIZE = 1024*1024
+
+    def __init__(self, storage_path, max_size, max_file_size, min_ratio, content_index):
+        # Maximum store and file sizes are specified in megabytes
+        self.storage_path = storage_path
+        self.max_size = int(max_size*1000*1000)
+        self.max_file_size = int(max_file_size*1000*1000)
+        self.min_ratio = min_ratio
+        self.content_index = content_index
+        self.size = 0
+        self.served = 0
+        self.bytes_saved = 0
+        self.variants = OrderedDict()
+        self.incompressible = set()
+        self.pending = set()
+        self.build_queue = queue.Queue()
+        self.lock = threading.Lock()
+
+        if self.max_size > 0:
+            self.load()
+            builder_thread = threading.Thread(target=self.__builder)
+            builder_thread.daemon = True
+            builder_thread.start()
+
+    def load(self):
+        try:
+            for file in os.listdir(self.storage_path):
+                variant_path = self.storage_path+"/"+file
+                if file.endswith(".tmp"):
+                    os.unlink(variant_path)
+                elif file.endswith(".bz2"):
+                    variant_size = os.path.getsize(variant_path)
+                    self.variants[file[:-4]] = (variant_size, None)
+                    self.size += variant_size
+
+            self.__evict()
+
+        except Exception as e:
+            RNS.log("Could not load compressed variant store: "+str(e), RNS.LOG_ERROR)
+
+    def variant_path(self, content_hash):
+        return self.storage_path+"/"+content_hash+".bz2"
+
+    def too_large(self, file_size):
+        # Files larger than the store itself, or than the configured
+        # maximum file size, are never compressed
+        if file_size > self.max_size:
+            return True
+        elif self.max_file_size > 0 and file_size > self.max_file_size:
+            return True
+        else:
+            return False
+
+    def update(self, file_path):
+        if self.max_size > 0:
+            try:
+                if self.too_large(os.path.getsize(file_path)):
+                    return
+
+            except Exception as e:
+                return
+
+            with self.lock:
+                if not file_path in self.pending:
+                    self.pending.add(file_path)
+                    self.build_queue.put(file_path)
+
+    def get(self, file_path):
+        if self.max_size == 0:
+            return None
+
+        content_hash = self.content_index.get(file_path, compute=False)
+        if content_hash != None:
+            content_hash = content_hash.hex()
+            with self.lock:
+                if content_hash in self.variants:
+                    variant_size, original_size = self.variants[content_hash]
+                    if original_size != None:
+                        self.variants.move_to_end(content_hash)
+                        self.served += 1
+                        self.bytes_saved += original_size-variant_size
+                        return self.variant_path(content_hash)
+
+                elif content_hash in self.incompressible:
+                    return None
+
+        self.update(file_path)
+        return None
+
+    def build(self, file_path):
+        if self.max_size == 0:
+            return None
+
+        file_size = os.path.getsize(file_path)
+        if self.too_large(file_size):
+            return None
+
+        content_hash = self.content_index.get(file_path).hex()
+
+        with self.lock:
+            if content_hash in self.variants:
+                variant_size = self.variants[content_hash][0]
+                self.variants[content_hash] = (variant_size, file_size)
+                return self.variant_path(content_hash)
+            elif content_hash in self.incompressible:
+                return None
+
+        tmp_path = self.variant_path(content_hash)+"."+str(threading.get_ident())+".tmp"
+        compressor = bz2.BZ2Compressor()
+        variant_size = 0
+        fh = open(file_path, "rb")
+        th = open(tmp_path, "wb")
+        while True:
+            chunk = fh.read(VariantStore.READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            compressed = compressor.compress(chunk)
+            variant_size += len(compressed)
+            th.write(compressed)
+        compressed = compressor.flush()
+        variant_size += len(compressed)
+        th.write(compressed)
+        th.close()
+        fh.close()
+
+        with self.lock:
+            if variant_size >= file_size*self.min_ratio or variant_size > self.max_size:
+                os.unlink(tmp_path)
+                self.incompressible.add(content_hash)
+                return None
+
+            elif content_hash in self.variants:
+                os.unlink(tmp_path)
+
+            else:
+                os.replace(tmp_path, self.variant_path(content_hash))
+                self.variants[content_hash] = (variant_size, file_size)
+                self.size += variant_size
+                RNS.log("Built compressed variant of "+str(file_path)+", "+RNS.prettysize(file_size)+" to "+RNS.prettysize(variant_size), RNS.LOG_DEBUG)
+                self.__evict()
+
+            if content_hash in self.variants:
+                return self.variant_path(content_hash)
+            else:
+                return None
+
+    def reset_stats(self):
+        self.served = 0
+        self.bytes_saved = 0
+
+    def __evict(self):
+        while self.size > self.max_size and len(self.variants) > 0:
+            content_hash, entry = self.variants.popitem(last=False)
+            self.size -= entry[0]
+            try:
+                os.unlink(self.variant_path(content_hash))
+            except Exception as e:
+                RNS.log("Could not remove evicted variant "+str(content_hash)+": "+str(e), RNS.LOG_DEBUG)
+
+    def __builder(self):
+        while True:
+            file_path = self.build_queue.get()
+            with self.lock:
+                self.pending.discard(file_path)
+
+            try:
+                if os.path.isfile(file_path):
+                    self.build(file_path)
+
+            except Exception as e:
+                RNS.log("Could not build compressed variant of "+str(file_path)+": "+str(e), RNS.LOG_DEBUG)
+
+class ACLRegistry:
+    def __init__(self, script_ttl):
+        self.script_ttl = script_ttl
+        self.lists = {}
+        self.lock = threading.Lock()
+
+    def get(self, allowed_path):
+        # Allow lists are cached by their resolved path, so pages
+        # with symlinked .allowed files share a single parsed list.
+        try:
+            real_path = os.path.realpath(allowed_path)
+            file_stat = os.stat(real_path)
+            if not stat.S_ISREG(file_stat.st_mode):
+                return None
+
+        except FileNotFoundError:
+            with self.lock:
+                self.lists.pop(real_path, None)
+            return None
+
+        executable = os.access(real_path, os.X_OK)
+        key = (file_stat.st_mtime_ns, file_stat.st_size)
+        now = time.time()
+
+        with self.lock:
+            if real_path in self.lists:
+                cached_key, allowed_list, fetched_at = self.lists[real_path]
+                if cached_key == key:
+                    if not executable or now < fetched_at+self.script_ttl:
+                        return allowed_list
+
+        try:
+            if executable:
+                allowed_result = subprocess.run([real_path], stdout=subprocess.PIPE)
+                allowed_input = allowed_result.stdout
+
+            else:
+                fh = open(real_path, "rb")
+                allowed_input = fh.read()
+                fh.close()
+
+        except Exception as e:
+            RNS.log("Error while fetching list of allowed identities for request: "+str(e), RNS.LOG_ERROR)
+            return frozenset()
+
+        allowed_list = ACLRegistry.parse(allowed_input)
+        with self.lock:
+            self.lists[real_path] = (key, allowed_list, now)
+
+        return allowed_list
+
+    def forget(self, allowed_path):
+        with self.lock:
+            real_path = os.path.realpath(allowed_path)
+            if real_path in self.lists:
+                self.lists.pop(real_path)
+
+    @staticmethod
+    def parse(allowed_input):
+        allowed_hashes = set()
+        for hash_str in allowed_input.splitlines():
+            hash_str = hash_str.strip()
+            if len(hash_str) == RNS.Identity.TRUNCATED_HASHLENGTH//8*2:
+                try:
+                    allowed_hashes.add(bytes.fromhex(hash_str.decode("utf-8")))
+
+                except Exception as e:
+                    RNS.log("Could not decode RNS Identity hash from: "+str(hash_str), RNS.LOG_DEBUG)
+                    RNS.log("The contained exception was: "+str(e), RNS.LOG_DEBUG)
+
+        return frozenset(allowed_hashes)
+
+class PythonHandlerBusy(Exception):
+    pass
+
+class PythonPageHandlers:
+    POOL_NONE = "none"
+    POOL_THREAD = "thread"
+    POOL_PROCESS = "process"
+    MAX_TIMED_OUT = 4
+
+    # Python page handlers are modules in the pages directory that
+    # define a handle(path, data, remote_identity, link_id) function
+    # returning the page as bytes, a string or a generator of chunks.
+    # Modules are imported once, and imported again if the file
+    # changes. Handlers run in the request thread by default, but
+    # can also be run in a thread or process pool.
+    #
+    # Handlers in a process pool are stopped when they time out, and
+    # the worker process is replaced. Running threads can not be
+    # stopped, so for the other modes the timeout is only advisory:
+    # the request is answered with a timeout page, but the handler
+    # keeps running. While MAX_TIMED_OUT of those are still running,
+    # further requests are refused instead of piling up more threads.
+    def __init__(self, pool_type, workers):
+        self.pool_type = pool_type
+        self.modules = {}
+        self.lock = threading.Lock()
+        self.timed_out = 0
+        self.timed_out_lock = threading.Lock()
+
+        if pool_type == PythonPageHandlers.POOL_THREAD:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        elif pool_type == PythonPageHandlers.POOL_PROCESS:
+            self.executor = PythonHandlerPool(workers)
+        else:
+            self.executor = None
+
+    @staticmethod
+    def response_bytes(response):
+        if isinstance(response, bytes):
+            return response
+        elif isinstance(response, str):
+            return response.encode("utf-8")
+        elif response == None:
+            return b""
+        else:
+            chunks = []
+            for chunk in response:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                chunks.append(chunk)
+            return b"".join(chunks)
+
+    def handle(self, path, file_path, data, remote_identity, link_id, timeout=None):
+        if self.pool_type == PythonPageHandlers.POOL_PROCESS:
+            # Identities can not be passed to other processes, so
+            # the public key is sent, and the identity recreated
+            public_key = None
+            if remote_identity != None:
+                public_key = remote_identity.get_public_key()
+            return self.executor.handle((path, file_path, data, public_key, link_id), timeout)
+
+        if timeout == None:
+            if self.executor == None:
+                return self.run(path, file_path, data, remote_identity, link_id)
+            else:
+                return self.executor.submit(self.run, path, file_path, data, remote_identity, link_id).result()
+
+        with self.timed_out_lock:
+            if self.timed_out >= PythonPageHandlers.MAX_TIMED_OUT:
+                raise PythonHandlerBusy(str(self.timed_out)+" timed out Python page handlers are still running")
+
+        if self.executor == None:
+            future = concurrent.futures.Future()
+            thread = threading.Thread(target=self.__run_future, args=(future, path, file_path, data, remote_identity, link_id), daemon=True)
+            thread.start()
+        else:
+            future = self.executor.submit(self.run, path, file_path, data, remote_identity, link_id)
+
+        try:
+            return future.result(timeout)
+
+        except concurrent.futures.TimeoutError:
+            if not future.cancel():
+                with self.timed_out_lock:
+                    self.timed_out += 1
+                future.add_done_callback(self.__timed_out_done)
+                RNS.log("Python page handler "+str(file_path)+" timed out, but will keep running until it returns", RNS.LOG_WARNING)
+
+            raise subprocess.TimeoutExpired(file_path, timeout)
+
+    def __run_future(self, future, path, file_path, data, remote_identity, link_id):
+        if not future.set_running_or_notify_cancel():
+            return
+
+        try:
+            future.set_result(self.run(path, file_path, data, remote_identity, link_id))
+        except Exception as e:
+            future.set_exception(e)
+
+    def __timed_out_done(self, future):
+        with self.timed_out_lock:
+            self.timed_out -= 1
+
+    def run(self, path, file_path, data, remote_identity, link_id):
+        module = self.load(file_path)
+        return PythonPageHandlers.response_bytes(module.handle(path, data, remote_identity, link_id))
+
+    def load(self, file_path):
+        mtime = os.stat(file_path).st_mtime_ns
+        with self.lock:
+            if file_path in self.modules:
+                module_mtime, module = self.modules[file_path]
+                if module_mtime == mtime:
+                    return module
+
+            module_name = "nomadnet_page_"+hashlib.sha256(file_path.encode("utf-8")).hexdigest()[:16]
+            spec = importlib.util.spec_from_file_location(module_name, file_path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            if not callable(getattr(module, "handle", None)):
+                raise TypeError("Python page handler "+str(file_path)+" does not define a handle function")
+
+            if file_path in self.modules:
+                RNS.log("Reloaded Python page handler "+str(file_path), RNS.LOG_VERBOSE)
+            self.modules[file_path] = (mtime, module)
+            return module
+
+    def forget(self, file_path):
+        with self.lock:
+            self.modules.pop(file_path, None)
+
+    def shutdown(self):
+        if self.pool_type == PythonPageHandlers.POOL_PROCESS:
+            self.executor.shutdown()
+        elif self.executor != None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+def python_handler_worker(connection):
+    # Runs Python page handlers inside process pool workers,
+    # which keep their own set of imported handler modules
+    handlers = PythonPageHandlers(PythonPageHandlers.POOL_NONE, 0)
+    while True:
+        try:
+            path, file_path, data, public_key, link_id = connection.recv()
+        except EOFError:
+            break
+
+        try:
+            remote_identity = None
+            if public_key != None:
+                remote_identity = RNS.Identity(create_keys=False)
+                remote_identity.load_public_key(public_key)
+
+            connection.send((True, handlers.run(path, file_path, data, remote_identity, link_id)))
+
+        except Exception as e:
+            connection.send((False, type(e).__name__+": "+str(e)))
+
+class PythonHandlerProcess:
+    def __init__(self):
+        self.connection, worker_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.get_context("spawn").Process(target=python_handler_worker, args=(worker_connection,), daemon=True)
+        self.process.start()
+        worker_connection.close()
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def handle(self, request, timeout=None):
+        self.connection.send(request)
+        if not self.connection.poll(timeout):
+            self.stop()
+            raise subprocess.TimeoutExpired(request[1], timeout)
+
+        success, response = self.connection.recv()
+        if success:
+            return response
+        else:
+            raise RuntimeError(response)
+
+    def stop(self):
+        self.process.kill()
+        self.process.join(timeout=1)
+        self.connection.close()
+
+class PythonHandlerPool:
+    def __init__(self, size):
+        self.size = max(1, size)
+        self.workers = []
+        self.idle = []
+        self.condition = threading.Condition()
+
+    def handle(self, request, timeout=None):
+        worker = self.__acquire()
+        try:
+            response = worker.handle(request, timeout)
+
+        except subprocess.TimeoutExpired as e:
+            RNS.log("Python page handler "+str(request[1])+" timed out, replacing its worker process", RNS.LOG_DEBUG)
+            self.__discard(worker)
+            raise e
+
+        except RuntimeError as e:
+            self.__release(worker)
+            raise e
+
+        except Exception as e:
+            self.__discard(worker)
+            raise e
+
+        self.__release(worker)
+        return response
+
+    def __acquire(self):
+        with self.condition:
+            while True:
+                while len(self.idle) > 0:
+                    worker = self.idle.pop()
+                    if worker.is_alive():
+                        return worker
+                    else:
+                        worker.stop()
+                        self.workers.remove(worker)
+
+                if len(self.workers) < self.size:
+                    worker = PythonHandlerProcess()
+                    self.workers.append(worker)
+                    return worker
+
+                self.condition.wait()
+
+    def __release(self, worker):
+        with self.condition:
+            if worker in self.workers:
+                self.idle.append(worker)
+            else:
+                worker.stop()
+            self.condition.notify()
+
+    def __discard(self, worker):
+        worker.stop()
+        with self.condition:
+            if worker in self.workers:
+                self.workers.remove(worker)
+            self.condition.notify()
+
+    def shutdown(self):
+        with self.condition:
+            for worker in self.workers:
+                worker.stop()
+            self.workers = []
+            self.idle = []
+            self.condition.notify_all()
+
+class PersistentHandler:
+    # Persistent handlers are started with NOMADNET_PERSISTENT set in
+    # their environment, and then serve requests in a loop. Requests
+    # and responses are both framed as a 4-byte big-endian length
+    # followed by the payload. Request payloads are msgpack-encoded
+    # maps of the variables otherwise passed as environment variables,
+    # and response payloads are the generated page. Workers should
+    # exit when their stdin is closed.
+    LENGTH_BYTES = 4
+
+    def __init__(self, file_path, mtime):
+        self.file_path = file_path
+        self.mtime = mtime
+        self.last_used = time.time()
+        self.timed_out = False
+
+        env_map = {"NOMADNET_PERSISTENT": "1"}
+        if "PATH" in os.environ:
+            env_map["PATH"] = os.environ["PATH"]
+
+        self.process = subprocess.Popen([file_path], stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env_map)
+
+    def is_alive(self):
+        return self.process.poll() == None
+
+    def handle(self, env_map, timeout=None):
+        timer = None
+        if timeout != None:
+            timer = threading.Timer(timeout, self.__timed_out)
+            timer.daemon = True
+            timer.start()
+
+        try:
+            request = msgpack.packb(env_map)
+            self.process.stdin.write(len(request).to_bytes(PersistentHandler.LENGTH_BYTES, "big")+request)
+            self.process.stdin.flush()
+
+            length = int.from_bytes(self.__read(PersistentHandler.LENGTH_BYTES), "big")
+            response = self.__read(length)
+            self.last_used = time.time()
+
+        except Exception as e:
+            if self.timed_out:
+                raise subprocess.TimeoutExpired(self.file_path, timeout)
+            else:
+                raise e
+
+        finally:
+            if timer != None:
+                timer.cancel()
+
+        return response
+
+    def __timed_out(self):
+        self.timed_out = True
+        self.process.kill()
+
+    def __read(self, length):
+        data = b""
+        while len(data) < length:
+            chunk = self.process.stdout.read(length-len(data))
+            if not chunk:
+                raise IOError("Persistent handler "+str(self.file_path)+" closed its output")
+            data += chunk
+
+        return data
+
+    def stop(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=1)
+
+        except Exception as e:
+            self.process.kill()
+
+class HandlerPool:
+    def __init__(self, file_path, size):
+        self.file_path = file_path
+        self.size = max(1, size)
+        self.workers = []
+        self.idle = []
+        self.mtime = os.stat(file_path).st_mtime_ns
+        self.condition = threading.Condition()
+
+    def handle(self, env_map, timeout=None):
+        worker = self.__acquire()
+        try:
+            response = worker.handle(env_map, timeout)
+
+        except Exception as e:
+            self.__discard(worker)
+            raise e
+
+        self.__release(worker)
+        return response
+
+    def __acquire(self):
+        mtime = os.stat(self.file_path).st_mtime_ns
+        with self.condition:
+            if mtime != self.mtime:
+                RNS.log("Page "+str(self.file_path)+" changed, restarting persistent handlers", RNS.LOG_DEBUG)
+                self.mtime = mtime
+                for worker in self.idle:
+                    worker.stop()
+                    self.workers.remove(worker)
+                self.idle = []
+
+            while True:
+                while len(self.idle) > 0:
+                    worker = self.idle.pop()
+                    if worker.is_alive():
+                        return worker
+                    else:
+                        self.workers.remove(worker)
+
+                if len(self.workers) < self.size:
+                    worker = PersistentHandler(self.file_path, self.mtime)
+                    self.workers.append(worker)
+                    return worker
+
+                self.condition.wait()
+
+    def __release(self, worker):
+        with self.condition:
+            if worker in self.workers and worker.mtime == self.mtime:
+                self.idle.append(worker)
+            else:
+                worker.stop()
+                if worker in self.workers:
+                    self.workers.remove(worker)
+            self.condition.notify()
+
+    def __discard(self, worker):
+        worker.stop()
+        with self.condition:
+            if worker in self.workers:
+                self.workers.remove(worker)
+            self.condition.notify()
+
+    def reap(self, idle_timeout):
+        now = time.time()
+        with self.condition:
+            for worker in list(self.idle):
+                if not worker.is_alive() or now > worker.last_used+idle_timeout:
+                    RNS.log("Stopping idle persistent handler for "+str(self.file_path), RNS.LOG_DEBUG)
+                    worker.stop()
+                    self.idle.remove(worker)
+                    self.workers.remove(worker)
+
+    def shutdown(self):
+        with self.condition:
+            for worker in self.workers:
+                worker.stop()
+            self.workers = []
+            self.idle = []
+            self.condition.notify_all()
+
+class PageScheduler:
+    def __init__(self, max_running, max_running_per_page, max_queued, timeout):
+        self.max_running = max(1, max_running)
+        self.max_running_per_page = max(1, max_running_per_page)
+        self.max_queued = max(0, max_queued)
+        self.timeout = timeout if timeout > 0 else None
+        self.running = 0
+        self.running_pages = {}
+        self.queued = 0
+        self.peak_queued = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, path):
+        with self.condition:
+            if not self.__can_run(path):
+                if self.queued >= self.max_queued:
+                    self.rejected += 1
+                    return False
+
+                self.queued += 1
+                self.peak_queued = max(self.peak_queued, self.queued)
+                try:
+                    if not self.condition.wait_for(lambda: self.__can_run(path), timeout=self.timeout):
+                        self.rejected += 1
+                        return False
+
+                finally:
+                    self.queued -= 1
+
+            self.running += 1
+            if not path in self.running_pages:
+                self.running_pages[path] = 0
+            self.running_pages[path] += 1
+
+            return True
+
+    def release(self, path):
+        with self.condition:
+            self.running -= 1
+            self.running_pages[path] -= 1
+            if self.running_pages[path] == 0:
+                self.running_pages.pop(path)
+
+            self.condition.notify_all()
+
+    def reset_stats(self):
+        self.peak_queued = self.queued
+        self.rejected = 0
+        self.timeouts = 0
+
+    def __can_run(self, path):
+        if self.running >= self.max_running:
+            return False
+        elif path in self.running_pages and self.running_pages[path] >= self.max_running_per_page:
+            return False
+        else:
+            return True
+
 DEFAULT_INDEX = '''>Default Home Page
 
 This node is serving pages, but the home page file (index.mu) was not found in the page storage directory. This is an auto-generated placeholder.
@@ -266,3 +2235,21 @@ DEFAULT_NOTALLOWED = '''>Request Not Allowed
 
 You are not authorised to carry out the request.
 '''
+
+DEFAULT_BUSY = '''#!c=0
+>Node Busy
+
+This node is currently handling too many requests. Please try again in a little while.
+'''
+
+DEFAULT_TIMEOUT = '''#!c=0
+>Request Timed Out
+
+The page could not be generated in time. Please try again later.
+'''
+
+DEFAULT_RATE_LIMITED = '''#!c=0
+>Rate Limited
+
+You are sending requests to this node too quickly. Please wait a little while before trying again.
+'''
@@ -13,7 +13,7 @@ import RNS
 import LXMF
 import nomadnet
 
-from nomadnet.Directory import DirectoryEntry
+from nomadnet.Directory import DirectoryEntry, IgnoreList
 from datetime import datetime
 
 import RNS.vendor.umsgpack as msgpack
@@ -34,12 +34,24 @@ class NomadNetworkApp:
         configdir = userdir+"/.nomadnetwork"
 
     START_ANNOUNCE_DELAY = 3
+    PN_REFRESH_INTERVAL  = 10*60
 
     def exit_handler(self):
         self.should_run_jobs = False
 
+        if self.peer_settings_dirty:
+            RNS.log("Saving peer settings...", RNS.LOG_VERBOSE)
+            self.save_peer_settings()
+
         RNS.log("Saving directory...", RNS.LOG_VERBOSE)
         self.directory.save_to_disk()
+        if self.directory.announce_history != None:
+            self.directory.announce_history.close()
+
+        if self.node != None:
+            self.node.python_handlers.shutdown()
+            if self.node.content_index.dirty:
+                self.node.save_content_index()
 
         if hasattr(self.ui, "restore_ixon"):
             if self.ui.restore_ixon:
@@ -77,6 +89,9 @@ class NomadNetworkApp:
         self.enable_node   = False
         self.identity      = None
 
+        self.peer_settings_lock  = threading.Lock()
+        self.peer_settings_dirty = False
+
         self.uimode        = None
 
         if configdir == None:
@@ -105,8 +120,12 @@ class NomadNetworkApp:
         self.resourcepath      = self.configdir+"/storage/resources"
         self.conversationpath  = self.configdir+"/storage/conversations"
         self.directorypath     = self.configdir+"/storage/directory"
+        self.announcespath     = self.configdir+"/storage/announces"
         self.peersettingspath  = self.configdir+"/storage/peersettings"
         self.tmpfilespath      = self.configdir+"/storage/tmp"
+        self.variantspath      = self.configdir+"/storage/variants"
+        self.contentindexpath  = self.configdir+"/storage/contentindex"
+        self.metricspath       = self.configdir+"/storage/node_metrics.json"
 
         self.pagespath         = self.configdir+"/storage/pages"
         self.filespath         = self.configdir+"/storage/files"
@@ -121,6 +140,32 @@ class NomadNetworkApp:
         self.defer_jobs             = 90
         self.page_refresh_interval  = 0
         self.file_refresh_interval  = 0
+        self.page_cache_size        = 4
+        self.page_output_cache_size = 4
+        self.page_output_cache_per_identity = True
+        self.persistent_pages       = []
+        self.handler_pool_size      = 2
+        self.handler_idle_timeout   = 300
+        self.python_handlers        = []
+        self.python_handler_pool    = "none"
+        self.python_handler_workers = 4
+        self.file_listings          = False
+        self.file_listing_page_size = 100
+
+        self.max_page_executions          = 8
+        self.max_page_executions_per_page = 4
+        self.max_queued_page_requests     = 32
+        self.page_execution_timeout       = 30
+        self.allowed_script_ttl           = 0
+        self.variant_store_size           = 256
+        self.variant_max_file_size        = 32
+        self.page_rate_limit              = 0
+        self.page_rate_burst              = 10
+        self.page_rate_limit_total        = 0
+        self.file_rate_limit              = 0
+        self.file_rate_burst              = 4
+        self.file_rate_limit_total        = 0
+        self.metrics_snapshot_interval    = 10
 
         self.static_peers            = []
         self.peer_announce_at_start  = True
@@ -136,7 +181,15 @@ class NomadNetworkApp:
         self.periodic_lxmf_sync = True
         self.lxmf_sync_interval = 360*60
         self.lxmf_sync_limit    = 8
+        self.pn_autoselect_interval = 30
+        self.pn_selection_lock  = threading.Lock()
+        self.pn_selection_timer = None
+        self.pn_changed_nodes   = set()
+        self.pn_hops            = {}
+        self.last_pn_selection  = 0
+        self.last_pn_refresh    = 0
         self.compact_stream     = False
+        self.announce_history   = 10000
         
         self.required_stamp_cost   = None
         self.accept_invalid_stamps = False
@@ -163,6 +216,9 @@ class NomadNetworkApp:
         if not os.path.isdir(self.cachepath):
             os.makedirs(self.cachepath)
 
+        if not os.path.isdir(self.variantspath):
+            os.makedirs(self.variantspath)
+
         if not os.path.isdir(self.tmpfilespath):
             os.makedirs(self.tmpfilespath)
         else:
@@ -269,27 +325,7 @@ class NomadNetworkApp:
                 RNS.log("The contained exception was: %s" % (str(e)), RNS.LOG_ERROR)
                 nomadnet.panic()
 
-        self.ignored_list = []
-        if os.path.isfile(self.ignoredpath):
-            try:
-                fh = open(self.ignoredpath, "rb")
-                ignored_input = fh.read()
-                fh.close()
-
-                ignored_hash_strs = ignored_input.splitlines()
-
-                for hash_str in ignored_hash_strs:
-                    if len(hash_str) == RNS.Identity.TRUNCATED_HASHLENGTH//8*2:
-                        try:
-                            ignored_hash = bytes.fromhex(hash_str.decode("utf-8"))
-                            self.ignored_list.append(ignored_hash)
-
-                        except Exception as e:
-                            RNS.log("Could not decode RNS Identity hash from: "+str(hash_str), RNS.LOG_DEBUG)
-                            RNS.log("The contained exception was: "+str(e), RNS.LOG_DEBUG)
-
-            except Exception as e:
-                RNS.log("Error while loading list of ignored destinations: "+str(e), RNS.LOG_ERROR)
+        self.ignored_list = IgnoreList(self.ignoredpath)
 
         self.directory = nomadnet.Directory(self)
 
@@ -373,7 +409,7 @@ class NomadNetworkApp:
         RNS.Transport.register_announce_handler(nomadnet.Conversation)
         RNS.Transport.register_announce_handler(nomadnet.Directory)
 
-        self.autoselect_propagation_node()
+        self.select_propagation_node()
 
         if self.peer_announce_at_start:
             def delayed_announce():
@@ -428,6 +464,23 @@ class NomadNetworkApp:
                 RNS.log("Initiating automatic LXMF sync", RNS.LOG_VERBOSE)
                 self.request_lxmf_sync(limit=self.lxmf_sync_limit)
 
+            if self.peer_settings_dirty:
+                try:
+                    self.save_peer_settings()
+                except Exception as e:
+                    RNS.log("Could not save peer settings, retrying later. The contained exception was: "+str(e), RNS.LOG_ERROR)
+
+            self.directory.compact_journal()
+
+            if now > self.ignored_list.last_check+IgnoreList.RELOAD_INTERVAL:
+                ignored_changes = self.ignored_list.reload_if_changed()
+                if ignored_changes != None:
+                    added, removed = ignored_changes
+                    for destination_hash in added:
+                        self.message_router.ignore_destination(destination_hash)
+                    for destination_hash in removed:
+                        self.message_router.unignore_destination(destination_hash)
+
             time.sleep(self.job_interval)
 
     def set_display_name(self, display_name):
@@ -517,31 +570,71 @@ class NomadNetworkApp:
         self.peer_settings["last_announce"] = time.time()
         self.save_peer_settings()
 
-    def autoselect_propagation_node(self):
+    # Requests a re-evaluation of the selected propagation node.
+    # Requests are debounced, so announce bursts from candidate
+    # nodes only cause one evaluation per autoselect interval,
+    # and it runs on a timer thread instead of the caller's.
+    def autoselect_propagation_node(self, changed_node=None):
+        with self.pn_selection_lock:
+            if changed_node != None:
+                self.pn_changed_nodes.add(changed_node)
+
+            if self.pn_selection_timer == None:
+                delay = max(0, self.last_pn_selection+self.pn_autoselect_interval-time.time())
+                self.pn_selection_timer = threading.Timer(delay, self.select_propagation_node)
+                self.pn_selection_timer.daemon = True
+                self.pn_selection_timer.start()
+
+    def select_propagation_node(self):
         selected_node = None
 
-        if "propagation_node" in self.peer_settings and self.peer_settings["propagation_node"] != None:
-            selected_node = self.peer_settings["propagation_node"]
-        else:
-            nodes = self.directory.known_nodes()
-            trusted_nodes = []
-
-            best_hops = RNS.Transport.PATHFINDER_M+1
-
-            for node in nodes:
-                if node.trust_level == DirectoryEntry.TRUSTED:
-                    hops = RNS.Transport.hops_to(node.source_hash)
+        with self.pn_selection_lock:
+            self.pn_selection_timer = None
+            self.last_pn_selection = time.time()
 
-                    if hops < best_hops:
-                        best_hops = hops
-                        selected_node = node.source_hash
+            if "propagation_node" in self.peer_settings and self.peer_settings["propagation_node"] != None:
+                selected_node = self.peer_settings["propagation_node"]
+                cached_hops = None
+            else:
+                # Hop counts are cached per candidate, and only looked
+                # up again for candidates that have announced since
+                # the last evaluation, or after a full refresh interval
+                if time.time() > self.last_pn_refresh+NomadNetworkApp.PN_REFRESH_INTERVAL:
+                    self.last_pn_refresh = time.time()
+                    self.pn_hops = {}
+
+                cached_hops = self.pn_hops
+                changed_nodes = self.pn_changed_nodes
+                self.pn_changed_nodes = set()
+
+        # Hop counts are looked up without holding the selection
+        # lock, so announce ingestion is not stalled by the scan
+        if cached_hops != None:
+            candidates = self.directory.propagation_node_candidates()
+            pn_hops = {}
+            for node_hash in candidates:
+                if node_hash in cached_hops and not node_hash in changed_nodes:
+                    pn_hops[node_hash] = cached_hops[node_hash]
+                else:
+                    pn_hops[node_hash] = RNS.Transport.hops_to(node_hash)
 
-        if selected_node == None:
-            RNS.log("Could not autoselect a propagation node! LXMF propagation will not be available until a trusted node announces on the network, or a propagation node is manually selected.", RNS.LOG_WARNING)
-        else:
-            pn_name_str = ""
-            RNS.log("Selecting "+RNS.prettyhexrep(selected_node)+pn_name_str+" as default LXMF propagation node", RNS.LOG_DEBUG)
-            self.message_router.set_outbound_propagation_node(selected_node)
+            best_hops = RNS.Transport.PATHFINDER_M+1
+            for node_hash in sorted(candidates, key=lambda h: self.directory.sort_key(h)):
+                if pn_hops[node_hash] < best_hops:
+                    best_hops = pn_hops[node_hash]
+                    selected_node = node_hash
+
+        with self.pn_selection_lock:
+            if cached_hops != None:
+                self.pn_hops = pn_hops
+
+            if selected_node == None:
+                if self.message_router.get_outbound_propagation_node() == None:
+                    RNS.log("Could not autoselect a propagation node! LXMF propagation will not be available until a trusted node announces on the network, or a propagation node is manually selected.", RNS.LOG_WARNING)
+            elif selected_node != self.message_router.get_outbound_propagation_node():
+                pn_name_str = ""
+                RNS.log("Selecting "+RNS.prettyhexrep(selected_node)+pn_name_str+" as default LXMF propagation node", RNS.LOG_DEBUG)
+                self.message_router.set_outbound_propagation_node(selected_node)
 
     def get_user_selected_propagation_node(self):
         if "propagation_node" in self.peer_settings:
@@ -552,15 +645,43 @@ class NomadNetworkApp:
     def set_user_selected_propagation_node(self, node_hash):
         self.peer_settings["propagation_node"] = node_hash
         self.save_peer_settings()
-        self.autoselect_propagation_node()
+        self.select_propagation_node()
     
     def get_default_propagation_node(self):
         return self.message_router.get_outbound_propagation_node()
 
+    def increment_peer_counter(self, key):
+        # Counters are only updated in memory here, and are
+        # written to disk in batches by the job scheduler.
+        with self.peer_settings_lock:
+            self.peer_settings[key] += 1
+            self.peer_settings_dirty = True
+
     def save_peer_settings(self):
-        file = open(self.peersettingspath, "wb")
-        file.write(msgpack.packb(self.peer_settings))
-        file.close()
+        with self.peer_settings_lock:
+            packed_settings = msgpack.packb(self.peer_settings)
+
+            # The dirty flag is only cleared once the new settings
+            # are in place, so a failed write is retried later
+            tmp_path = self.peersettingspath+".tmp"
+            try:
+                file = open(tmp_path, "wb")
+                try:
+                    file.write(packed_settings)
+                    file.flush()
+                    os.fsync(file.fileno())
+                finally:
+                    file.close()
+                os.replace(tmp_path, self.peersettingspath)
+                self.peer_settings_dirty = False
+
+            except Exception as e:
+                if os.path.isfile(tmp_path):
+                    try:
+                        os.unlink(tmp_path)
+                    except Exception:
+                        pass
+                raise e
 
     def lxmf_delivery(self, message):
         time_string = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(message.timestamp))
@@ -759,6 +880,12 @@ class NomadNetworkApp:
                     else:
                         self.lxmf_sync_limit = None
 
+                if option == "pn_autoselect_interval":
+                    value = self.config["client"].as_int(option)
+                    if value < 0:
+                        value = 0
+                    self.pn_autoselect_interval = value
+
                 if option == "required_stamp_cost":
                     value = self.config["client"][option]
                     if value.lower() == "none":
@@ -789,6 +916,12 @@ class NomadNetworkApp:
                     value = self.config["client"].as_bool(option)
                     self.compact_stream = value
 
+                if option == "announce_history":
+                    value = self.config["client"].as_int(option)
+                    if value < 0:
+                        value = 0
+                    self.announce_history = value
+
                 if option == "notify_on_new_message":
                     value = self.config["client"].as_bool(option)
                     self.notify_on_new_message = value
@@ -942,6 +1075,195 @@ class NomadNetworkApp:
                 if value < 0:
                     value = 0
                 self.file_refresh_interval = value
+
+            if not "page_cache_size" in self.config["node"]:
+                self.page_cache_size = 4
+            else:
+                value = self.config["node"].as_float("page_cache_size")
+                if value < 0:
+                    value = 0
+                self.page_cache_size = value
+
+            if not "page_output_cache_size" in self.config["node"]:
+                self.page_output_cache_size = 4
+            else:
+                value = self.config["node"].as_float("page_output_cache_size")
+                if value < 0:
+                    value = 0
+                self.page_output_cache_size = value
+
+            if not "page_output_cache_per_identity" in self.config["node"]:
+                self.page_output_cache_per_identity = True
+            else:
+                self.page_output_cache_per_identity = self.config["node"].as_bool("page_output_cache_per_identity")
+
+            if "persistent_pages" in self.config["node"]:
+                self.persistent_pages = self.config["node"].as_list("persistent_pages")
+            else:
+                self.persistent_pages = []
+
+            if not "handler_pool_size" in self.config["node"]:
+                self.handler_pool_size = 2
+            else:
+                value = self.config["node"].as_int("handler_pool_size")
+                if value < 1:
+                    value = 1
+                self.handler_pool_size = value
+
+            if not "handler_idle_timeout" in self.config["node"]:
+                self.handler_idle_timeout = 300
+            else:
+                value = self.config["node"].as_int("handler_idle_timeout")
+                if value < 0:
+                    value = 0
+                self.handler_idle_timeout = value
+
+            if "python_handlers" in self.config["node"]:
+                self.python_handlers = self.config["node"].as_list("python_handlers")
+            else:
+                self.python_handlers = []
+
+            if not "python_handler_pool" in self.config["node"]:
+                self.python_handler_pool = "none"
+            else:
+                value = self.config["node"]["python_handler_pool"].lower()
+                if not value in ["none", "thread", "process"]:
+                    RNS.log("Invalid value for python_handler_pool in configuration, running Python page handlers without a pool", RNS.LOG_WARNING)
+                    value = "none"
+                self.python_handler_pool = value
+
+            if not "python_handler_workers" in self.config["node"]:
+                self.python_handler_workers = 4
+            else:
+                value = self.config["node"].as_int("python_handler_workers")
+                if value < 1:
+                    value = 1
+                self.python_handler_workers = value
+
+            if not "file_listings" in self.config["node"]:
+                self.file_listings = False
+            else:
+                self.file_listings = self.config["node"].as_bool("file_listings")
+
+            if not "file_listing_page_size" in self.config["node"]:
+                self.file_listing_page_size = 100
+            else:
+                value = self.config["node"].as_int("file_listing_page_size")
+                if value < 1:
+                    value = 1
+                self.file_listing_page_size = value
+
+            if not "max_page_executions" in self.config["node"]:
+                self.max_page_executions = 8
+            else:
+                value = self.config["node"].as_int("max_page_executions")
+                if value < 1:
+                    value = 1
+                self.max_page_executions = value
+
+            if not "max_page_executions_per_page" in self.config["node"]:
+                self.max_page_executions_per_page = 4
+            else:
+                value = self.config["node"].as_int("max_page_executions_per_page")
+                if value < 1:
+                    value = 1
+                self.max_page_executions_per_page = value
+
+            if not "max_queued_page_requests" in self.config["node"]:
+                self.max_queued_page_requests = 32
+            else:
+                value = self.config["node"].as_int("max_queued_page_requests")
+                if value < 0:
+                    value = 0
+                self.max_queued_page_requests = value
+
+            if not "page_execution_timeout" in self.config["node"]:
+                self.page_execution_timeout = 30
+            else:
+                value = self.config["node"].as_float("page_execution_timeout")
+                if value < 0:
+                    value = 0
+                self.page_execution_timeout = value
+
+            if not "allowed_script_ttl" in self.config["node"]:
+                self.allowed_script_ttl = 0
+            else:
+                value = self.config["node"].as_float("allowed_script_ttl")
+                if value < 0:
+                    value = 0
+                self.allowed_script_ttl = value
+
+            if not "variant_store_size" in self.config["node"]:
+                self.variant_store_size = 256
+            else:
+                value = self.config["node"].as_float("variant_store_size")
+                if value < 0:
+                    value = 0
+                self.variant_store_size = value
+
+            if not "variant_max_file_size" in self.config["node"]:
+                self.variant_max_file_size = 32
+            else:
+                value = self.config["node"].as_float("variant_max_file_size")
+                if value < 0:
+                    value = 0
+                self.variant_max_file_size = value
+
+            if not "page_rate_limit" in self.config["node"]:
+                self.page_rate_limit = 0
+            else:
+                value = self.config["node"].as_float("page_rate_limit")
+                if value < 0:
+                    value = 0
+                self.page_rate_limit = value
+
+            if not "page_rate_burst" in self.config["node"]:
+                self.page_rate_burst = 10
+            else:
+                value = self.config["node"].as_int("page_rate_burst")
+                if value < 1:
+                    value = 1
+                self.page_rate_burst = value
+
+            if not "page_rate_limit_total" in self.config["node"]:
+                self.page_rate_limit_total = 0
+            else:
+                value = self.config["node"].as_float("page_rate_limit_total")
+                if value < 0:
+                    value = 0
+                self.page_rate_limit_total = value
+
+            if not "file_rate_limit" in self.config["node"]:
+                self.file_rate_limit = 0
+            else:
+                value = self.config["node"].as_float("file_rate_limit")
+                if value < 0:
+                    value = 0
+                self.file_rate_limit = value
+
+            if not "file_rate_burst" in self.config["node"]:
+                self.file_rate_burst = 4
+            else:
+                value = self.config["node"].as_int("file_rate_burst")
+                if value < 1:
+                    value = 1
+                self.file_rate_burst = value
+
+            if not "file_rate_limit_total" in self.config["node"]:
+                self.file_rate_limit_total = 0
+            else:
+                value = self.config["node"].as_float("file_rate_limit_total")
+                if value < 0:
+                    value = 0
+                self.file_rate_limit_total = value
+
+            if not "metrics_snapshot_interval" in self.config["node"]:
+                self.metrics_snapshot_interval = 10
+            else:
+                value = self.config["node"].as_int("metrics_snapshot_interval")
+                if value < 0:
+                    value = 0
+                self.metrics_snapshot_interval = value
                 
 
             if "prioritise_destinations" in self.config["node"]:
@@ -1030,6 +1352,8 @@ class NomadNetworkApp:
 
     def quit(self):
         RNS.log("Nomad Network Client shutting down...")
+        if self.peer_settings_dirty:
+            self.save_peer_settings()
         os._exit(0)
 
 
@@ -1084,6 +1408,13 @@ lxmf_sync_interval = 360
 # the limit, and download everything every time.
 lxmf_sync_limit = 8
 
+# When no propagation node is manually selected,
+# the closest trusted node is selected auto-
+# matically. Announces and directory changes
+# cause this selection to be re-evaluated at
+# most once per this many seconds.
+pn_autoselect_interval = 30
+
 # You can specify a required stamp cost for
 # inbound messages to be accepted. Specifying
 # a stamp cost will require untrusted senders
@@ -1115,6 +1446,14 @@ max_accepted_size = 500
 # been received, for every destination.
 compact_announce_stream = yes
 
+# The number of announces kept in the on-disk
+# announce history. Only the most recent ones
+# are held in memory, and older announces can
+# be loaded from the announce stream. Each
+# announce uses 512 bytes of disk space. Set
+# to 0 to only keep recent announces.
+announce_history = 10000
+
 [textui]
 
 # Amount of time to show intro screen
@@ -1296,6 +1635,126 @@ max_sync_size = 10240
 
 # file_refresh_interval = 0
 
+# The node can serve automatically generated
+# listings of the hosted files, starting at
+# the /list path. Listings are split into pages
+# of the configured number of entries.
+
+# file_listings = no
+# file_listing_page_size = 100
+
+# Static pages are kept in an in-memory cache,
+# and are only read from disk again when they
+# change. You can configure the maximum size
+# of this cache in megabytes, or set it to 0
+# to disable it.
+
+# page_cache_size = 4
+
+# The output of executable pages that start
+# with a cache header, such as "#!c=60", is
+# cached by the node for the specified number
+# of seconds. Cached output is separate for
+# each combination of request variables, and
+# by default also for each identified user.
+# Set the cache size to 0 to disable it.
+
+# page_output_cache_size = 4
+# page_output_cache_per_identity = yes
+
+# Executable pages are normally started once
+# for every request. Pages written to serve
+# requests in a loop can instead be kept
+# running as a pool of persistent handlers,
+# which avoids the startup cost of the page
+# program. See the Guide for details on the
+# handler protocol.
+
+# persistent_pages = /page/board.mu, /page/app/index.mu
+
+# The number of handler processes to keep
+# running per persistent page, and the number
+# of seconds an idle handler is kept alive.
+
+# handler_pool_size = 2
+# handler_idle_timeout = 300
+
+# Pages written as Python modules can be loaded
+# directly into Nomad Network, which avoids
+# starting a new process for every request. See
+# the Guide for details on the handler API. By
+# default, handlers run in the thread handling
+# the request, but you can run them in a pool
+# of threads or processes instead. Only handlers
+# in a process pool can be stopped when they
+# exceed the page execution timeout.
+
+# python_handlers = /page/board.py
+# python_handler_pool = none
+# python_handler_workers = 4
+
+# You can limit how many executable pages can
+# run at the same time, both in total and for
+# each individual page. Requests exceeding the
+# limits are queued, and when the queue is full,
+# a "node busy" page is returned immediately.
+
+# max_page_executions = 8
+# max_page_executions_per_page = 4
+# max_queued_page_requests = 32
+
+# Executable pages that take longer than this
+# amount of seconds to generate are stopped.
+# Set to 0 to disable the timeout.
+
+# page_execution_timeout = 30
+
+# Lists of allowed identities are cached until
+# the .allowed file changes. Executable allow
+# lists are run for every request by default,
+# but you can cache their output for a number
+# of seconds.
+
+# allowed_script_ttl = 0
+
+# Compressed variants of requested files and static
+# pages are built in the background, so they do
+# not have to be compressed for every transfer.
+# You can set the maximum disk space in megabytes
+# used for storing these, or set it to 0 to
+# disable the variant store. No variants are
+# built for files larger than the maximum file
+# size in megabytes. Set it to 0 to only limit
+# files to the size of the variant store.
+
+# variant_store_size = 256
+# variant_max_file_size = 32
+
+# You can limit how many page and file requests
+# each client can make per minute. Clients are
+# tracked per link, and identified clients also
+# per identity. A client can make a burst of
+# requests up to the configured burst size,
+# before the rate limit applies. The total
+# limits apply to all clients together. Set a
+# limit to 0 to disable it.
+
+# page_rate_limit = 0
+# page_rate_burst = 10
+# page_rate_limit_total = 0
+# file_rate_limit = 0
+# file_rate_burst = 4
+# file_rate_limit_total = 0
+
+# The node keeps request metrics for the most
+# requested paths, and periodically writes a
+# snapshot of them, in JSON format, to the file
+# storage/node_metrics.json in the config
+# directory. You can set the interval in minutes,
+# or set it to 0 to disable writing snapshots.
+
+# metrics_snapshot_interval = 10
+
 [printing]
 
 # You can configure Nomad Network to print
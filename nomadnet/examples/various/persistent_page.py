@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import RNS.vendor.umsgpack as msgpack
+
+started = time.time()
+served = 0
+
+def render(env):
+    global served
+    served += 1
+    template = """>Persistent Page
+
+This page is generated by a handler process that was started {uptime} seconds ago, and has served {served} requests.
+
+Request variables:
+{variables}
+"""
+    variables = ""
+    for e in env:
+        variables += "{}={}\n".format(e, env[e])
+
+    return template.format(uptime=round(time.time()-started), served=served, variables=variables)
+
+def read_exactly(length):
+    data = b""
+    while len(data) < length:
+        chunk = sys.stdin.buffer.read(length-len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+if os.environ.get("NOMADNET_PERSISTENT") == "1":
+    while True:
+        header = read_exactly(4)
+        if header == None:
+            break
+
+        request = read_exactly(int.from_bytes(header, "big"))
+        if request == None:
+            break
+
+        response = render(msgpack.unpackb(request)).encode("utf-8")
+        sys.stdout.buffer.write(len(response).to_bytes(4, "big")+response)
+        sys.stdout.buffer.flush()
+
+else:
+    print(render(os.environ))
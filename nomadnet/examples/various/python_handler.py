@@ -0,0 +1,29 @@
+# This is an example of a Python page handler. To use it, place
+# it in your pages directory, and add its path to the
+# python_handlers option in your configuration, for example:
+#
+#   python_handlers = /page/python_handler.py
+#
+# The module is imported once, so state like the counter below
+# is kept between requests, unless handlers run in a process pool.
+import time
+
+started = time.time()
+served = 0
+
+def handle(path, data, remote_identity, link_id):
+    global served
+    served += 1
+
+    yield ">Python Page Handler\n\n"
+    yield "This page was generated by a handler module loaded "+str(round(time.time()-started))+" seconds ago, "
+    yield "and has served "+str(served)+" requests.\n\n"
+
+    if remote_identity != None:
+        yield "You are identified as "+remote_identity.hash.hex()+"\n\n"
+
+    if isinstance(data, dict):
+        yield "Request variables:\n"
+        for key in data:
+            if key.startswith("field_") or key.startswith("var_"):
+                yield key+"="+str(data[key])+"\n"
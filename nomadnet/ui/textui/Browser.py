@@ -2,7 +2,9 @@ import RNS
 import LXMF
 import io
 import os
+import bz2
 import time
+import hashlib
 import urwid
 import shutil
 import nomadnet
@@ -64,6 +66,8 @@ class Browser:
     DEFAULT_PATH       = "/page/index.mu"
     DEFAULT_TIMEOUT    = 10
     DEFAULT_CACHE_TIME = 12*60*60
+    # Expired cache entries are kept for revalidation this long
+    STALE_CACHE_TIME   = 7*24*60*60
 
     NO_PATH            = 0x00
     PATH_REQUESTED     = 0x01
@@ -78,6 +82,17 @@ class Browser:
     DISCONECTED        = 0xFE
     DONE               = 0xFF
 
+    PARTIAL_SUFFIX     = ".part"
+
+    # Nodes that are known to serve compressed variants, and
+    # nodes that have already been asked whether they do
+    variant_nodes = set()
+    variant_probed = set()
+
+    # Hashes of downloaded files, with the mtime and size they were
+    # computed for, so unchanged files are not hashed again
+    file_hashes = {}
+
     def __init__(self, app, app_name, aspects, destination_hash = None, path = None, auth_identity = None, delegate = None):
         self.app = app
         self.g = self.app.ui.glyphs
@@ -87,6 +102,10 @@ class Browser:
         self.destination_hash = destination_hash
         self.path = path
         self.request_data = None
+        self.stale_page_data = None
+        self.existing_file_name = None
+        self.existing_file_hash = None
+        self.download_path = None
         self.timeout = Browser.DEFAULT_TIMEOUT
         self.last_keypress = None
 
@@ -520,7 +539,11 @@ class Browser:
             if path.startswith("/file/"):
                 if destination_hash != self.loopback:
                     if destination_hash == self.destination_hash:
-                        self.download_file(destination_hash, path)
+                        # Downloads wait for paths and links, and hash
+                        # existing copies, so they run in a thread
+                        download_thread = threading.Thread(target=self.download_file, args=(destination_hash, path))
+                        download_thread.setDaemon(True)
+                        download_thread.start()
                     else:
                         RNS.log("Cannot request file download from a node that is not currently connected.", RNS.LOG_ERROR)
                         RNS.log("The requested URL was: "+str(url), RNS.LOG_ERROR)
@@ -635,21 +658,114 @@ class Browser:
             self.saved_file_name = None
 
             self.update_display()
-            receipt = self.link.request(
-                path,
-                data = None,
-                response_callback = self.file_received,
-                failed_callback = self.request_failed,
-                progress_callback = self.response_progressed
-            )
-
-            if receipt:
-                self.last_request_receipt = receipt
-                self.last_request_id = receipt.request_id
-                self.status = Browser.REQUEST_SENT
-                self.update_display()
+            # If a file of the same name has already been downloaded,
+            # its hash is sent along, and the node will only respond
+            # with the full file if the content has changed.
+            request_data = None
+            self.existing_file_name = os.path.basename(path)
+            self.existing_file_hash = None
+            existing_file = self.app.downloads_path+"/"+self.existing_file_name
+            if os.path.isfile(existing_file):
+                try:
+                    self.existing_file_hash = self.local_file_hash(existing_file)
+                    request_data = {"cached_hash": self.existing_file_hash}
+                except Exception as e:
+                    RNS.log("Could not hash existing download "+str(existing_file)+": "+str(e), RNS.LOG_DEBUG)
+
+            # Files are downloaded in ranges, which are appended to a
+            # partial file as they arrive, so an interrupted download
+            # loses at most one range. If a previous download of the
+            # same file was interrupted, it resumes where it stopped.
+            self.download_path = path
+            offset = 0
+            partial_file = self.partial_file_path(self.existing_file_name)
+            if os.path.isfile(partial_file):
+                offset = os.path.getsize(partial_file)
+                RNS.log("Resuming download of "+str(self.existing_file_name)+" from "+str(offset)+" bytes", RNS.LOG_DEBUG)
+
+            if offset == 0 and self.destination_hash in Browser.variant_nodes:
+                self.send_file_request(nomadnet.Node.VARIANT_PATH_PREFIX+path, request_data)
             else:
-                self.link.teardown()
+                self.request_file_range(offset, request_data)
+
+    def send_file_request(self, path, request_data):
+        receipt = self.link.request(
+            path,
+            data = request_data,
+            response_callback = self.file_received,
+            failed_callback = self.request_failed,
+            progress_callback = self.response_progressed
+        )
+
+        if receipt:
+            self.last_request_receipt = receipt
+            self.last_request_id = receipt.request_id
+            self.status = Browser.REQUEST_SENT
+            self.update_display()
+        else:
+            self.link.teardown()
+
+    def request_file_range(self, offset, request_data=None):
+        if request_data == None:
+            request_data = {}
+        request_data["range"] = [offset, None]
+        self.send_file_request(self.download_path, request_data)
+
+    def partial_file_path(self, file_name):
+        return self.app.downloads_path+"/"+os.path.basename(file_name)+Browser.PARTIAL_SUFFIX
+
+    def download_destination(self, file_name):
+        file_destination = self.app.downloads_path+"/"+file_name
+
+        counter = 0
+        while os.path.isfile(file_destination):
+            counter += 1
+            file_destination = self.app.downloads_path+"/"+file_name+"."+str(counter)
+
+        return file_destination
+
+    def discard_partial_file(self, file_name):
+        try:
+            partial_file = self.partial_file_path(file_name)
+            if os.path.isfile(partial_file):
+                os.unlink(partial_file)
+
+        except Exception as e:
+            RNS.log("Could not remove partial download of "+str(file_name)+": "+str(e), RNS.LOG_ERROR)
+
+    def range_received(self, response):
+        # Appends a received range to the partial file, and either
+        # requests the next range, or verifies and saves the file
+        # once it is complete. Returns whether the file was saved.
+        file_name = os.path.basename(response[0])
+        file_data = response[1]
+        file_range = response[2]
+        partial_file = self.partial_file_path(file_name)
+
+        offset = 0
+        if os.path.isfile(partial_file):
+            offset = os.path.getsize(partial_file)
+
+        if file_range["offset"] != offset:
+            raise ValueError("Received range at offset "+str(file_range["offset"])+" for partial download of "+str(offset)+" bytes")
+
+        fh = open(partial_file, "ab")
+        fh.write(file_data)
+        fh.close()
+        offset += len(file_data)
+
+        if offset < file_range["size"] and len(file_data) > 0:
+            self.request_file_range(offset)
+            return False
+
+        if offset != file_range["size"] or ("hash" in file_range and self.local_file_hash(partial_file) != file_range["hash"]):
+            os.unlink(partial_file)
+            raise ValueError("Downloaded "+str(file_name)+" does not match the file on the node, discarded the partial download")
+
+        file_destination = self.download_destination(file_name)
+        shutil.move(partial_file, file_destination)
+        self.saved_file_name = file_destination.replace(self.app.downloads_path+"/", "", 1)
+        return True
 
     def write_history(self):
         entry = [self.destination_hash, self.path]
@@ -749,7 +865,6 @@ class Browser:
                 def confirmed(sender):
                     node_entry = DirectoryEntry(self.destination_hash, display_name=display_name, hosts_node=True)
                     self.app.directory.remember(node_entry)
-                    self.app.ui.main_display.sub_displays.network_display.directory_change_callback()
 
                     self.close_dialogs()
 
@@ -790,6 +905,7 @@ class Browser:
         if self.request_data == None:
             cached = self.get_cached(self.current_url())
         else:
+            self.stale_page_data = None
             cached = None
 
         if cached:
@@ -961,9 +1077,17 @@ class Browser:
 
 
         self.update_display()
+        request_path = self.path
+        if self.destination_hash in Browser.variant_nodes and request_path.startswith("/page/"):
+            request_path = nomadnet.Node.VARIANT_PATH_PREFIX+request_path
+
+        request_data = self.request_data
+        if request_data == None and self.stale_page_data != None:
+            request_data = {"cached_hash": RNS.Identity.full_hash(self.stale_page_data)}
+
         receipt = self.link.request(
-            self.path,
-            data = self.request_data,
+            request_path,
+            data = request_data,
             response_callback = self.response_received,
             failed_callback = self.request_failed,
             progress_callback = self.response_progressed
@@ -1013,7 +1137,19 @@ class Browser:
     def response_received(self, request_receipt):
         try:
             self.status = Browser.DONE
-            self.page_data = request_receipt.response
+            response = request_receipt.response
+            revalidated = False
+            if isinstance(response, list) and response[0] == nomadnet.Node.NOT_MODIFIED:
+                if self.stale_page_data != None and RNS.Identity.full_hash(self.stale_page_data) == response[1]:
+                    RNS.log("Cached copy of "+str(self.current_url())+" is still valid", RNS.LOG_DEBUG)
+                    self.page_data = self.stale_page_data
+                    revalidated = True
+                else:
+                    raise ValueError("Received not modified response without a matching cached copy")
+            else:
+                self.page_data = self.variant_response_data(response)
+
+            self.stale_page_data = None
             self.markup = self.page_data.decode("utf-8")
 
             self.page_background_color = None
@@ -1037,7 +1173,7 @@ class Browser:
             self.response_speed = None
             self.progress_updated_at = None
             self.previous_progress = 0
-            self.loaded_from_cache = False
+            self.loaded_from_cache = revalidated
 
             # Simple header handling. Should be expanded when more
             # header tags are added.
@@ -1063,9 +1199,63 @@ class Browser:
                 RNS.log("Received page "+str(self.current_url())+", caching for %.3f hours." % (cache_time/60/60), RNS.LOG_DEBUG)    
                 self.cache_page(cache_time)
 
+            self.probe_variant_support()
+
         except Exception as e:
             RNS.log("An error occurred while handling response. The contained exception was: "+str(e))
 
+    def probe_variant_support(self):
+        # Nodes that serve compressed variants answer requests for
+        # the variant path prefix itself. Each node is asked once,
+        # after the first page loaded from it, so page loads are
+        # never delayed by nodes that do not answer.
+        destination_hash = self.destination_hash
+        if self.link == None or destination_hash in Browser.variant_nodes or destination_hash in Browser.variant_probed:
+            return
+
+        Browser.variant_probed.add(destination_hash)
+
+        def probe_received(request_receipt):
+            if isinstance(request_receipt.response, list) and nomadnet.Node.VARIANT_COMPRESSION in request_receipt.response:
+                RNS.log("Node "+RNS.prettyhexrep(destination_hash)+" serves compressed variants", RNS.LOG_DEBUG)
+                Browser.variant_nodes.add(destination_hash)
+
+        try:
+            self.link.request(nomadnet.Node.VARIANT_PATH_PREFIX, response_callback = probe_received)
+
+        except Exception as e:
+            RNS.log("Could not ask "+RNS.prettyhexrep(destination_hash)+" for variant support: "+str(e), RNS.LOG_DEBUG)
+
+    def variant_response_data(self, response):
+        if isinstance(response, list):
+            compression, response_data = response
+            if compression == nomadnet.Node.VARIANT_COMPRESSION:
+                return bz2.decompress(response_data)
+            else:
+                return response_data
+        else:
+            return response
+
+    def local_file_hash(self, file_path):
+        file_stat = os.stat(file_path)
+        if file_path in Browser.file_hashes:
+            mtime, size, file_hash = Browser.file_hashes[file_path]
+            if mtime == file_stat.st_mtime_ns and size == file_stat.st_size:
+                return file_hash
+
+        hasher = hashlib.sha256()
+        fh = open(file_path, "rb")
+        while True:
+            chunk = fh.read(1024*1024)
+            if not chunk:
+                break
+            hasher.update(chunk)
+        fh.close()
+
+        file_hash = hasher.digest()
+        Browser.file_hashes[file_path] = (file_stat.st_mtime_ns, file_stat.st_size, file_hash)
+        return file_hash
+
     def uncache_page(self, url):
         url_hash = self.url_hash(url)
         files = os.listdir(self.app.cachepath)
@@ -1077,6 +1267,7 @@ class Browser:
 
     def get_cached(self, url):
         url_hash = self.url_hash(url)
+        self.stale_page_data = None
         files = os.listdir(self.app.cachepath)
         for file in files:
             cachepath = self.app.cachepath+"/"+file
@@ -1085,9 +1276,18 @@ class Browser:
                 if len(components) == 2 and len(components[0]) == 64 and len(components[1]) > 0:
                     expires = float(components[1])
 
-                    if time.time() > expires:
+                    if time.time() > expires+Browser.STALE_CACHE_TIME:
                         RNS.log("Removing stale cache entry "+str(file), RNS.LOG_DEBUG)
                         os.unlink(cachepath)
+                    elif time.time() > expires:
+                        # Expired entries are not displayed, but kept
+                        # so the node can be asked whether the page
+                        # has changed since it was cached.
+                        if file.startswith(url_hash):
+                            RNS.log("Found expired "+str(file)+" in cache, requesting revalidation", RNS.LOG_DEBUG)
+                            file = open(cachepath, "rb")
+                            self.stale_page_data = file.read()
+                            file.close()
                     else:
                         if file.startswith(url_hash):
                             RNS.log("Found "+str(file)+" in cache.", RNS.LOG_DEBUG)
@@ -1118,7 +1318,7 @@ class Browser:
                 if len(components) == 2 and len(components[0]) == 64 and len(components[1]) > 0:
                     expires = float(components[1])
 
-                    if time.time() > expires:
+                    if time.time() > expires+Browser.STALE_CACHE_TIME:
                         RNS.log("Removing stale cache entry "+str(file), RNS.LOG_DEBUG)
                         os.unlink(cachepath)
 
@@ -1148,36 +1348,79 @@ class Browser:
 
     def file_received(self, request_receipt):
         try:
-            if type(request_receipt.response) == io.BufferedReader:
+            response = request_receipt.response
+            if isinstance(response, list) and response[0] == nomadnet.Node.NOT_MODIFIED:
+                if self.existing_file_hash == None or response[1] != self.existing_file_hash:
+                    raise ValueError("Received not modified response without a matching downloaded file")
+
+                RNS.log("Previously downloaded "+str(self.existing_file_name)+" is unchanged, skipping download", RNS.LOG_DEBUG)
+                self.discard_partial_file(self.existing_file_name)
+                self.saved_file_name = self.existing_file_name
+
+            elif isinstance(response, dict) and nomadnet.Node.RATE_LIMITED in response:
+                RNS.log("File request was rate limited by the node, retry after "+str(response[nomadnet.Node.RATE_LIMITED])+" seconds", RNS.LOG_WARNING)
+                self.status = Browser.REQUEST_FAILED
+                self.update_display()
+                return
+
+            elif isinstance(response, list) and response[0] == nomadnet.Node.PLAIN_PATH:
+                RNS.log("No compressed variant of "+str(self.download_path)+" is available, downloading from plain path", RNS.LOG_DEBUG)
+                request_data = None
+                if self.existing_file_hash != None:
+                    request_data = {"cached_hash": self.existing_file_hash}
+                self.request_file_range(0, request_data)
+                return
+
+            elif isinstance(response, list) and len(response) > 2 and isinstance(response[2], dict) and "offset" in response[2]:
+                if not self.range_received(response):
+                    return
+
+            elif response == None and self.download_path != None:
+                self.discard_partial_file(self.existing_file_name)
+                raise ValueError("The node could not serve "+str(self.download_path))
+
+            elif type(request_receipt.response) == io.BufferedReader:
                 if request_receipt.metadata != None:
                     file_name   = os.path.basename(request_receipt.metadata["name"].decode("utf-8"))
                     file_handle = request_receipt.response
-                    file_destination = self.app.downloads_path+"/"+file_name
+                    file_destination = self.download_destination(file_name)
+
+                    if "variants" in request_receipt.metadata:
+                        if nomadnet.Node.VARIANT_COMPRESSION in request_receipt.metadata["variants"]:
+                            Browser.variant_nodes.add(self.destination_hash)
+
+                    if request_receipt.metadata.get("compression", None) == nomadnet.Node.VARIANT_COMPRESSION:
+                        decompressor = bz2.BZ2Decompressor()
+                        fh = open(file_handle.name, "rb")
+                        fd = open(file_destination, "wb")
+                        while True:
+                            chunk = fh.read(1024*1024)
+                            if not chunk:
+                                break
+                            fd.write(decompressor.decompress(chunk))
+                        fd.close()
+                        fh.close()
+                        os.unlink(file_handle.name)
 
-                    counter = 0
-                    while os.path.isfile(file_destination):
-                        counter += 1
-                        file_destination = self.app.downloads_path+"/"+file_name+"."+str(counter)
+                    else:
+                        shutil.move(file_handle.name, file_destination)
 
-                    shutil.move(file_handle.name, file_destination)
+                    self.discard_partial_file(file_name)
 
             else:
                 file_name = request_receipt.response[0]
                 file_data = request_receipt.response[1]
                 file_destination_name = os.path.basename(file_name)
-                file_destination = self.app.downloads_path+"/"+file_destination_name
-
-                counter = 0
-                while os.path.isfile(file_destination):
-                    counter += 1
-                    file_destination = self.app.downloads_path+"/"+file_destination_name+"."+str(counter)
+                file_destination = self.download_destination(file_destination_name)
 
                 fh = open(file_destination, "wb")
                 fh.write(file_data)
                 fh.close()
 
+                self.discard_partial_file(file_destination_name)
                 self.saved_file_name = file_destination.replace(self.app.downloads_path+"/", "", 1)
                     
+            self.download_path = None
             self.status = Browser.DONE
             self.response_progress = 0
             self.response_speed = None
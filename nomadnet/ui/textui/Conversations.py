@@ -234,7 +234,6 @@ class ConversationsDisplay():
                 self.app.directory.remember(entry)
                 self.update_conversation_list()
                 self.dialog_open = False
-                self.app.ui.main_display.sub_displays.network_display.directory_change_callback()
             except Exception as e:
                 RNS.log("Could not save directory entry. The contained exception was: "+str(e), RNS.LOG_VERBOSE)
                 if not dialog_pile.error_display:
@@ -334,6 +334,12 @@ You can use a preprocessor such as PHP, bash, Python (or whatever you prefer) to
 
 Data from fields and link variables will be passed to these scipts or programs as environment variables, and can simply be read by any method for accessing such.
 
+If the output of a dynamic page starts with a cache header, for example `!#!c=300`!, the node will also cache the generated output for that many seconds, and serve it to other requests with the same field and link variables without running the page again.
+
+If many requests for the same dynamic page, with the same field and link variables, arrive while the page is being generated, they can wait for, and receive, the output of that single execution. If the last output of the page started with a cache header, this output is shared between all requestors. Otherwise, it is only shared between identical requests arriving over the same link from the same identity, such as repeated requests from an impatient user. The number of saved executions is shown in the node statistics. Output is cached separately for each identified user, unless the `!page_output_cache_per_identity`! option is disabled. Pages that vary their output on the link ID should not include a cache header.
+
+Pages that must run for every single request, for example because they have side effects, can opt out of all output sharing by including a `!#!private`! line among the header lines at the start of their output. The output of such a page is never cached or shared by the node, and every request executes the page. Since the node learns this from the output, the line should be included in every response of the page.
+
 In the `!examples`! directory, you can find various small examples for the use of this feature. The currently included examples are:
 
  - A messageboard that receives messages over LXMF, contributed by trippcheng
@@ -341,6 +347,10 @@ In the `!examples`! directory, you can find various small examples for the use o
 
 By default, you can find the examples in `!~/.nomadnetwork/examples`!. If you build something neat, that you feel would fit here, you are more than welcome to contribute it.
 
+Starting a new process for every request can be slow, especially for pages written in interpreted languages on small devices. Pages listed in the `!persistent_pages`! configuration option are instead started once, and kept running as a pool of handler processes. A persistent handler is started with the `!NOMADNET_PERSISTENT`! environment variable set, and reads requests from stdin in a loop. Each request is a 4-byte big-endian length, followed by a msgpack-encoded map of the variables that would otherwise be passed as environment variables. The handler must respond by writing a 4-byte big-endian length, followed by the generated page, to stdout. Handlers are restarted when the page file changes, and if a handler fails, the page is executed normally instead. The `!persistent_page.py`! example shows how to write such a handler.
+
+Pages written in Python can avoid process startup entirely, by being loaded directly into Nomad Network as handler modules. A handler module is a `!.py`! file in the pages directory, listed in the `!python_handlers`! configuration option, that defines a `!handle(path, data, remote_identity, link_id)`! function. The function receives the request path, the request data, including any fields and link variables, the identity of the remote peer, if it identified, and the link ID. It must return the page as bytes or a string, or as a generator of chunks. Modules are imported once, and imported again when the file changes. Since handlers run inside Nomad Network itself, only use handler modules you trust. The `!python_handler.py`! example shows a simple handler.
+
 >>Authenticating Users
 
 Sometimes, you don't want everyone to be able to view certain pages or execute certain scripts. In such cases, you can use `*authentication`* to control who gets to run certain requests.
@@ -357,7 +367,9 @@ d454bcdac0e64fb68ba8e267543ae110
 `=
 ``
 
-You can also dynamically generate this list, by making the file executable, and writing a script (in whatever language you want), that prints the list to stdout. Every time someone tries to request the page, Nomad Network will check the allowed identities list, and only grant access to allowed users.
+You can also dynamically generate this list, by making the file executable, and writing a script (in whatever language you want), that prints the list to stdout. Every time someone tries to request the page, Nomad Network will check the allowed identities list, and only grant access to allowed users. If generating the list is slow, you can cache the output of such scripts with the `!allowed_script_ttl`! configuration option.
+
+If many pages should be available to the same users, you can keep a single list of allowed identities, and symlink the `!.allowed`! files of each page to it. Nomad Network will then only keep one copy of the list in memory.
 
 By default, Nomad Network connects anonymously to all nodes. To be able to identify, and access restricted pages, you must allow identifying on a per-node basis. To allow identifying when connecting to a node, you must go to the `!Known Nodes`! list in the `![ Network ]`! part of the program, and enable the `!Identify When Connecting`! checkbox under `!Node Info`!.
 
@@ -365,6 +377,12 @@ By default, Nomad Network connects anonymously to all nodes. To be able to ident
 
 Like pages, you can place files you want to make available in the `!~/.nomadnetwork/storage/files`! directory. To let a peer download a file, you should create a link to it in one of your pages.
 
+Instead of writing pages listing your files by hand, you can enable the `!file_listings`! option, and the node will serve generated listings of your files, showing names, sizes and modification times. The listing of the files directory is available at `!/list`!, and the listing of a subdirectory at `!/list/`! followed by the subdirectory path, for example `!/list/music/albums`!. Large directories are split into several pages. Listings are generated once and kept until files are added to or removed from the directory, which is detected when the files directory is rescanned.
+
+Files that are already compressed, such as archives, images and most media formats, are transferred without additional compression. Programs downloading files from a node can also request a part of a file, by including a `!range`! entry with a byte offset and an optional length in the request data. This allows interrupted downloads to be resumed. The range reaching the end of the file also includes its SHA-256 hash. The browser downloads files in ranges, and appends them to a `!.part`! file in your downloads directory as they arrive. If the download is interrupted, downloading the same file again resumes from where it stopped. Only the first range of a download counts towards the node's rate limits and request statistics. The completed file is checked against the size and hash reported by the node.
+
+When a page in your browser cache has expired, or you download a file that already exists in your downloads directory, the SHA-256 hash of your existing copy is sent along with the request. If the page or file on the node has not changed, the node only responds with a short `!not_modified`! response instead of sending the whole thing again. This only applies to static pages and files, since the output of executable pages can change on every request.
+
 >>Links and URLs
 
 Links to pages and resources in Nomad Network use a simple URL format. Here is an example:
@@ -741,6 +759,12 @@ The number of minutes between each automatic sync. The default is equal to 6 hou
 On low-bandwidth networks, it can be useful to limit the amount of messages downloaded in each sync. The default is 8. Set to 0 to download all available messages every time a sync occurs.
 <
 
+>>>
+`!pn_autoselect_interval = 30`!
+>>>>
+When no propagation node has been manually selected, the closest trusted node is selected automatically. Announces from trusted nodes and changes to the directory cause the selection to be re-evaluated, but at most once per this number of seconds.
+<
+
 >>>
 `!required_stamp_cost = None`!
 >>>>
@@ -765,6 +789,12 @@ The maximum accepted unpacked size for messages received directly from other pee
 With this option enabled, Nomad Network will only display one entry in the announce stream per destination. Older announces are culled when a new one arrives.
 <
 
+>>>
+`!announce_history = 10000`!
+>>>>
+The number of announces kept in the on-disk announce history. The most recent announces are held in memory and shown in the announce stream, and older announces can be loaded by selecting `!Load older announces`! at the end of the list. The history is a fixed-size file using 512 bytes per announce, so this option determines its size on disk. Set to `!0`! to only keep the most recent announces.
+<
+
 >> Text UI Section
 
 This section hold configuration directives related to the look and feel of the text-based user interface of the program. It is delimited by the `![textui]`! header in the configuration file. Available directives, along with their default values, are as follows:
@@ -870,7 +900,7 @@ Determines where the node server will look for hosted pages. Must be a readable
 >>>
 `!page_refresh_interval = 0`!
 >>>>
-Determines the interval in minutes for rescanning the hosted pages path. By default, this option is disabled, and the pages path will only be scanned on startup.
+Determines the interval in minutes for rescanning the hosted pages path. By default, this option is disabled, and the pages path will only be scanned on startup. Only pages that were added or removed since the last scan are registered or deregistered.
 <
 
 >>>
@@ -882,7 +912,157 @@ Determines where the node server will look for downloadable files. Must be a rea
 >>>
 `!file_refresh_interval = 0`!
 >>>>
-Determines the interval in minutes for rescanning the hosted files path. By default, this option is disabled, and the files path will only be scanned on startup.
+Determines the interval in minutes for rescanning the hosted files path. By default, this option is disabled, and the files path will only be scanned on startup. Only files that were added or removed since the last scan are registered or deregistered.
+<
+
+>>>
+`!file_listings = no`!
+>>>>
+If enabled, the node serves automatically generated listings of all hosted files and directories, starting at the `!/list`! path. See the `!Files`! part of the `*Hosting a Node`* section for details.
+<
+
+>>>
+`!file_listing_page_size = 100`!
+>>>>
+The number of entries shown on each page of a generated file listing.
+<
+
+>>>
+`!page_cache_size = 4`!
+>>>>
+Determines the maximum size, in megabytes, of the in-memory cache for static pages. Cached pages are only read from disk again when they are modified. Set to 0 to disable the cache.
+<
+
+>>>
+`!page_output_cache_size = 4`!
+>>>>
+Determines the maximum size, in megabytes, of the in-memory cache for the output of executable pages. Only output starting with a cache header, such as `!#!c=60`!, is cached, and only for the specified number of seconds. Set to 0 to disable the cache.
+<
+
+>>>
+`!page_output_cache_per_identity = yes`!
+>>>>
+Determines whether cached page output is kept separately for each identified user. Disable this if your pages do not vary their output on the remote identity, to let all users share the same cached output.
+<
+
+>>>
+`!persistent_pages = /page/board.mu, /page/app/index.mu`!
+>>>>
+A list of executable pages that should be served by a pool of persistent handler processes, instead of being started once per request. See the `!Dynamic Pages`! part of the `*Hosting a Node`* section for details.
+<
+
+>>>
+`!handler_pool_size = 2`!
+>>>>
+The maximum number of persistent handler processes to run for each persistent page.
+<
+
+>>>
+`!handler_idle_timeout = 300`!
+>>>>
+The number of seconds an idle persistent handler process is kept running before it is stopped.
+<
+
+>>>
+`!python_handlers = /page/board.py`!
+>>>>
+A list of Python page handler modules that should be loaded directly into Nomad Network, instead of being executed as separate programs. See the `!Dynamic Pages`! part of the `*Hosting a Node`* section for details.
+<
+
+>>>
+`!python_handler_pool = none`!
+>>>>
+Determines where Python page handlers run. With `!none`!, handlers run in the thread handling the request. With `!thread`! or `!process`!, they run in a pool of threads or processes. A process pool lets handlers use multiple CPU cores, but handlers can then not share state between workers. Handlers in a process pool that exceed the `!page_execution_timeout`! are stopped, and their worker process replaced. Running threads can not be stopped, so with `!none`! or `!thread`! the timeout is only advisory: the requestor receives a timeout page, but the handler keeps running until it returns. While four timed out handlers are still running, further requests for Python pages are answered with a "node busy" page.
+<
+
+>>>
+`!python_handler_workers = 4`!
+>>>>
+The number of threads or processes in the Python page handler pool.
+<
+
+>>>
+`!max_page_executions = 8`!
+>>>>
+The maximum number of executable pages that can be generated at the same time. Further requests are queued until a page generation finishes.
+<
+
+>>>
+`!max_page_executions_per_page = 4`!
+>>>>
+The maximum number of concurrent executions of any single executable page.
+<
+
+>>>
+`!max_queued_page_requests = 32`!
+>>>>
+The maximum number of page requests that can wait for execution. When the queue is full, the node immediately responds with a "node busy" page.
+<
+
+>>>
+`!page_execution_timeout = 30`!
+>>>>
+The maximum amount of seconds an executable page can run, or wait in the queue, before the request is aborted and the page program is stopped. Set to 0 to disable the timeout.
+<
+
+>>>
+`!allowed_script_ttl = 0`!
+>>>>
+The number of seconds the output of executable `!.allowed`! scripts is cached for. By default, these scripts are run for every request.
+<
+
+>>>
+`!variant_store_size = 256`!
+>>>>
+The maximum disk space, in megabytes, used for storing pre-compressed variants of hosted files and static pages. Variants are built in the background the first time a page or file is requested, and the least recently used variants are removed when the limit is reached. Set to 0 to disable the variant store.
+<
+
+>>>
+`!variant_max_file_size = 32`!
+>>>>
+The maximum size, in megabytes, of files that compressed variants are built for. No variants are built for larger files. Set to 0 to only limit files to the size of the variant store.
+<
+
+>>>
+`!page_rate_limit = 0`!
+>>>>
+The maximum number of page requests per minute each client can make. Clients are tracked per link, and identified clients are additionally tracked per identity. Requests exceeding the limit are answered with a short "rate limited" page. Set to 0 to disable the limit.
+<
+
+>>>
+`!page_rate_burst = 10`!
+>>>>
+The number of page requests a client can make in quick succession, before the rate limit applies.
+<
+
+>>>
+`!page_rate_limit_total = 0`!
+>>>>
+The maximum number of page requests per minute the node will handle from all clients together. Set to 0 to disable the limit.
+<
+
+>>>
+`!file_rate_limit = 0`!
+>>>>
+The maximum number of file requests per minute each client can make. Set to 0 to disable the limit.
+<
+
+>>>
+`!file_rate_burst = 4`!
+>>>>
+The number of file requests a client can make in quick succession, before the rate limit applies.
+<
+
+>>>
+`!file_rate_limit_total = 0`!
+>>>>
+The maximum number of file requests per minute the node will handle from all clients together. Set to 0 to disable the limit.
+<
+
+>>>
+`!metrics_snapshot_interval = 10`!
+>>>>
+The interval in minutes for writing a snapshot of the node request metrics to `!storage/node_metrics.json`! in the configuration directory. The snapshot is in JSON format, and contains request counts, response sizes, cache hits, denied requests and latency histograms for the most requested paths, which makes it easy to collect with external monitoring tools. Set to 0 to disable writing snapshots.
 <
 
 >>>
@@ -951,7 +1131,9 @@ Specifies the command that Nomad Network uses to print the message. Defaults to
 
 >Ignoring Destinations
 
-If you encounter peers or nodes on the network, that you would rather not see in your client, you can add them to the `!~/.nomadnetwork/ignored`! file. To ignore nodes or peers, add one 32-character hexadecimal destination hash per line to the file. To unignore one again, simply remove the corresponding entry from the file and restart Nomad Network.
+If you encounter peers or nodes on the network, that you would rather not see in your client, you can add them to the `!~/.nomadnetwork/ignored`! file. To ignore nodes or peers, add one 32-character hexadecimal destination hash per line to the file. To unignore one again, simply remove the corresponding entry from the file. Changes to the file are picked up automatically while Nomad Network is running.
+
+To ignore every destination starting with a certain prefix, add the prefix followed by an asterisk, such as `!a1b2c3*`!. Anything after a `!#`! on a line is treated as a comment. Prefix rules apply to announces, while messages are only blocked for destinations listed with their full hash.
 '''
 
 TOPIC_NETWORKS = '''>Network Configuration
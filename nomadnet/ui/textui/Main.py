@@ -147,6 +147,7 @@ class MainDisplay():
 
     def start(self):
         self.menu_display.start()
+        self.sub_displays.network_display.watch_directory()
 
     def quit(self, sender=None):
         logterm_pid = None
@@ -1,3 +1,4 @@
+import os
 import RNS
 import urwid
 import nomadnet
@@ -125,7 +126,6 @@ class AnnounceInfo(urwid.WidgetWrap):
         def save_node(sender):
             node_entry = DirectoryEntry(source_hash, display_name=data_str, trust_level=trust_level, hosts_node=True)
             self.app.directory.remember(node_entry)
-            self.app.ui.main_display.sub_displays.network_display.directory_change_callback()
             show_announce_stream(None)
 
         if is_node:
@@ -373,6 +373,8 @@ class TabButton(urwid.Button):
     button_right = urwid.Text("]")
 
 class AnnounceStream(urwid.WidgetWrap):
+    OLDER_PAGE_SIZE = 100
+
     def __init__(self, app, parent):
         self.app = app
         self.parent = parent
@@ -383,6 +385,9 @@ class AnnounceStream(urwid.WidgetWrap):
         self.current_tab = "nodes"
 
         self.added_entries = []
+        self.older_entries = []
+        self.older_sources = None
+        self.older_exhausted = False
         self.widget_list = []
         self.update_widget_list()
 
@@ -425,8 +430,11 @@ class AnnounceStream(urwid.WidgetWrap):
 
     def delete_selected_entry(self):
         if self.ilb.get_selected_item() != None:
-            self.app.directory.remove_announce_with_timestamp(self.ilb.get_selected_item().original_widget.timestamp)
-            self.rebuild_widget_list()
+            selected = self.ilb.get_selected_item().original_widget
+            if hasattr(selected, "timestamp"):
+                self.app.directory.remove_announce_with_timestamp(selected.timestamp)
+                self.older_entries = [e for e in self.older_entries if e[0] != selected.timestamp]
+                self.rebuild_widget_list()
 
     def rebuild_widget_list(self):
         self.no_content = True
@@ -434,6 +442,40 @@ class AnnounceStream(urwid.WidgetWrap):
         self.widget_list = []
         self.update_widget_list()
 
+    def reset_older_entries(self):
+        self.older_entries = []
+        self.older_sources = None
+        self.older_exhausted = False
+
+    def tab_types(self):
+        if self.current_tab == "nodes":
+            return ["node"]
+        elif self.current_tab == "peers":
+            return ["peer"]
+        else:
+            return ["pn"]
+
+    # Pages announces that have dropped out of the in-memory
+    # stream in from the on-disk announce history
+    def load_older_entries(self, sender=None):
+        stream = self.app.directory.announce_stream.entries_list()
+        if len(self.older_entries) > 0:
+            before = self.older_entries[-1][0]
+        elif len(stream) > 0:
+            before = stream[-1][0]
+        else:
+            before = None
+
+        if self.app.compact_stream and self.older_sources == None:
+            self.older_sources = set(e[1] for e in stream)
+
+        older = self.app.directory.older_announces(before, AnnounceStream.OLDER_PAGE_SIZE, self.tab_types(), self.older_sources)
+        if len(older) < AnnounceStream.OLDER_PAGE_SIZE:
+            self.older_exhausted = True
+
+        self.older_entries.extend(older)
+        self.update_widget_list()
+
     def update_widget_list(self):
         self.widget_list = []
         new_entries = []
@@ -449,6 +491,8 @@ class AnnounceStream(urwid.WidgetWrap):
             elif self.current_tab == "pn" and announce_type == "pn":
                 new_entries.append(e)
 
+        new_entries.extend(self.older_entries)
+
         for e in new_entries:
             nw = AnnounceStreamEntry(self.app, e, self)
             nw.timestamp = e[0]
@@ -460,19 +504,25 @@ class AnnounceStream(urwid.WidgetWrap):
             self.no_content = True
             self.widget_list = [urwid.Text(f"No {self.current_tab} announces", align='center')]
 
+        if self.app.directory.announce_history != None and not self.older_exhausted:
+            self.widget_list.append(urwid.Button("Load older announces", on_press=self.load_older_entries))
+
         if self.ilb:
             self.ilb.set_body(self.widget_list)
 
     def show_nodes_tab(self, button):
         self.current_tab = "nodes"
+        self.reset_older_entries()
         self.update_widget_list()
 
     def show_peers_tab(self, button):
         self.current_tab = "peers"
+        self.reset_older_entries()
         self.update_widget_list()
 
     def show_pn_tab(self, button):
         self.current_tab = "pn"
+        self.reset_older_entries()
         self.update_widget_list()
 
     def list_selection(self, arg1, arg2):
@@ -688,7 +738,6 @@ class KnownNodeInfo(urwid.WidgetWrap):
 
             node_entry = DirectoryEntry(source_hash, display_name=display_str, trust_level=trust_level, hosts_node=True, identify_on_connect=connect_identify_checkbox.get_state(), sort_rank=sort_rank)
             self.app.directory.remember(node_entry)
-            self.app.ui.main_display.sub_displays.network_display.directory_change_callback()
 
             if trust_level == DirectoryEntry.TRUSTED:
                 self.app.autoselect_propagation_node()
@@ -1192,6 +1241,225 @@ class NodeTotalFiles(urwid.WidgetWrap):
         self.started = False
 
 
+class NodePageCacheStats(urwid.WidgetWrap):
+    def __init__(self, app):
+        self.started = False
+        self.app = app
+        self.timeout = self.app.config["textui"]["animation_interval"]
+        self.display_widget = urwid.Text("")
+        self.update_stat()
+
+        super().__init__(self.display_widget)
+
+    def update_stat(self):
+        self.stat_string = "None"
+        if self.app.node != None:
+            cache = self.app.node.page_cache
+            ratio = cache.hit_ratio()
+            ratio_str = ""
+            if ratio != None:
+                ratio_str = " ("+str(round(ratio*100))+"%)"
+
+            self.stat_string = str(cache.hits)+" hits, "+str(cache.misses)+" misses"+ratio_str
+
+            output_cache = self.app.node.response_cache
+            ratio = output_cache.hit_ratio()
+            if ratio != None:
+                self.stat_string += ", output "+str(round(ratio*100))+"% cached"
+
+        self.display_widget.set_text("Page Cache     : "+self.stat_string)
+
+    def update_stat_callback(self, loop=None, user_data=None):
+        self.update_stat()
+        if self.started:
+            self.app.ui.loop.set_alarm_in(self.timeout, self.update_stat_callback)
+
+    def start(self):
+        was_started = self.started
+        self.started = True
+        if not was_started:
+            self.update_stat_callback()
+
+    def stop(self):
+        self.started = False
+
+
+class NodePageQueueStats(urwid.WidgetWrap):
+    def __init__(self, app):
+        self.started = False
+        self.app = app
+        self.timeout = self.app.config["textui"]["animation_interval"]
+        self.display_widget = urwid.Text("")
+        self.update_stat()
+
+        super().__init__(self.display_widget)
+
+    def update_stat(self):
+        self.stat_string = "None"
+        if self.app.node != None:
+            scheduler = self.app.node.page_scheduler
+            self.stat_string = str(scheduler.queued)+" queued (peak "+str(scheduler.peak_queued)+"), "+str(scheduler.rejected)+" rejected, "+str(scheduler.timeouts)+" timed out"
+            self.stat_string += ", "+str(self.app.node.request_coalescer.saved)+" executions saved"
+
+        self.display_widget.set_text("Page Queue     : "+self.stat_string)
+
+    def update_stat_callback(self, loop=None, user_data=None):
+        self.update_stat()
+        if self.started:
+            self.app.ui.loop.set_alarm_in(self.timeout, self.update_stat_callback)
+
+    def start(self):
+        was_started = self.started
+        self.started = True
+        if not was_started:
+            self.update_stat_callback()
+
+    def stop(self):
+        self.started = False
+
+
+class NodeVariantStats(urwid.WidgetWrap):
+    def __init__(self, app):
+        self.started = False
+        self.app = app
+        self.timeout = self.app.config["textui"]["animation_interval"]
+        self.display_widget = urwid.Text("")
+        self.update_stat()
+
+        super().__init__(self.display_widget)
+
+    def update_stat(self):
+        self.stat_string = "None"
+        if self.app.node != None:
+            store = self.app.node.variant_store
+            self.stat_string = str(store.served)+" served, "+RNS.prettysize(store.bytes_saved)+" saved"
+
+        self.display_widget.set_text("Variants       : "+self.stat_string)
+
+    def update_stat_callback(self, loop=None, user_data=None):
+        self.update_stat()
+        if self.started:
+            self.app.ui.loop.set_alarm_in(self.timeout, self.update_stat_callback)
+
+    def start(self):
+        was_started = self.started
+        self.started = True
+        if not was_started:
+            self.update_stat_callback()
+
+    def stop(self):
+        self.started = False
+
+
+class NodeRateLimitStats(urwid.WidgetWrap):
+    def __init__(self, app):
+        self.started = False
+        self.app = app
+        self.timeout = self.app.config["textui"]["animation_interval"]
+        self.display_widget = urwid.Text("")
+        self.update_stat()
+
+        super().__init__(self.display_widget)
+
+    def update_stat(self):
+        self.stat_string = "None"
+        if self.app.node != None:
+            page_limiter = self.app.node.page_rate_limiter
+            file_limiter = self.app.node.file_rate_limiter
+            if not page_limiter.enabled() and not file_limiter.enabled():
+                self.stat_string = "Disabled"
+            else:
+                clients = page_limiter.limited_clients()+file_limiter.limited_clients()
+                self.stat_string = str(page_limiter.limited)+" page, "+str(file_limiter.limited)+" file requests from "+str(clients)+" clients"
+
+                top_client = None
+                for limiter in [page_limiter, file_limiter]:
+                    client = limiter.top_client()
+                    if client != None and (top_client == None or client[2] > top_client[2]):
+                        top_client = client
+
+                if top_client != None:
+                    self.stat_string += "\n                 most by "+page_limiter.client_str(top_client[0])+", "+str(top_client[2])+" of "+str(top_client[1])+" limited"
+
+        self.display_widget.set_text("Rate Limited   : "+self.stat_string)
+
+    def update_stat_callback(self, loop=None, user_data=None):
+        self.update_stat()
+        if self.started:
+            self.app.ui.loop.set_alarm_in(self.timeout, self.update_stat_callback)
+
+    def start(self):
+        was_started = self.started
+        self.started = True
+        if not was_started:
+            self.update_stat_callback()
+
+    def stop(self):
+        self.started = False
+
+
+class NodeMetricsStats(urwid.WidgetWrap):
+    TOP_PATHS = 3
+
+    def __init__(self, app):
+        self.started = False
+        self.app = app
+        self.timeout = self.app.config["textui"]["animation_interval"]
+        self.display_widget = urwid.Text("")
+        self.update_stat()
+
+        super().__init__(self.display_widget)
+
+    def latency_str(self, histogram):
+        if histogram.count == 0:
+            return "n/a"
+
+        def ms(value):
+            if value == float("inf"):
+                return ">"+str(round(histogram.BOUNDS[-1]*1000))+"ms"
+            else:
+                return "<"+str(round(value*1000))+"ms"
+
+        return "p50 "+ms(histogram.percentile(0.5))+", p95 "+ms(histogram.percentile(0.95))
+
+    def update_stat(self):
+        text = "Requests       : None"
+        if self.app.node != None:
+            metrics = self.app.node.metrics
+            totals = metrics.totals
+            text = "Requests       : "+str(totals.requests)+", "+RNS.prettysize(totals.response_bytes)+", "+str(totals.denied)+" denied"
+            ratio = totals.cache_hit_ratio()
+            if ratio != None:
+                text += ", "+str(round(ratio*100))+"% cached"
+            text += "\nExecution Time : "+self.latency_str(totals.execution)
+            text += "\nRead Time      : "+self.latency_str(totals.read)
+
+            top_paths = metrics.top_paths(NodeMetricsStats.TOP_PATHS)
+            for i in range(len(top_paths)):
+                path, path_metrics = top_paths[i]
+                if i == 0:
+                    text += "\nTop Paths      : "
+                else:
+                    text += "\n                 "
+                text += path+" "+str(path_metrics.requests)+" req, "+RNS.prettysize(path_metrics.response_bytes)
+
+        self.display_widget.set_text(text)
+
+    def update_stat_callback(self, loop=None, user_data=None):
+        self.update_stat()
+        if self.started:
+            self.app.ui.loop.set_alarm_in(self.timeout, self.update_stat_callback)
+
+    def start(self):
+        was_started = self.started
+        self.started = True
+        if not was_started:
+            self.update_stat_callback()
+
+    def stop(self):
+        self.started = False
+
+
 class LocalPeer(urwid.WidgetWrap):
     announce_timer = None
 
@@ -1296,6 +1564,11 @@ class NodeInfo(urwid.WidgetWrap):
     conns_timer = None
     pages_timer = None
     files_timer = None
+    cache_timer = None
+    queue_timer = None
+    variants_timer = None
+    limits_timer = None
+    metrics_timer = None
     storage_timer = None
 
     def __init__(self, app, parent):
@@ -1328,6 +1601,14 @@ class NodeInfo(urwid.WidgetWrap):
                 self.app.peer_settings["served_page_requests"] = 0
                 self.app.peer_settings["served_file_requests"] = 0
                 self.app.save_peer_settings()
+                self.app.node.page_cache.reset_stats()
+                self.app.node.response_cache.reset_stats()
+                self.app.node.request_coalescer.reset_stats()
+                self.app.node.page_scheduler.reset_stats()
+                self.app.node.variant_store.reset_stats()
+                self.app.node.page_rate_limiter.reset_stats()
+                self.app.node.file_rate_limiter.reset_stats()
+                self.app.node.metrics.reset_stats()
 
             def announce_query(sender):
                 def dismiss_dialog(sender):
@@ -1398,6 +1679,41 @@ class NodeInfo(urwid.WidgetWrap):
                 self.t_total_files = NodeInfo.files_timer
                 self.t_total_files.update_stat()
 
+            if NodeInfo.cache_timer == None:
+                self.t_page_cache = NodePageCacheStats(self.app)
+                NodeInfo.cache_timer = self.t_page_cache
+            else:
+                self.t_page_cache = NodeInfo.cache_timer
+                self.t_page_cache.update_stat()
+
+            if NodeInfo.queue_timer == None:
+                self.t_page_queue = NodePageQueueStats(self.app)
+                NodeInfo.queue_timer = self.t_page_queue
+            else:
+                self.t_page_queue = NodeInfo.queue_timer
+                self.t_page_queue.update_stat()
+
+            if NodeInfo.variants_timer == None:
+                self.t_variants = NodeVariantStats(self.app)
+                NodeInfo.variants_timer = self.t_variants
+            else:
+                self.t_variants = NodeInfo.variants_timer
+                self.t_variants.update_stat()
+
+            if NodeInfo.limits_timer == None:
+                self.t_rate_limits = NodeRateLimitStats(self.app)
+                NodeInfo.limits_timer = self.t_rate_limits
+            else:
+                self.t_rate_limits = NodeInfo.limits_timer
+                self.t_rate_limits.update_stat()
+
+            if NodeInfo.metrics_timer == None:
+                self.t_metrics = NodeMetricsStats(self.app)
+                NodeInfo.metrics_timer = self.t_metrics
+            else:
+                self.t_metrics = NodeInfo.metrics_timer
+                self.t_metrics.update_stat()
+
             lxmf_addr_str = g["sent"]+" LXMF Propagation Node Address is "+RNS.prettyhexrep(RNS.Destination.hash_from_name_and_identity("lxmf.propagation", self.app.node.destination.identity))
             e_lxmf = urwid.Text(lxmf_addr_str, align=urwid.CENTER)
 
@@ -1418,6 +1734,11 @@ class NodeInfo(urwid.WidgetWrap):
                     self.t_total_connections,
                     self.t_total_pages,
                     self.t_total_files,
+                    self.t_page_cache,
+                    self.t_page_queue,
+                    self.t_variants,
+                    self.t_rate_limits,
+                    self.t_metrics,
                     urwid.Divider(g["divider1"]),
                     urwid.Columns([
                         (urwid.WEIGHT, 5, urwid.Button("Back", on_press=show_peer_info)),
@@ -1440,6 +1761,11 @@ class NodeInfo(urwid.WidgetWrap):
                 self.t_total_connections,
                 self.t_total_pages,
                 self.t_total_files,
+                self.t_page_cache,
+                self.t_page_queue,
+                self.t_variants,
+                self.t_rate_limits,
+                self.t_metrics,
                 urwid.Divider(g["divider1"]),
                 urwid.Columns([
                     (urwid.WEIGHT, 5, urwid.Button("Back", on_press=show_peer_info)),
@@ -1469,6 +1795,11 @@ class NodeInfo(urwid.WidgetWrap):
             self.t_total_connections.start()
             self.t_total_pages.start()
             self.t_total_files.start()
+            self.t_page_cache.start()
+            self.t_page_queue.start()
+            self.t_variants.start()
+            self.t_rate_limits.start()
+            self.t_metrics.start()
 
 
 class UpdatingText(urwid.WidgetWrap):
@@ -1509,13 +1840,14 @@ class NetworkStats(urwid.WidgetWrap):
         self.parent = parent
 
         def get_num_peers():
-            return self.app.directory.number_of_known_peers(lookback_seconds=30*60)
+            heard = self.app.directory.heard_peers()
+            return str(heard[5*60])+" (5m), "+str(heard[30*60])+" (30m), "+str(heard[24*60*60])+" (24h)"
 
 
         def get_num_nodes():
             return self.app.directory.number_of_known_nodes()
 
-        self.w_heard_peers = UpdatingText(self.app, "Heard Peers: ", get_num_peers, append_text=" (30m)")
+        self.w_heard_peers = UpdatingText(self.app, "Heard Peers: ", get_num_peers)
         self.w_known_nodes = UpdatingText(self.app, "Known Nodes: ", get_num_nodes)
 
         pile = urwid.Pile([
@@ -1601,6 +1933,10 @@ class NetworkDisplay():
         self.shortcuts_display = NetworkDisplayShortcuts(self.app)
         self.widget = self.columns
 
+        self.change_pipe = None
+        self.refresh_pending = False
+        self.last_directory_refresh = 0
+
     def toggle_list(self):
         if self.list_display != 0:
             options = self.left_pile.options(height_type=urwid.WEIGHT, height_amount=1)
@@ -1678,12 +2014,45 @@ class NetworkDisplay():
     def shortcuts(self):
         return self.shortcuts_display
 
-    def directory_change_callback(self):
-        self.announce_stream_display.rebuild_widget_list()
-        if self.known_nodes_display.no_content:
-            self.reinit_known_nodes()
-        else:
-            self.known_nodes_display.rebuild_widget_list()
+    # Directory changes can be signalled from any thread. They
+    # wake the UI loop through a pipe, and are applied on the
+    # loop thread at most once per animation interval.
+    def watch_directory(self):
+        if self.change_pipe == None:
+            self.change_pipe = self.app.ui.loop.watch_pipe(self.directory_changes_ready)
+            self.app.directory.add_change_listener(self.signal_directory_change)
+
+    def signal_directory_change(self):
+        try:
+            os.write(self.change_pipe, b"\x01")
+        except Exception as e:
+            RNS.log("Could not signal directory change to UI. The contained exception was: "+str(e), RNS.LOG_ERROR)
+
+    def directory_changes_ready(self, data):
+        if not self.refresh_pending:
+            self.refresh_pending = True
+            delay = self.last_directory_refresh+self.app.config["textui"]["animation_interval"]-time.time()
+            if delay > 0:
+                self.app.ui.loop.set_alarm_in(delay, self.refresh_directory_views)
+            else:
+                self.refresh_directory_views()
+
+        return True
+
+    def refresh_directory_views(self, loop=None, user_data=None):
+        self.refresh_pending = False
+        self.last_directory_refresh = time.time()
+        changes = self.app.directory.take_changes()
+        stream_changes = {"nodes": nomadnet.Directory.CHANGED_NODES, "peers": nomadnet.Directory.CHANGED_PEERS, "pn": nomadnet.Directory.CHANGED_PNS}
+
+        if changes & (stream_changes[self.announce_stream_display.current_tab] | nomadnet.Directory.CHANGED_ENTRIES):
+            self.announce_stream_display.rebuild_widget_list()
+
+        if changes & nomadnet.Directory.CHANGED_ENTRIES:
+            if self.known_nodes_display.no_content:
+                self.reinit_known_nodes()
+            else:
+                self.known_nodes_display.rebuild_widget_list()
 
 
 class LXMFPeers(urwid.WidgetWrap):